@@ -1,9 +1,84 @@
 #from .check_obj_memory import check_obj_memory
-from .read_optical import read_optical_data, laser_key
 #from .reread_data_from_fits import reread_data_from_fits
-from .check_ATL06_hold_list import *
-from .fit_OIB_aug import *
-from .im_subset import *
-from .read_ICESat2 import *
-from  . import register_DEMs
 
+import sys as _sys
+import types as _types
+
+# submodules are imported on first use (PEP 562), so that importing the
+# package is fast, and does not import numpy (see thread_budget) or the
+# optional LSsurf, pyTMD, SMBcorr, pointAdvection and GDAL dependencies.
+# _lazy_attrs maps each name that the package exported when it imported
+# its submodules eagerly to the submodule it came from.
+_lazy_attrs={
+    'read_ATL06_hold_files':'check_ATL06_hold_list',
+    'check_ATL06_hold_list':'check_ATL06_hold_list',
+    'importlib':'check_ATL06_hold_list',
+    'segDifferenceFilter':'read_ICESat2',
+    'read_ICESat2':'read_ICESat2',
+    'read_hold_files':'read_ICESat2',
+    'main':'read_ICESat2',
+    'np':'read_ICESat2',
+    'pc':'read_ICESat2',
+    'read_optical_data':'read_optical',
+    'laser_key':'read_optical',
+    'make_sensor_dict':'fit_OIB_aug',
+    'get_SRS_proj4':'fit_OIB_aug',
+    'GI_files':'fit_OIB_aug',
+    'custom_edits':'fit_OIB_aug',
+    'apply_tides':'fit_OIB_aug',
+    'mask_data_by_year':'fit_OIB_aug',
+    'interp_ds':'fit_OIB_aug',
+    'save_fit_to_file':'fit_OIB_aug',
+    'assign_sigma_corr':'fit_OIB_aug',
+    'save_errors_to_file':'fit_OIB_aug',
+    'fit_OIB':'fit_OIB_aug',
+    'reread_data_from_fits':'fit_OIB_aug',
+    'smooth_xytb_fit_aug':'fit_OIB_aug',
+    'fd_grid':'fit_OIB_aug',
+    'matlab_to_year':'fit_OIB_aug',
+    'subset_DEM_stack':'fit_OIB_aug',
+    'assign_firn_variable':'fit_OIB_aug',
+    'compute_tide_corrections':'fit_OIB_aug',
+    'pointAdvection':'fit_OIB_aug',
+    'datetime':'fit_OIB_aug',
+    'timedelta':'fit_OIB_aug',
+    'glob':'fit_OIB_aug',
+    'h5py':'fit_OIB_aug',
+    'os':'fit_OIB_aug',
+    're':'fit_OIB_aug',
+    'sys':'fit_OIB_aug',
+    'warnings':'fit_OIB_aug',
+    'im_subset':'im_subset',
+    'match_range':'im_subset',
+    'gdal':'im_subset',
+}
+_lazy_modules=['register_DEMs', 'thread_budget', 'fit_OIB_aug', 'fit_altimetry', 'read_optical',
+               'read_DEM_data']
+
+__all__=sorted(list(_lazy_attrs.keys()) + ['fit_OIB_aug', 'read_DEM_data', 'read_optical', 'register_DEMs'])
+
+def __getattr__(name):
+    import importlib
+    if name in _lazy_attrs:
+        value=getattr(importlib.import_module('.'+_lazy_attrs[name], __name__), name)
+    elif name in _lazy_modules:
+        value=importlib.import_module('.'+name, __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name]=value
+    return value
+
+def __dir__():
+    return sorted(set(list(globals().keys()) + list(_lazy_attrs.keys()) + _lazy_modules))
+
+class _package(_types.ModuleType):
+    def __setattr__(self, name, value):
+        # importing a submodule binds it to the package under its own name.
+        # Where the package exports a function or class with that name (e.g.
+        # reread_data_from_fits), keep the exported object instead.
+        if name in _lazy_attrs and isinstance(value, _types.ModuleType) \
+                and value.__name__==self.__name__+'.'+name:
+            value=getattr(value, name)
+        super().__setattr__(name, value)
+
+_sys.modules[__name__].__class__=_package
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Thin data more where the surface is smooth and less where it changes.
+
+The tile is divided into square regions, and each region gets an
+importance that increases with the median surface slope of its data and,
+if a previous fit is available, with the temporal variability (standard
+deviation over time) of that fit's dz.  Each region is thinned by
+selecting one point per block of a size that scales as
+L0/sqrt(importance/max importance): the most important regions are thinned
+at L0, and the least important are thinned more.  L0 is found by bisection
+so that the number of selected points is at most N_target.
+
+Blocks are formed separately for each sensor (i.e. for each DEM) and, for
+laser data, for each day, so that the thinning does not remove repeat
+measurements.  The point selected in each block is the one with the median
+elevation, so all of the data fields of the selected points are retained.
+"""
+
+import numpy as np
+import h5py
+
+def read_dz_variability(filename, group='dz', field='dz'):
+    '''
+    Read the standard deviation over time of the dz grid in a fit output file
+
+    Returns
+    -------
+    x, y, dz_std : numpy arrays
+        grid coordinates and the standard deviation of dz at each node,
+        or None if the file has no dz grid
+    '''
+    with h5py.File(filename,'r') as h5f:
+        if group not in h5f or field not in h5f[group]:
+            return None
+        x=np.array(h5f[group]['x'])
+        y=np.array(h5f[group]['y'])
+        dz=np.array(h5f[group][field], dtype=float)
+    return x, y, np.nanstd(dz, axis=2)
+
+def grid_lookup(x, y, grid):
+    '''
+    Nearest-node values of a regular grid (x, y, z) at points (x, y), NaN outside the grid
+    '''
+    gx, gy, gz = grid
+    col=np.round((x-gx[0])/(gx[1]-gx[0])).astype(int)
+    row=np.round((y-gy[0])/(gy[1]-gy[0])).astype(int)
+    inside=(col>=0) & (col<gx.size) & (row>=0) & (row<gy.size)
+    out=np.zeros(x.size)+np.nan
+    out[inside]=gz[row[inside], col[inside]]
+    return out
+
+def region_median(region, values, N_regions):
+    '''
+    Median of the finite values in each region (NaN for regions with none)
+    '''
+    out=np.zeros(N_regions)+np.nan
+    good=np.isfinite(values)
+    if not np.any(good):
+        return out
+    order=np.lexsort((values[good], region[good]))
+    r_sorted=region[good][order]
+    v_sorted=values[good][order]
+    regions, starts, counts = np.unique(r_sorted, return_index=True, return_counts=True)
+    out[regions]=0.5*(v_sorted[starts+(counts-1)//2] + v_sorted[starts+counts//2])
+    return out
+
+def region_importance(x, y, xy0, Wxy, region_size, slope_mag=None, dz_std=None):
+    '''
+    Assign each point to a region, and find the importance of each region
+
+    The importance is 1 + slope/median(slope) + dz_std/median(dz_std), with
+    each term omitted if it is not available.
+
+    Returns
+    -------
+    region : numpy array
+        region number for each point
+    importance : numpy array
+        importance of each region
+    '''
+    N_side=int(np.maximum(1, np.ceil(Wxy/region_size)))
+    col=np.clip(np.floor((x-(xy0[0]-Wxy/2))/region_size), 0, N_side-1).astype(int)
+    row=np.clip(np.floor((y-(xy0[1]-Wxy/2))/region_size), 0, N_side-1).astype(int)
+    region=row*N_side+col
+    importance=np.ones(N_side**2)
+    for values in [slope_mag, dz_std]:
+        if values is None:
+            continue
+        med=region_median(region, values, N_side**2)
+        ref=np.nanmedian(med) if np.any(np.isfinite(med)) else np.nan
+        if not np.isfinite(ref) or ref <= 0:
+            continue
+        importance += np.where(np.isfinite(med), med/ref, 0)
+    return region, importance
+
+def block_medians(z, groups):
+    '''
+    Indices of the median-elevation point in each group
+    '''
+    order=np.lexsort((z, groups))
+    starts, counts = np.unique(groups[order], return_index=True, return_counts=True)[1:]
+    return order[starts+(counts-1)//2]
+
+def thin_groups(x, y, group, region, importance, L0):
+    '''
+    Block number for each point, for base block size L0
+    '''
+    L=L0/np.sqrt(importance[region]/importance.max())
+    # blocks in different regions and groups have different keys because
+    # the region and group are part of the key
+    keys=[group, region, np.floor(x/L).astype(np.int64), np.floor(y/L).astype(np.int64)]
+    keys=[key-key.min() for key in keys]
+    key=np.ravel_multi_index(keys, [int(key.max())+1 for key in keys])
+    return np.unique(key, return_inverse=True)[1].ravel()
+
+def adaptive_thin(x, y, z, group, N_target, region, importance, L_min, L_max, N_bisect=16):
+    '''
+    Select points so that at most N_target remain, thinning the less important regions more
+
+    Parameters
+    ----------
+    x, y, z : numpy arrays
+        point coordinates and elevations
+    group : numpy array
+        integer group (e.g. sensor and day) for each point.  Points in
+        different groups are never in the same block
+    N_target : int
+        maximum number of points to keep
+    region, importance : numpy arrays
+        output of region_importance
+    L_min, L_max : float
+        range of base block sizes searched
+
+    Returns
+    -------
+    ind : numpy array
+        indices of the selected points
+    L0 : float
+        base block size
+    '''
+    if x.size <= N_target:
+        return np.arange(x.size), L_min
+    # bisect in log(L0) for the smallest block size that gives N_target or fewer points
+    lo, hi = np.log(L_min), np.log(L_max)
+    best=None
+    for count in range(N_bisect):
+        L0=np.exp((lo+hi)/2)
+        blocks=thin_groups(x, y, group, region, importance, L0)
+        if blocks.max()+1 > N_target:
+            lo=np.log(L0)
+        else:
+            hi=np.log(L0)
+            best=(L0, blocks)
+    if best is None:
+        print(f"adaptive_thin: could not reduce {x.size} points to {N_target} with block sizes up to {L_max}")
+        best=(L_max, thin_groups(x, y, group, region, importance, L_max))
+    return block_medians(z, best[1]), best[0]
+
+def thin_data(data, N_target, bm_scale, laser_sensors, xy0, Wxy, region_size=2000., dz_grid=None):
+    '''
+    Adaptively thin laser and DEM data to their N_target counts
+
+    Parameters
+    ----------
+    data : pointCollection.data
+        data to thin.  If a slope_mag field is present, it is used in the
+        region importance.
+    N_target : dict
+        maximum number of 'laser' and 'DEM' data
+    bm_scale : dict
+        blockmedian scales used when reading the data, used as the smallest block sizes
+    laser_sensors : list
+        sensor numbers for laser data
+    xy0, Wxy : list, float
+        tile center and width
+    region_size : float, optional
+        size of the regions over which importance is assessed.  The default is 2000.
+    dz_grid : tuple, optional
+        (x, y, dz_std) from read_dz_variability
+
+    Returns
+    -------
+    data : pointCollection.data
+        thinned data
+    stats : dict
+        counts before and after thinning, and base block size, for each data type
+    '''
+    slope=data.slope_mag if 'slope_mag' in data.fields else None
+    dz_std=grid_lookup(data.x, data.y, dz_grid) if dz_grid is not None else None
+    region, importance = region_importance(data.x, data.y, xy0, Wxy, region_size,
+                                           slope_mag=slope, dz_std=dz_std)
+    laser=np.in1d(data.sensor, laser_sensors)
+    # laser data are grouped by sensor and day, DEMs by sensor
+    day=np.floor(data.time*365.25)
+    group=np.unique(np.c_[data.sensor, np.where(laser, day, 0)], axis=0, return_inverse=True)[1].ravel()
+    keep=np.zeros(data.size, dtype=bool)
+    stats={'importance_max':float(importance.max()), 'importance_min':float(importance.min())}
+    for key, these in [('laser', np.flatnonzero(laser)), ('DEM', np.flatnonzero(~laser))]:
+        stats['N_in_'+key]=int(these.size)
+        if N_target is None or N_target.get(key) is None or these.size==0:
+            keep[these]=True
+            continue
+        sub, L0 = adaptive_thin(data.x[these], data.y[these], data.z[these], group[these],
+                                N_target[key], region[these], importance,
+                                bm_scale[key], Wxy)
+        keep[these[sub]]=True
+        stats['N_out_'+key]=int(sub.size)
+        stats['L0_'+key]=float(L0)
+    data.index(keep)
+    return data, stats
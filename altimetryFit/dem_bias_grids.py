@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Size the bias grid of each DEM to the DEM's data coverage.
+
+Each DEM bias grid spans the whole tile, so a DEM that covers a small part
+of the tile adds as many unknowns as one that covers all of it.  Here, the
+grid spacing for each DEM is increased until the number of nodes in the
+tile is no more than the number of nodes that the DEM's data touch at the
+requested spacing, so the number of unknowns scales with the DEM's
+footprint.  DEMs whose data touch fewer than min_nodes nodes get no grid,
+leaving only their scalar (sensor) bias.
+
+The grids still span the tile, so a coarsened grid resolves only biases
+that vary over scales longer than its spacing: the resolution of a DEM's
+bias is traded for fewer unknowns.  The expected_rms values describe the
+size and slope of the bias itself, so they are kept unchanged for coarsened
+grids.
+"""
+
+import numpy as np
+
+def occupied_nodes(x, y, spacing, xy0, Wxy):
+    '''
+    Number of grid nodes (at the given spacing) that are corners of cells containing data
+    '''
+    col=np.floor((x-(xy0[0]-Wxy/2))/spacing).astype(int)
+    row=np.floor((y-(xy0[1]-Wxy/2))/spacing).astype(int)
+    cells=np.unique(np.c_[row, col], axis=0)
+    nodes=np.concatenate([cells+np.array(offset) for offset in [[0, 0], [0, 1], [1, 0], [1, 1]]])
+    return np.unique(nodes, axis=0).shape[0]
+
+def domain_nodes(spacing, Wxy):
+    return int(np.ceil(Wxy/spacing)+1)**2
+
+def count_DEM_bias_nodes(data, DEM_sensors, grid_bias_params, xy0, Wxy, min_nodes=None):
+    '''
+    Number of DEM bias-grid nodes in a fit, with the grids sized to the DEMs' coverage if min_nodes is given
+    '''
+    if min_nodes is None:
+        return len(DEM_sensors)*domain_nodes(grid_bias_params['spacing'], Wxy)
+    return size_DEM_bias_grids(data, DEM_sensors, grid_bias_params, xy0, Wxy, min_nodes=min_nodes)[1]['N_nodes']
+
+def size_DEM_bias_grids(data, DEM_sensors, grid_bias_params, xy0, Wxy, min_nodes=9):
+    '''
+    Make the sensor_grid_bias_params list for a set of DEMs, scaled to their coverage
+
+    Parameters
+    ----------
+    data : pointCollection.data
+        fit data
+    DEM_sensors : iterable
+        sensor numbers of the DEMs
+    grid_bias_params : dict
+        default parameters for the DEM bias grids (spacing, expected_rms, expected_rms_grad)
+    xy0, Wxy : list, float
+        tile center and width
+    min_nodes : int, optional
+        DEMs whose data touch fewer nodes than this get no grid.  The default is 9.
+
+    Returns
+    -------
+    sensor_grid_bias_params : list
+        one dict for each DEM that keeps a grid
+    stats : dict
+        numbers of DEMs with full, coarsened and no grids, and of grid nodes before and after
+    '''
+    spacing=grid_bias_params['spacing']
+    out=[]
+    stats={'N_full':0, 'N_coarsened':0, 'N_dropped':0, 'N_nodes_full':0, 'N_nodes':0}
+    for sensor in DEM_sensors:
+        these=data.sensor==sensor
+        stats['N_nodes_full'] += domain_nodes(spacing, Wxy)
+        N_occupied=occupied_nodes(data.x[these], data.y[these], spacing, xy0, Wxy) \
+            if np.any(these) else 0
+        if N_occupied < min_nodes:
+            stats['N_dropped'] += 1
+            continue
+        this_spacing=spacing
+        while domain_nodes(this_spacing, Wxy) > N_occupied and this_spacing < Wxy/2:
+            this_spacing *= 2
+        # don't coarsen so far that the DEM's data no longer span min_nodes nodes
+        while this_spacing > spacing and \
+            occupied_nodes(data.x[these], data.y[these], this_spacing, xy0, Wxy) < min_nodes:
+            this_spacing /= 2
+        if this_spacing > spacing:
+            stats['N_coarsened'] += 1
+        else:
+            stats['N_full'] += 1
+        out += [{'sensor':sensor, 'expected_val':0}]
+        out[-1].update(grid_bias_params)
+        out[-1]['spacing']=this_spacing
+        stats['N_nodes'] += domain_nodes(this_spacing, Wxy)
+    return out, stats
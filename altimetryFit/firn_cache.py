@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cached firn-model subsets for fit_altimetry.
+
+assign_firn_variable re-opens the firn-model files and extracts the
+surrounding space-time cube every time it is called.  Here the firn
+correction is evaluated once on a regular lattice covering a padded
+region, the resulting cube is stored as a memory-mappable .npy file, and
+data points are assigned values by trilinear interpolation from the cube.
+Tiles that fall in the same region (neighbors in a batch run, or reruns of
+the same tile) share the cube.
+"""
+
+import os
+import json
+import numpy as np
+import pointCollection as pc
+
+# firn cubes that have been opened by this process
+_cubes={}
+
+class firn_cube(object):
+    '''
+    Regular (y, x, t) cube of firn-correction values
+
+    Parameters
+    ----------
+    filename : str
+        name of the .npy file containing the cube.  The lattice geometry is
+        stored in a json file with the same base name.
+    '''
+    def __init__(self, filename):
+        self.filename=filename
+        with open(filename.replace('.npy','.json'),'r') as fh:
+            self.meta=json.load(fh)
+        for key in ['x0','y0','t0','spacing','dt']:
+            setattr(self, key, self.meta[key])
+        self.z=np.load(filename, mmap_mode='r')
+
+    def bounds(self):
+        ny, nx, nt = self.z.shape
+        return [self.x0, self.x0+(nx-1)*self.spacing], \
+            [self.y0, self.y0+(ny-1)*self.spacing], \
+            [self.t0, self.t0+(nt-1)*self.dt]
+
+    def interp(self, x, y, t):
+        '''
+        Trilinear interpolation of the cube.  Corners with NaN values (e.g.
+        outside the firn-model mask) are left out and the weights of the
+        others are renormalized.  Points outside the cube, or whose
+        corners are all NaN, are assigned NaN.
+        '''
+        result=np.zeros_like(x, dtype=np.float64)+np.nan
+        shape=self.z.shape
+        f=[(y-self.y0)/self.spacing, (x-self.x0)/self.spacing, (t-self.t0)/self.dt]
+        inside=np.ones(x.shape, dtype=bool)
+        for fi, ni in zip(f, shape):
+            inside &= np.isfinite(fi) & (fi >= 0) & (fi <= ni-1)
+        if not np.any(inside):
+            return result
+        i0=[]
+        w=[]
+        for fi, ni in zip(f, shape):
+            ii=np.minimum(np.floor(fi[inside]).astype(int), ni-2)
+            i0 += [ii]
+            w += [fi[inside]-ii]
+        temp=np.zeros(np.sum(inside))
+        w_sum=np.zeros(np.sum(inside))
+        for dy in [0, 1]:
+            for dx in [0, 1]:
+                for dt in [0, 1]:
+                    wt=(w[0] if dy else 1-w[0])*(w[1] if dx else 1-w[1])*(w[2] if dt else 1-w[2])
+                    zi=self.z[i0[0]+dy, i0[1]+dx, i0[2]+dt]
+                    good=np.isfinite(zi)
+                    temp[good] += wt[good]*zi[good]
+                    w_sum[good] += wt[good]
+        valid=w_sum > 0
+        temp[valid] /= w_sum[valid]
+        temp[~valid]=np.nan
+        result[inside]=temp
+        return result
+
+
+def cube_filename(cache_dir, firn_correction, model_version, hemisphere, region, t_range, spacing, dt):
+    return os.path.join(cache_dir, '%s_%s_H%d_E%d_N%d_%d-%d_%dm_%dd.npy' % \
+                        (firn_correction, model_version, hemisphere,
+                         region[0]/1000, region[1]/1000, t_range[0], t_range[1],
+                         spacing, np.round(dt*365.25)))
+
+def make_firn_cube(filename, region, region_size, pad, t_range, spacing, dt,
+                   firn_correction, firn_directory, hemisphere, model_version):
+    '''
+    Evaluate the firn model on a lattice covering a padded region and save
+    the result as a .npy file with a json description of the lattice.
+    '''
+    from SMBcorr import assign_firn_variable
+    x=np.arange(region[0]-pad, region[0]+region_size+pad+spacing/2, spacing)
+    y=np.arange(region[1]-pad, region[1]+region_size+pad+spacing/2, spacing)
+    t=np.arange(t_range[0], t_range[1]+dt/2, dt)
+    print(f"firn_cache: extracting {firn_correction} on a {y.size}x{x.size}x{t.size} lattice")
+    yg, xg, tg = np.meshgrid(y, x, t, indexing='ij')
+    lattice=pc.data().from_dict({'x':xg.ravel(), 'y':yg.ravel(), 'time':tg.ravel()})
+    assign_firn_variable(lattice, firn_correction, firn_directory, hemisphere,
+                         model_version=model_version, subset_valid=False)
+    cube=np.reshape(lattice.h_firn, xg.shape).astype(np.float32)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # write to temporary files, then move them into place so that
+    # other workers never see a partial cube
+    temp_file=filename.replace('.npy', '.%d.tmp.npy' % os.getpid())
+    np.save(temp_file, cube)
+    with open(temp_file.replace('.npy','.json'),'w') as fh:
+        json.dump({'x0':float(x[0]), 'y0':float(y[0]), 't0':float(t[0]),
+                   'spacing':float(spacing), 'dt':float(dt),
+                   'firn_correction':firn_correction, 'model_version':str(model_version),
+                   'hemisphere':int(hemisphere)}, fh, indent=4)
+    os.replace(temp_file.replace('.npy','.json'), filename.replace('.npy','.json'))
+    os.replace(temp_file, filename)
+
+def assign_firn_variable_cached(data, firn_correction, firn_directory, hemisphere,
+                                model_version=None, cache_dir=None, t_span=None,
+                                region_size=1.e5, pad=5.e4, spacing=5000., dt=5/365.25,
+                                subset_valid=False):
+    '''
+    Assign the 'h_firn' field to a data structure using a cached firn cube.
+
+    Parameters
+    ----------
+    data : pc.data
+        data structure, must contain x, y, and time fields
+    firn_correction, firn_directory, hemisphere, model_version :
+        firn-model specification, as for SMBcorr.assign_firn_variable
+    cache_dir : str
+        directory in which firn cubes are stored
+    t_span : iterable, optional
+        time range of the cube, rounded out to whole years.  The default is
+        the time range of the data
+    region_size : float, optional
+        size of the regions that share a cube (m). The default is 1.e5.
+    pad : float, optional
+        padding around each region (m). The default is 5.e4.
+    spacing : float, optional
+        horizontal lattice spacing (m). The default is 5000.
+    dt : float, optional
+        lattice time spacing (years). The default is 5 days.
+    subset_valid : bool, optional
+        If true, data without a valid firn value are removed. The default is False.
+
+    Returns
+    -------
+    None.
+    '''
+    if t_span is None:
+        t_span=[np.nanmin(data.time), np.nanmax(data.time)]
+    t_range=[int(np.floor(t_span[0])), int(np.ceil(t_span[1]))]
+    xy_ctr=[np.nanmean(data.x), np.nanmean(data.y)]
+    region=[np.floor(ii/region_size)*region_size for ii in xy_ctr]
+    filename=cube_filename(cache_dir, firn_correction, model_version, hemisphere,
+                           region, t_range, spacing, dt)
+    if filename not in _cubes:
+        if not os.path.isfile(filename):
+            make_firn_cube(filename, region, region_size, pad, t_range, spacing, dt,
+                           firn_correction, firn_directory, hemisphere, model_version)
+        _cubes[filename]=firn_cube(filename)
+    h_firn=_cubes[filename].interp(data.x, data.y, data.time)
+
+    # points outside the cube get values directly from the model
+    XR, YR, TR = _cubes[filename].bounds()
+    outside=np.flatnonzero((data.x < XR[0]) | (data.x > XR[1]) |
+                           (data.y < YR[0]) | (data.y > YR[1]) |
+                           (data.time < TR[0]) | (data.time > TR[1]))
+    if outside.size > 0:
+        print(f"firn_cache: {outside.size} points outside the cached cube")
+        from SMBcorr import assign_firn_variable
+        D_out=pc.data().from_dict({'x':data.x[outside], 'y':data.y[outside],
+                                   'time':data.time[outside]})
+        assign_firn_variable(D_out, firn_correction, firn_directory, hemisphere,
+                             model_version=model_version, subset_valid=False)
+        h_firn[outside]=D_out.h_firn
+    data.assign({'h_firn':h_firn})
+    if subset_valid:
+        data.index(np.isfinite(data.h_firn))
@@ -7,11 +7,12 @@ Created on Tue Feb 26 17:12:48 2019
 """
 
 import os
-# make sure we're only using one thread
-os.environ['MKL_NUM_THREADS']="1"
-os.environ['NUMEXPR_NUM_THREADS']="1"
-os.environ['OMP_NUM_THREADS']="1"
-os.environ['OPENBLAS_NUM_THREADS']="1"
+import sys
+# set the BLAS/OpenMP thread budget before numpy is imported.  The default
+# is one thread; see --threads, --workers and ALTIMETRYFIT_NUM_THREADS
+from altimetryFit.thread_budget import resolve_threads, set_thread_env, set_thread_limits, \
+    import_thread_budget
+set_thread_env(import_thread_budget(argv=sys.argv))
 
 
 import numpy as np
@@ -27,7 +28,6 @@ import pointCollection as pc
 from datetime import datetime, timedelta
 import warnings
 import h5py
-import sys
 import glob
 import re
 
@@ -560,9 +560,21 @@ def main(argv):
     parser.add_argument('--calc_error_for_xy', action='store_true')
     parser.add_argument('--avg_scales', type=str, help='scales at which to report average errors, comma-separated list, no spaces')
     parser.add_argument('--error_res_scale','-s', type=float, nargs=2, default=[4, 2], help='if the errors are being calculated (see calc_error_file), scale the grid resolution in x and y to be coarser')
+    parser.add_argument('--threads', type=str, help="number of BLAS/OpenMP threads for the fit, or 'auto' to divide the node's cores among --workers.  The default is ALTIMETRYFIT_NUM_THREADS, or 1")
+    parser.add_argument('--workers', type=int, help='number of concurrent workers on the node, used with --threads auto.  The default is ALTIMETRYFIT_WORKERS, or 1')
     args, unk=parser.parse_known_args()
     print("unknown arguments:"+str(unk))
 
+    try:
+        n_threads, thread_mode = resolve_threads(args.threads, args.workers)
+    except ValueError:
+        parser.error("--threads must be an integer or 'auto', and --workers and the ALTIMETRYFIT_NUM_THREADS and ALTIMETRYFIT_WORKERS variables must be integers")
+    n_active=set_thread_limits(n_threads)
+    if n_active != n_threads:
+        print(f"WARNING: could not set the thread limits to {n_threads} after numpy was imported "
+              f"(threadpoolctl is not installed); {n_active if n_active is not None else 'an unknown number of'} threads are in effect")
+    print(f"using {n_active} threads ({thread_mode})")
+
     if args.avg_scales is not None:
         args.avg_scales = [np.int(temp) for temp in args.avg_scales.split(',')]
     args.grid_spacing = [np.float(temp) for temp in args.grid_spacing.split(',')]
@@ -676,6 +688,9 @@ def main(argv):
             avg_scales=args.avg_scales,\
             DEM_grid_bias_params=DEM_bias_params)
 
+    # threads is -1 if the number in effect is not known
+    S.setdefault('timing', {}).update({'threads':n_active if n_active is not None else -1,
+                                      'threads_requested':n_threads, 'thread_mode':thread_mode})
     if args.calc_error_file is None:
         save_fit_to_file(S, args.out_name, sensor_dict=sensor_dict,\
                          dzdt_lags=S['dzdt_lags'], \
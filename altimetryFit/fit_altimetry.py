@@ -14,11 +14,12 @@ April 2023: SmithB merged lagrangian code into fit_altimetry.py
 
 import resource
 import os
-# make sure we're only using one thread
-os.environ['MKL_NUM_THREADS']="1"
-os.environ['NUMEXPR_NUM_THREADS']="1"
-os.environ['OMP_NUM_THREADS']="1"
-os.environ['OPENBLAS_NUM_THREADS']="1"
+import sys
+# set the BLAS/OpenMP thread budget before numpy is imported.  The default
+# is one thread; see --threads, --workers and ALTIMETRYFIT_NUM_THREADS
+from altimetryFit.thread_budget import resolve_threads, set_thread_env, set_thread_limits, \
+    import_thread_budget
+set_thread_env(import_thread_budget(argv=sys.argv))
 
 
 #import warnings
@@ -30,17 +31,30 @@ from LSsurf.smooth_xytb_fit_aug import smooth_xytb_fit_aug
 from LSsurf import fd_grid
 from altimetryFit.reread_data_from_fits import reread_data_from_fits
 import pointCollection as pc
-from pyTMD import compute_tide_corrections
-from SMBcorr import assign_firn_variable
-from altimetryFit.read_optical import read_optical_data, laser_key
-from CS2_fit.read_CS2_data import read_CS2_data
-import pointAdvection
+from altimetryFit.read_optical import read_optical_data, laser_key, find_gI_files
+from altimetryFit.firn_cache import assign_firn_variable_cached
+from altimetryFit.lagrangian_tools import advect_grid, fast_lagrangian_positions, displacement_cache_file, \
+    read_displacement_cache, write_displacement_cache, read_NSIDC_velocity, read_NSIDC_velocity_window, \
+    velocity_cache_file, read_velocity_cache, write_velocity_cache
+from altimetryFit.year_mask_cube import year_mask_values
+from altimetryFit.fit_output import fit_output_writer, decode_categorical
+from altimetryFit.memory_planner import plan_for_data
+from altimetryFit.fit_stages import fit_stages, file_id
+from altimetryFit.stage_timer import stage_timer, timed
+from altimetryFit.warm_start import apply_prelim_edits, apply_edits, data_edits
+from altimetryFit.adaptive_thinning import thin_data, read_dz_variability
+from altimetryFit.dem_bias_grids import size_DEM_bias_grids, count_DEM_bias_nodes, domain_nodes
+from altimetryFit.run_database import run_database, plan_for_time, fit_size
+from altimetryFit.tide_cache import tide_cache
+from altimetryFit.tide_predictor import get_tide_predictor, predict_tides_on_lattice
 import h5py
-import sys
 import glob
 import json
 import re
-import xarray as xr
+import gc
+import time
+import shlex
+import traceback
 
 def set_memory_limit(max_bytes):
     '''
@@ -95,7 +109,8 @@ def custom_edits(data):
     bad=np.abs(data.time - 2003.7821) < 0.1/24/365.25
     data.index(bad==0)
 
-def apply_tides(D, xy0, W, tide_mask_file, tide_directory, tide_model, EPSG=3031):
+def apply_tides(D, xy0, W, tide_mask_file, tide_directory, tide_model, EPSG=3031,
+                tide_cache_dir=None, lattice_spacing=None, lattice_tol=0.01):
     #read in the tide mask (for Antarctica) and apply dac and tide to ice-shelf elements
     # the tide mask should be 1 for non-grounded points (ice shelves?), zero otherwise
     tide_mask = pc.grid.data().from_geotif(tide_mask_file, bounds=[np.array([-0.6, 0.6])*W+xy0[0], np.array([-0.6, 0.6])*W+xy0[1]])
@@ -107,18 +122,39 @@ def apply_tides(D, xy0, W, tide_mask_file, tide_directory, tide_model, EPSG=3031
         # Old version read:  (D.time-(2018+0.5/365.25))*24*3600*365.25
         # updates have made time values equivalent to years- Y2K +2000,
         # consistent between IS1 and IS2 (2/18/2022)
-        D.tide_ocean = compute_tide_corrections(\
-                D.x, D.y, (D.time-2000)*24*3600*365.25,
-                DIRECTORY=tide_directory, MODEL=tide_model,
-                EPOCH=(2000,1,1,0,0,0), TYPE='drift', TIME='utc', EPSG=EPSG)
-    D.tide_ocean[is_els==0] = 0
+        # only evaluate the tide model for the shelf points
+        els=np.flatnonzero(is_els)
+        # the predictor keeps the model constituents in memory between calls
+        predict=get_tide_predictor(tide_directory, tide_model, EPSG=EPSG).predict
+        if tide_cache_dir is not None:
+            cache=tide_cache(tide_cache_dir, tide_model, EPSG=EPSG)
+            predict_model=predict
+            def predict(x, y, delta_time):
+                return cache.predict(x, y, delta_time, predict_model)
+        delta_time=(D.time[els]-2000)*24*3600*365.25
+        if lattice_spacing is None:
+            tide=predict(D.x[els], D.y[els], delta_time)
+        else:
+            tide, stats = predict_tides_on_lattice(D.x[els], D.y[els], delta_time, predict,
+                                                   spacing=lattice_spacing, tol=lattice_tol)
+            print(f"\t\ttide lattice: {stats['N_nodes']} nodes, {stats['N_exact']} exact evaluations for {stats['N_points']} points, "
+                  f"RMS error={stats['RMS_error']:0.4f}, max error={stats['max_error']:0.4f}")
+        if tide_cache_dir is not None:
+            print(f"\t\ttide cache: {cache.N_hits} hits, {cache.N_misses} misses")
+        D.tide_ocean[els] = np.ma.filled(tide, np.nan)
     #D.dac[is_els==0] = 0
     D.tide_ocean[~np.isfinite(D.tide_ocean)] = 0
     #D.dac[~np.isfinite(D.dac)] = 0
     D.z -= D.tide_ocean
     return D
 
-def mask_data_by_year(data, mask_dir):
+def mask_data_by_year(data, mask_dir, cube_file=None):
+    # look up the masks in the compiled, bit-packed mask cube (see make_year_mask_cube.py)
+    temp=year_mask_values(mask_dir, data.x, data.y, data.time, cube_file=cube_file)
+    if temp is not None:
+        data.index(~((temp<0.5) & np.isfinite(temp)))
+        return
+    # if there is no current cube, read the masks one year at a time
     masks={}
     year_re=re.compile('(\d\d\d\d.+\d+).tif')
     for file in glob.glob(mask_dir+'/*.tif'):
@@ -138,8 +174,11 @@ def mask_data_by_year(data, mask_dir):
     data.index(good)
 
 def setup_lagrangian(velocity_files=None, lagrangian_epoch=None,
-    SRS_proj4=None, xy0=None, Wxy=None, t_span=None, spacing=None, **kwargs):
+    SRS_proj4=None, xy0=None, Wxy=None, t_span=None, spacing=None,
+    lagrangian_cache_dir=None, lagrangian_workers=1, velocity_region_size=None, **kwargs):
 
+    if isinstance(velocity_files, str):
+        velocity_files=[velocity_files]
     # verbose output of lagrangian parameters
     print(f'Velocity File(s): {",".join(velocity_files)}')
     print(f'Advect parcels to {lagrangian_epoch:0.1f}')
@@ -150,92 +189,99 @@ def setup_lagrangian(velocity_files=None, lagrangian_epoch=None,
     t = fd_grid([t_span], [spacing['dt']], name='t')
     gridx,gridy = np.meshgrid(x.ctrs[0], y.ctrs[0])
     # create advection object with buffer around grid
+    import pointAdvection
     adv = pointAdvection.advection(
         x=gridx.flatten(),
         y=gridy.flatten(),
         t=np.zeros((x.N_nodes*y.N_nodes))
     )
-    # read velocity image and trim to a buffer extent around points
-    # use a wide buffer to encapsulate advections in fast moving areas
-    if isinstance(velocity_files, str):
-        velocity_files=[velocity_files]
-    if len(velocity_files) == 1:
-        if 'NSIDC' in os.path.basename(velocity_files[0]):
-            with xr.open_dataset(velocity_files[0]) as ds:
-                adv.from_dict({'x':np.array(ds.x),
-                               'y':np.array(ds.y)[::-1],
-                               'U':np.array(ds.VelocitySeries[:, 0, ::-1,:]),
-                               'V':np.array(ds.VelocitySeries[:, 1, ::-1,:]),
-                               'eU':np.array(ds.VelocitySeries[:, 3, ::-1,:]),
-                               'eV':np.array(ds.VelocitySeries[:, 4, ::-1,:]),
-                               'time':np.array(ds.time.data-
-                                               np.datetime64('2000-01-01'),
-                                               dtype='timedelta64[s]')\
-                                         .astype(float)/24./3600./365.25 + 2000
-                               }, t_axis=0)
-                #buffer=Wxy
-                #buffer=np.max(np.sqrt(adv.velocity.U**2+adv.velocity.V**2)*24/3600*365.25)\
-                #    *np.max(np.abs(delta_time))*2
-                #adv.velocity.crop(xy0[0]+np.array([-1, 1])*(Wxy+buffer), xy0[1]+np.array([-1, 1])*(Wxy+buffer))
+    # gap-filled velocity windows are cached for each region
+    velocity_file=None
+    if lagrangian_cache_dir is not None:
+        velocity_file=velocity_cache_file(lagrangian_cache_dir, velocity_files, xy0, Wxy,
+                                          t_span, lagrangian_epoch, region_size=velocity_region_size)
+    if velocity_file is not None and os.path.isfile(velocity_file):
+        print(f'Reading gap-filled velocities from {velocity_file}')
+        adv.velocity, lagrangian_interpolation = read_velocity_cache(velocity_file)
+    else:
+        # read velocity image and trim to a buffer extent around points
+        # use a wide buffer to encapsulate advections in fast moving areas
+        if len(velocity_files) == 1:
+            if 'NSIDC' in os.path.basename(velocity_files[0]):
+                # read only the window implied by the maximum speed and the time span
+                velocity, _ = read_NSIDC_velocity_window(velocity_files[0], xy0, Wxy,
+                        t_span, lagrangian_epoch, region_size=velocity_region_size)
+                if velocity is None:
+                    # the window is outside the velocity grid: read the whole file
+                    velocity=read_NSIDC_velocity(velocity_files[0])
+                adv.from_dict(velocity, t_axis=0)
                 lagrangian_interpolation = 'linear'
+            else:
+                adv.from_nc(velocity_files[0], buffer=Wxy)
+                lagrangian_interpolation = 'spline'
         else:
-            adv.from_nc(velocity_files[0], buffer=Wxy)
-            lagrangian_interpolation = 'spline'
-    else:
-        vlist = [pc.grid.data().from_nc(v,field_mapping=dict(U='VX', V='VY')) \
-            for v in velocity_files]
-        adv.from_list(vlist, buffer=Wxy)
-        lagrangian_interpolation = 'linear'
+            vlist = [pc.grid.data().from_nc(v,field_mapping=dict(U='VX', V='VY')) \
+                for v in velocity_files]
+            adv.from_list(vlist, buffer=Wxy)
+            lagrangian_interpolation = 'linear'
 
-    # convert velocity times to delta times from epoch
-    adv.velocity.time = (adv.velocity.time - lagrangian_epoch)*24*3600*365.25
-    adv.fill_velocity_gaps()
+        # convert velocity times to delta times from epoch
+        adv.velocity.time = (adv.velocity.time - lagrangian_epoch)*24*3600*365.25
+        adv.fill_velocity_gaps()
+        if velocity_file is not None:
+            write_velocity_cache(velocity_file, adv.velocity, lagrangian_interpolation)
 
     # advect coordinates to each output time
     # calculate as displacements from original grid coordinates
-    dx = np.zeros((y.N_nodes, x.N_nodes, t.N_nodes))
-    dy = np.zeros((y.N_nodes, x.N_nodes, t.N_nodes))
-    # calculate bounds of original and advected coordinates
-    bounds = np.array([x.bds[0], y.bds[0]])
-    for i,ctrs in enumerate(t.ctrs[0]):
-        # advect points to output grid time
-        t0 = (ctrs - lagrangian_epoch)*24*3600*365.25
-        adv.translate_parcel(integrator='RK4', method=lagrangian_interpolation, t0=t0)
-        # reshape to output grid dimensions and
-        # calculate displacements from original coordinates
-        dx[:,:,i] = np.reshape(adv.x0, (y.N_nodes, x.N_nodes)) - gridx
-        dy[:,:,i] = np.reshape(adv.y0, (y.N_nodes, x.N_nodes)) - gridy
-        # update bounds
-        bounds[0][0] = np.min([bounds[0][0], np.nanmin(adv.x0)])
-        bounds[0][1] = np.max([bounds[0][1], np.nanmax(adv.x0)])
-        bounds[1][0] = np.min([bounds[1][0], np.nanmin(adv.y0)])
-        bounds[1][1] = np.max([bounds[1][1], np.nanmax(adv.y0)])
-        # update coordinates to advect to next field
-        # without recomputing advection from original point
-        adv.x[:] = np.copy(adv.x0)
-        adv.y[:] = np.copy(adv.y0)
-        adv.t[:] = np.copy(t0)
+    # the displacements depend only on the tile, the grid, the velocities, and the epoch,
+    # so they can be reused from a cache
+    cache_file=None
+    if lagrangian_cache_dir is not None:
+        cache_file=displacement_cache_file(lagrangian_cache_dir, xy0=xy0, Wxy=Wxy,
+            spacing=spacing, t_span=t_span, velocity_files=velocity_files,
+            lagrangian_epoch=lagrangian_epoch)
+    if cache_file is not None and os.path.isfile(cache_file):
+        print(f'Reading displacements from {cache_file}')
+        dx, dy, bounds = read_displacement_cache(cache_file)
+    else:
+        # advect the grid nodes, and calculate bounds of original and advected coordinates
+        dx, dy, bounds = advect_grid(adv, gridx, gridy, t.ctrs[0], lagrangian_epoch,
+                                     lagrangian_interpolation,
+                                     np.array([x.bds[0], y.bds[0]]),
+                                     workers=lagrangian_workers)
+        if cache_file is not None:
+            write_displacement_cache(cache_file, dx, dy, bounds)
 
     out_args=kwargs
     out_args.update({'advection_obj':adv,
-            'method':lagrangian_interpolation,
+            'lagrangian_interpolation':lagrangian_interpolation,
             'SRS_proj4':SRS_proj4,
             'xy0':xy0,
             'Wxy':Wxy,
             'dx':dx,
             'dy':dy,
+            'grid_x':x.ctrs[0],
+            'grid_y':y.ctrs[0],
+            'grid_t':t.ctrs[0],
+            'lagrangian_epoch':lagrangian_epoch,
             'bds':bounds})
     return out_args
 
-def update_data_for_lagrangian(data, lagrangian_ref_dem=None, **kwargs):
+def update_data_for_lagrangian(data, lagrangian_ref_dem=None, lagrangian_fast=False,
+                               lagrangian_fast_tol=5., lagrangian_fast_check=1000, **kwargs):
+    import pointAdvection
     # default keyword arguments
     kwargs.setdefault('advection_obj', pointAdvection.advection())
     kwargs.setdefault('lagrangian_interpolation', 'linear')
-    kwargs.setdefault('lagrangian_epoch', 0)
     kwargs.setdefault('SRS_proj4', None)
     kwargs.setdefault('xy0', [None,None])
     kwargs.setdefault('Wxy', 0)
 
+    # the epoch comes from setup_lagrangian: a default would silently take
+    # the data times relative to year zero
+    if 'lagrangian_epoch' not in kwargs:
+        raise ValueError('update_data_for_lagrangian needs the lagrangian_epoch returned by setup_lagrangian')
+
     # get latitude and longitude of the original data
     data.get_latlon(proj4_string=kwargs['SRS_proj4'])
 
@@ -246,22 +292,50 @@ def update_data_for_lagrangian(data, lagrangian_ref_dem=None, **kwargs):
             bounds=data.bounds()).interp(data.x, data.y)
         data.index(np.isfinite(data.z))
 
+    x_new=np.zeros_like(data.x)+np.nan
+    y_new=np.zeros_like(data.y)+np.nan
+    if lagrangian_fast and 'dx' in kwargs:
+        # interpolate the epoch positions from the grid displacements, and
+        # advect exactly only the points for which this is inaccurate
+        x_new, y_new, exact = fast_lagrangian_positions(data.x, data.y, data.time,
+            dx=kwargs['dx'], dy=kwargs['dy'], grid_x=kwargs['grid_x'],
+            grid_y=kwargs['grid_y'], grid_t=kwargs['grid_t'], tol=lagrangian_fast_tol)
+        # check a random subset of the remaining points against exact advection
+        check=np.flatnonzero(~exact)
+        check=np.random.default_rng(0).choice(check, size=np.minimum(lagrangian_fast_check, check.size), replace=False)
+        x_fast, y_fast = x_new[check], y_new[check]
+        exact[check]=True
+        exact=np.flatnonzero(exact)
+    else:
+        check=np.zeros(0, dtype=int)
+        exact=np.arange(data.size)
+
     # update advection object with original coordinates and times
     adv = kwargs['advection_obj']
-    adv.x = data.x.copy()
-    adv.y = data.y.copy()
+    adv.x = data.x[exact].copy()
+    adv.y = data.y[exact].copy()
     # calculate the number of seconds between data times and epoch
-    adv.t = (data.time - kwargs['lagrangian_epoch'])*24*3600*365.25
+    adv.t = (data.time[exact] - kwargs['lagrangian_epoch'])*24*3600*365.25
 
     # advect points to delta time 0
-    adv.translate_parcel(integrator='RK4', method=kwargs['lagrangian_interpolation'], t0=0)
+    if exact.size > 0:
+        adv.translate_parcel(integrator='RK4', method=kwargs['lagrangian_interpolation'], t0=0)
+        x_new[exact]=adv.x0
+        y_new[exact]=adv.y0
+    if lagrangian_fast and 'dx' in kwargs:
+        print(f'Fast Lagrangian positions: {data.size-exact.size+check.size} interpolated, {exact.size-check.size} advected exactly')
+        if check.size > 0:
+            err=np.sqrt((x_fast-x_new[check])**2+(y_fast-y_new[check])**2)
+            print('Interpolated-position error for {0} check points: RMS {1:0.2f} max {2:0.2f}'.format(
+                check.size, np.sqrt(np.nanmean(err**2)), np.nanmax(err)))
     # verbose output of displacement range
-    mindist,maxdist = np.nanmin(adv.distance), np.nanmax(adv.distance)
+    distance=np.sqrt((x_new-data.x)**2+(y_new-data.y)**2)
+    mindist,maxdist = np.nanmin(distance), np.nanmax(distance)
     print('Min/Max Displacement: {0:0.1f} {1:0.1f}'.format(mindist,maxdist))
     # save the original coordinates:
     data.assign(x_original=data.x.copy(), y_original=data.y.copy())
     # replace x and y with the advected coordinates
-    data.x=np.copy(adv.x0); data.y=np.copy(adv.y0)
+    data.x=x_new; data.y=y_new
 
     # reindex to coordinates that are within the domain after advection
     domain_mask = (np.abs(data.x-kwargs['xy0'][0]) <= kwargs['Wxy']/2) & \
@@ -288,60 +362,107 @@ def update_output_grids_for_lagrangian(S, **kwargs):
     S['m']['dz'].assign(dx=kwargs['dx'], dy=kwargs['dy'])
 
 def interp_ds(ds, scale):
+    '''
+    Resample every field of a grid onto a grid refined by 'scale'.
+
+    The bilinear weights are calculated once for the target grid and are
+    applied to all fields and epochs.  Output fields have dimensions
+    (y, x) or (y, x, time).
+    '''
+    delta_xy=[(ds.x[1]-ds.x[0])/scale, (ds.y[1]-ds.y[0])/scale]
+    xi=np.arange(ds.x[0], ds.x[-1]+delta_xy[0], delta_xy[0])
+    yi=np.arange(ds.y[0], ds.y[-1]+delta_xy[1], delta_xy[1])
+
+    def bilinear_weights(c, ci):
+        f=(ci-c[0])/(c[1]-c[0])
+        # allow for roundoff in the target coordinates
+        valid=(f > -1.e-6) & (f < c.size-1+1.e-6)
+        f=np.clip(f, 0, c.size-1)
+        i0=np.minimum(np.floor(f).astype(int), c.size-2)
+        return i0, f-i0, valid
+    ix, wx, valid_x = bilinear_weights(ds.x, xi)
+    iy, wy, valid_y = bilinear_weights(ds.y, yi)
+    corners=[(iy, ix, (1-wy)[:,None]*(1-wx)[None,:]),
+             (iy, ix+1, (1-wy)[:,None]*wx[None,:]),
+             (iy+1, ix, wy[:,None]*(1-wx)[None,:]),
+             (iy+1, ix+1, wy[:,None]*wx[None,:])]
+
+    out={'x':xi, 'y':yi}
+    if len(ds.shape) > 2:
+        out['time']=ds.time
     for field in ds.fields:
-        delta_xy=[(ds.x[1]-ds.x[0])/scale, (ds.y[1]-ds.y[0])/scale]
-        xi=np.arange(ds.x[0], ds.x[-1]+delta_xy[0], delta_xy[0])
-        yi=np.arange(ds.y[0], ds.y[-1]+delta_xy[1], delta_xy[1])
         z0=getattr(ds, field)
-        if len(ds.shape)==2:
-            zi=pc.grid.data().from_dict({'x':ds.x, 'y':ds.y, 'z':z0}).interp(xi, yi, gridded=True)
-            return pc.grid.data().from_dict({'x':xi, 'y':yi, field:zi})
-        else:
-            zi=np.zeros([xi.size, yi.size, ds.time.size])
-            for epoch in range(ds.time.size):
-                temp=pc.grid.data().from_dict({'x':ds.x, 'y':ds.y, 'z':np.squeeze(z0[:,:,epoch])})
-                zi[:,:,epoch] = temp.interp(xi, yi, gridded=True)
-            return pc.grid.data().from_dict({'x':xi, 'y':yi, 'time':ds.time, field:zi})
-
-def save_fit_to_file(S,  filename, sensor_dict=None, dzdt_lags=None, reference_epoch=0):
+        # treat all dimensions after y and x as one batch dimension
+        z0=z0.reshape(z0.shape[0], z0.shape[1], -1)
+        zi=np.zeros((yi.size, xi.size, z0.shape[2]))
+        for rows, cols, w in corners:
+            zi += w[:,:,None]*z0[rows[:,None], cols[None,:], :]
+        zi[~valid_y,:,:]=np.nan
+        zi[:,~valid_x,:]=np.nan
+        out[field]=zi.reshape((yi.size, xi.size)+getattr(ds, field).shape[2:])
+    return pc.grid.data().from_dict(out)
+
+def save_fit_to_file(S,  filename, sensor_dict=None, dzdt_lags=None, reference_epoch=0,
+                     output_profile='default'):
     if os.path.isfile(filename):
         os.remove(filename)
-    with h5py.File(filename,'w') as h5f:
-        h5f.create_group('/data')
-        for key in S['data'].fields:
-            h5f.create_dataset('/data/'+key, data=getattr(S['data'], key))
-        h5f.create_group('/meta')
-        h5f.create_group('/meta/timing')
-        for key in S['timing']:
-            h5f['/meta/timing/'].attrs[key]=S['timing'][key]
-        h5f.create_group('/RMS')
-        for key in S['RMS']:
-            h5f.create_dataset('/RMS/'+key, data=S['RMS'][key])
-        h5f.create_group('E_RMS')
-        for key in S['E_RMS']:
-            h5f.create_dataset('E_RMS/'+key, data=S['E_RMS'][key])
-        for key in S['m']['bias']:
-            h5f.create_dataset('/bias/'+key, data=S['m']['bias'][key])
-        if 'slope_bias' in S['m']:
-            sensors=np.array(list(S['m']['slope_bias'].keys()))
-            h5f.create_dataset('/slope_bias/sensors', data=sensors)
-            x_slope=[S['m']['slope_bias'][key]['slope_x'] for key in sensors]
-            y_slope=[S['m']['slope_bias'][key]['slope_y'] for key in sensors]
-            h5f.create_dataset('/slope_bias/x_slope', data=np.array(x_slope))
-            h5f.create_dataset('/slope_bias/y_slope', data=np.array(y_slope))
-        if sensor_dict is not None:
-            h5f.create_group('meta/sensors')
-            for key in sensor_dict:
-                h5f['/meta/sensors'].attrs['sensor_%d' % key]=sensor_dict[key]
-        if 'sensor_bias_grids' in S['m'] and 'grid_bias' not in h5f:
-            h5f.create_group('/grid_bias')
-    if 'sensor_bias_grids' in S['m']:
-        for name, ds in S['m']['sensor_bias_grids'].items():
-                ds.to_h5(filename, group='/grid_bias/'+name)
-
-    for key , ds in S['m'].items():
-        if isinstance(ds, pc.grid.data):
-                ds.to_h5(filename, group=key)
+    timer=S.get('stage_timer', None)
+    with fit_output_writer(filename, mode='w', profile=output_profile) as out:
+        with timed(timer, 'save'):
+            h5f=out.h5f
+            h5f.create_group('/data')
+            for key in S['data'].fields:
+                out.write_data_field('/data/'+key, getattr(S['data'], key))
+            h5f.create_group('/meta')
+            h5f.create_group('/meta/timing')
+            for key in S['timing']:
+                h5f['/meta/timing/'].attrs[key]=S['timing'][key]
+            h5f.create_group('/RMS')
+            for key in S['RMS']:
+                h5f.create_dataset('/RMS/'+key, data=S['RMS'][key])
+            h5f.create_group('E_RMS')
+            for key in S['E_RMS']:
+                h5f.create_dataset('E_RMS/'+key, data=S['E_RMS'][key])
+            for key in S['m']['bias']:
+                h5f.create_dataset('/bias/'+key, data=S['m']['bias'][key])
+            if 'slope_bias' in S['m']:
+                sensors=np.array(list(S['m']['slope_bias'].keys()))
+                h5f.create_dataset('/slope_bias/sensors', data=sensors)
+                x_slope=[S['m']['slope_bias'][key]['slope_x'] for key in sensors]
+                y_slope=[S['m']['slope_bias'][key]['slope_y'] for key in sensors]
+                h5f.create_dataset('/slope_bias/x_slope', data=np.array(x_slope))
+                h5f.create_dataset('/slope_bias/y_slope', data=np.array(y_slope))
+            for group in ['memory_plan', 'warm_start', 'coarse_edit', 'thinning', 'DEM_grid_bias',
+                          'time_corr_groups', 'time_plan']:
+                if group not in S:
+                    continue
+                h5f.create_group('/meta/'+group)
+                for key, val in S[group].items():
+                    if isinstance(val, dict):
+                        for sub_key, sub_val in val.items():
+                            h5f['/meta/'+group].attrs[key+'_'+sub_key]=sub_val
+                    else:
+                        h5f['/meta/'+group].attrs[key]=val
+            if 'stages' in S:
+                # whether each data-preparation stage was run, read from the cache, or disabled
+                h5f.create_group('/meta/stages')
+                for name, status in S['stages']:
+                    h5f['/meta/stages'].attrs[name]=status
+            if sensor_dict is not None:
+                h5f.create_group('meta/sensors')
+                for key in sensor_dict:
+                    h5f['/meta/sensors'].attrs['sensor_%d' % key]=sensor_dict[key]
+            if 'sensor_bias_grids' in S['m']:
+                h5f.require_group('/grid_bias')
+                for name, ds in S['m']['sensor_bias_grids'].items():
+                    out.write_grid(ds, '/grid_bias/'+name)
+
+            for key , ds in S['m'].items():
+                if isinstance(ds, pc.grid.data):
+                    out.write_grid(ds, key)
+        if timer is not None:
+            # written after the save stage has finished, so that it is included
+            timer.write_h5(h5f['/meta/timing'])
     return
 
 def assign_sigma_corr(D, orbital_sensors=[1, 2], airborne_sensors=[3, 4, 5]):
@@ -353,36 +474,102 @@ def assign_sigma_corr(D, orbital_sensors=[1, 2], airborne_sensors=[3, 4, 5]):
     these=np.flatnonzero(np.in1d(D.sensor, airborne_sensors))
     time_corr[these]=np.floor(D.time[these]/delta_t_corr['airborne'])*delta_t_corr['airborne']
     D.assign({'time_corr':time_corr})
-    _, sensor_dict=pc.unique_by_rows(np.c_[D.sensor, D.time_corr], return_dict=True)
-    for key, ind in sensor_dict.items():
-        #skip DEMs
-        if key[0] > np.max(orbital_sensors+airborne_sensors):
-            continue
-        if np.any(np.isfinite(D.slope_mag[ind])):
-            mean_slope=np.nanmean(D.slope_mag[ind])
-        else:
-            mean_slope=0
-        D.sigma_corr[ind] = np.sqrt(D.sigma_corr[ind]**2 +
-                                    (mean_slope*5)**2)
-
-def save_errors_to_file( S, filename):
-
-    for key, ds in S['E'].items():
-        if isinstance(ds, pc.grid.data):
-            print(key)
-            if 'sensor_' in key and 'bias' in key:
-                #write the sensor grid biases into their own group
-                ds.to_h5(filename, group='/grid_bias/'+key.replace('sigma_',''))
-            else:
-                ds.to_h5(filename, group=key.replace('sigma_',''))
+    # skip DEMs
+    ind=np.flatnonzero(~(D.sensor > np.max(orbital_sensors+airborne_sensors)))
+    if ind.size==0:
+        return
+    # sort the points by (sensor, time_corr) and find the mean slope in each group
+    ind=ind[np.lexsort((D.time_corr[ind], D.sensor[ind]))]
+    new_group=np.ones(ind.size, dtype=bool)
+    new_group[1:]=(np.diff(D.sensor[ind]) != 0) | (np.diff(D.time_corr[ind]) != 0)
+    starts=np.flatnonzero(new_group)
+    slope=D.slope_mag[ind]
+    finite=np.isfinite(slope)
+    N_finite=np.add.reduceat(finite.astype(float), starts)
+    slope_sum=np.add.reduceat(np.where(finite, slope, 0), starts)
+    # groups with no valid slopes get a mean slope of zero
+    mean_slope=np.zeros(starts.size)
+    mean_slope[N_finite>0]=slope_sum[N_finite>0]/N_finite[N_finite>0]
+    group=np.cumsum(new_group)-1
+    D.sigma_corr[ind] = np.sqrt(D.sigma_corr[ind]**2 +
+                                (mean_slope[group]*5)**2)
+
+def merge_time_corr_groups(D, min_count=10, max_span=None, orbital_sensors=[1, 2], airborne_sensors=[3, 4, 5]):
+    '''
+    Merge adjacent time_corr groups of the same sensor and spot.
 
-    with h5py.File(filename,'r+') as h5f:
-        for key in S['E']['sigma_bias']:
-            if 'bias/sigma' in h5f and  key in h5f['/bias/sigma']:
-                print(f'{key} already exists in sigma_bias')
-                h5f['/bias/sigma/'+key][...]=S['E']['sigma_bias'][key]
-            else:
-                h5f.create_dataset('/bias/sigma/'+key, data=S['E']['sigma_bias'][key])
+    Consecutive groups are merged until the merged group has at least
+    min_count points, or until adding the next group would make the merged
+    group span more than max_span (years) in time_corr.  A small group left
+    at the end of a run is merged into the previous group if the span
+    allows.  Merged points take the time_corr of the first group in their
+    merged group, so each merged group becomes one bias parameter.
+
+    Returns a dict giving the number of laser time_corr groups before and after.
+    '''
+    if max_span is None:
+        max_span={'orbital':100/(24*3600*365.25), 'airborne':30*60/(24*3600*365.25)}
+    stats={'N_groups_in':0, 'N_groups_out':0}
+    ind=np.flatnonzero(np.in1d(D.sensor, orbital_sensors+airborne_sensors))
+    if ind.size==0:
+        return stats
+    spot=np.nan_to_num(D.spot[ind], nan=-1) if 'spot' in D.fields else np.zeros(ind.size)
+    order=np.lexsort((D.time_corr[ind], spot, D.sensor[ind]))
+    ind, spot = ind[order], spot[order]
+    sensor, time_corr = D.sensor[ind], D.time_corr[ind]
+    new_run=np.ones(ind.size, dtype=bool)
+    new_run[1:]=(np.diff(sensor) != 0) | (np.diff(spot) != 0)
+    new_group=new_run.copy()
+    new_group[1:] |= np.diff(time_corr) != 0
+    starts=np.flatnonzero(new_group)
+    counts=np.diff(np.r_[starts, ind.size])
+    g_time=time_corr[starts]
+    g_run=new_run[starts]
+    g_span=np.where(np.in1d(sensor[starts], airborne_sensors), max_span['airborne'], max_span['orbital'])
+
+    # greedy pass over the groups: target[ii] is the merged group of group ii
+    target=np.zeros(starts.size, dtype=int)
+    current, N_current = 0, 0
+    for ii in range(starts.size):
+        if g_run[ii] or N_current >= min_count or g_time[ii]-g_time[current] > g_span[ii]:
+            # a small final group in a run joins the previous merged group if it can
+            if N_current < min_count and ii > 0 and not g_run[current] and \
+                    g_time[ii-1]-g_time[target[current-1]] <= g_span[ii-1]:
+                target[current:ii]=target[current-1]
+            current, N_current = ii, 0
+        target[ii]=current
+        N_current += counts[ii]
+    if N_current < min_count and starts.size > 1 and not g_run[current] and \
+            g_time[-1]-g_time[target[current-1]] <= g_span[-1]:
+        target[current:]=target[current-1]
+    D.time_corr[ind]=np.repeat(g_time[target], counts)
+    stats['N_groups_in']=int(starts.size)
+    stats['N_groups_out']=int(np.unique(target).size)
+    return stats
+
+def save_errors_to_file( S, filename, output_profile='default'):
+
+    timer=S.get('stage_timer', None)
+    with fit_output_writer(filename, mode='a', profile=output_profile) as out:
+        with timed(timer, 'save_errors'):
+            for key, ds in S['E'].items():
+                if isinstance(ds, pc.grid.data):
+                    print(key)
+                    if 'sensor_' in key and 'bias' in key:
+                        #write the sensor grid biases into their own group
+                        out.write_grid(ds, '/grid_bias/'+key.replace('sigma_',''))
+                    else:
+                        out.write_grid(ds, key.replace('sigma_',''))
+
+            h5f=out.h5f
+            for key in S['E']['sigma_bias']:
+                if 'bias/sigma' in h5f and  key in h5f['/bias/sigma']:
+                    print(f'{key} already exists in sigma_bias')
+                    h5f['/bias/sigma/'+key][...]=S['E']['sigma_bias'][key]
+                else:
+                    h5f.create_dataset('/bias/sigma/'+key, data=S['E']['sigma_bias'][key])
+        if timer is not None:
+            timer.write_h5(h5f.require_group('/meta/error_timing'))
     return
 
 def fit_altimetry(xy0, Wxy=4e4, \
@@ -397,6 +584,7 @@ def fit_altimetry(xy0, Wxy=4e4, \
             replace=False, DOPLOT=False, spring_only=False, \
             firn_fixed=False, firn_rescale=False, \
             firn_correction=None, firn_directory=None, firn_version=None,\
+            firn_cache_dir=None,\
             GI_files=None,\
             geoid_file=None,\
             mask_file=None, \
@@ -405,6 +593,21 @@ def fit_altimetry(xy0, Wxy=4e4, \
             water_mask_threshold=None, \
             bm_scale=None,
             N_target=None,\
+            mem_budget=None,\
+            memory_coefficients=None,\
+            stage_cache_dir=None,\
+            warm_start_file=None,\
+            warm_start_min_match=0.9,\
+            coarse_edit_scale=None,\
+            adaptive_thinning=False,\
+            thin_region_size=2000.,\
+            thin_reference_fit=None,\
+            thin_read_factor=2.,\
+            DEM_grid_bias_min_nodes=None,\
+            time_corr_min_count=None,\
+            DEM_budget=None,\
+            time_budget=None,\
+            run_db=None,\
             calc_error_file=None, \
             extra_error=None,\
             repeat_res=None,\
@@ -415,9 +618,18 @@ def fit_altimetry(xy0, Wxy=4e4, \
             velocity_files=None, \
             lagrangian_epoch=2000.0, \
             lagrangian_ref_dem=None,\
+            lagrangian_cache_dir=None,\
+            lagrangian_workers=1,\
+            lagrangian_fast=False,\
+            lagrangian_fast_tol=5.,\
+            velocity_region_size=None,\
             tide_directory=None, \
             tide_model='CATS2008', \
+            tide_cache_dir=None, \
+            tide_lattice_spacing=None, \
+            tide_lattice_tol=0.01, \
             year_mask_dir=None, \
+            year_mask_cube=None, \
             avg_scales=None,\
             bias_params=['time_corr','sensor','spot'],\
             DEM_grid_bias_params=None):
@@ -428,6 +640,7 @@ def fit_altimetry(xy0, Wxy=4e4, \
 
     SRS_proj4=get_SRS_proj4(hemisphere)
     bias_model_args={}
+    timer=stage_timer()
     compute_E=False
     # set defaults for E_RMS, then update with input parameters
     E_RMS0={'d2z0_dx2':200000./3000/3000, 'd3z_dx2dt':3000./3000/3000, 'd2z_dxdt':3000/3000, 'd2z_dt2':5000}
@@ -448,68 +661,278 @@ def fit_altimetry(xy0, Wxy=4e4, \
         repeat_res=None
 
     if lagrangian:
-        lagrangian_dict = setup_lagrangian(
-            velocity_files=velocity_files,
-            lagrangian_epoch=lagrangian_epoch,
-            SRS_proj4=SRS_proj4, xy0=xy0, Wxy=Wxy,
-            t_span=t_span, spacing=spacing)
+        with timed(timer, 'lagrangian_setup'):
+            lagrangian_dict = setup_lagrangian(
+                velocity_files=velocity_files,
+                lagrangian_epoch=lagrangian_epoch,
+                SRS_proj4=SRS_proj4, xy0=xy0, Wxy=Wxy,
+                t_span=t_span, spacing=spacing,
+                lagrangian_cache_dir=lagrangian_cache_dir,
+                lagrangian_workers=lagrangian_workers,
+                velocity_region_size=velocity_region_size)
 
     if reread_file is not None:
         # get xy0 from the filename
         re_match=re.compile('E(.*)_N(.*).h5').search(reread_file)
         xy0=[float(re_match.group(ii))*1000 for ii in [1, 2]]
-        data=pc.data().from_h5(reread_file, group='data')
-        sensor_dict=make_sensor_dict(reread_file)
-    elif reread_dirs is None:
-        D, sensor_dict, DEM_meta_dict = read_optical_data(xy0, W, GI_files=GI_files, \
+    laser_sensors=[item for key, item in laser_key().items()]
+    read_optical = reread_file is None and reread_dirs is None
+    if bm_scale is None:
+        bm_scale={'laser':100, 'DEM':200}
+    # a time budget needs a cost model fit to previous runs
+    time_model=None
+    if time_budget is not None and run_db is not None:
+        time_model=run_database(run_db).cost_model()
+        if time_model is None:
+            print(f"not enough runs in {run_db} to fit a cost model, ignoring the time budget")
+    thin = adaptive_thinning and N_target is not None and calc_error_file is None
+    read_N_target=N_target
+    if thin:
+        # read more data than N_target, so that the thinning can choose which to keep
+        read_N_target={key:None if val is None else int(val*thin_read_factor) \
+                       for key, val in N_target.items()}
+
+    # the data are prepared in a chain of stages, whose outputs can be
+    # cached in stage_cache_dir so that reruns resume after the last
+    # stage whose inputs have not changed
+    def read_stage(data, meta):
+        if reread_file is not None:
+            data=decode_categorical(pc.data().from_h5(reread_file, group='data'))
+            sensor_dict=make_sensor_dict(reread_file)
+        elif reread_dirs is None:
+            this_N_target, this_bm_scale = read_N_target, bm_scale
+            # if a memory budget or a time budget is given, check the predicted
+            # peak memory and wall time of the fit before fitting, and re-read
+            # fewer data if either is too large.  Data that are to be thinned
+            # are planned for at most N_target, and if the plan needs fewer
+            # data, they are thinned further instead of being re-read.
+            fit_N_target=N_target if thin else None
+            if thin:
+                meta['thin_inputs']={'N_target':N_target, 'bm_scale':bm_scale}
+            N_reads=3 if (mem_budget is not None or time_model is not None) else 1
+            for read_count in range(N_reads):
+                D, sensor_dict, DEM_meta_dict = read_optical_data(xy0, W, GI_files=GI_files, \
                                 SRS_proj4=get_SRS_proj4(hemisphere),\
-                                bm_scale=bm_scale,\
-                                N_target=N_target,\
+                                bm_scale=this_bm_scale,\
+                                N_target=this_N_target,\
                                  mask_file=mask_file, geoid_file=geoid_file, \
                                  mask_floating=mask_floating,\
                                  water_mask_threshold=water_mask_threshold, \
                                  DEM_file=DEM_file, \
-                                 hemisphere=hemisphere)
-        for ind, Di in enumerate(D):
-            if Di is None:
-                continue
-            for field in ['rgt','cycle','spot']:
-                if field not in Di.fields:
-                    Di.assign({field:np.zeros_like(Di.x)+np.NaN})
-
-        data=pc.data(fields=['x','y','z','time','sigma','sigma_corr','slope_mag', 'sensor','spot', 'rgt','cycle','BP']).from_list(D)
-        data.assign({'day':np.floor(data.time*365.25)})
-        if extra_error is not None:
-            data.sigma[data.time < 2010] = np.sqrt(data.sigma[data.time<2010]**2 +extra_error**2)
-        # apply the tides if a directory has been provided
-        if tide_mask_file is not None:
-            if hemisphere==1:
-                EPSG=3413
-            else:
-                EPSG=3031
-            apply_tides(data, xy0, Wxy, tide_mask_file, tide_directory, tide_model, EPSG=EPSG)
-    else:
-        data, sensor_dict = reread_data_from_fits(xy0, Wxy, reread_dirs, template='E%d_N%d.h5')
-    laser_sensors=[item for key, item in laser_key().items()]
-    DEM_sensors=np.array([key for key in sensor_dict.keys() if key not in laser_sensors ])
-    if reference_epoch is None:
-        reference_epoch=len(np.arange(t_span[0], t_span[1], spacing['dt']))
+                                 hemisphere=hemisphere, DEM_budget=DEM_budget, timer=timer)
+                meta['read_inputs']={'N_target':this_N_target, 'bm_scale':this_bm_scale}
+                if N_reads==1:
+                    break
+                plans=[]
+                if mem_budget is not None:
+                    plan=plan_for_data(D, laser_sensors, Wxy, t_span, spacing,
+                                       mem_budget, N_target=fit_N_target if thin else this_N_target,
+                                       bm_scale=this_bm_scale, coefficients=memory_coefficients,
+                                       N_fit=fit_N_target)
+                    plan['N_rereads']=read_count
+                    meta['memory_plan']=plan
+                    print("memory plan: estimated peak %0.2f GB for %d data, %d unknowns, budget %0.2f GB" % \
+                          (plan['estimate']/2**30, plan['N_data'], plan['N_z0']+plan['N_dz']+plan['N_bias'],
+                           plan['budget']/2**30))
+                    plans += [plan]
+                if time_model is not None:
+                    N_grid_bias=0
+                    if DEM_grid_bias_params is not None:
+                        D_xy=pc.data(fields=['x','y','sensor']).from_list(D)
+                        N_grid_bias=count_DEM_bias_nodes(D_xy,
+                            [key for key in sensor_dict.keys() if key not in laser_sensors],
+                            DEM_grid_bias_params, xy0, Wxy, min_nodes=DEM_grid_bias_min_nodes)
+                    plan=plan_for_time(D, laser_sensors, Wxy, t_span, spacing, time_budget, time_model,
+                                       N_target=fit_N_target if thin else this_N_target,
+                                       bm_scale=this_bm_scale, N_grid_bias=N_grid_bias,
+                                       N_fit=fit_N_target)
+                    plan['N_rereads']=read_count
+                    meta['time_plan']=plan
+                    print("time plan: estimated %0.0f s for %d data, %d unknowns, budget %0.0f s" % \
+                          (plan['estimate'], plan['N_data'], plan['N_unknowns'], plan['budget']))
+                    plans += [plan]
+                # re-read with the smallest inputs that any of the budgets needs
+                plans=[plan for plan in plans if not plan['fits'] and 'fraction' in plan]
+                if len(plans)==0 or read_count==N_reads-1:
+                    break
+                plan=min(plans, key=lambda plan: plan['fraction'])
+                if thin:
+                    # the data that have been read are more than the plan needs
+                    meta['thin_inputs']={'N_target':plan['N_target'], 'bm_scale':plan['bm_scale']}
+                    print(f"thinning to N_target={plan['N_target']}, bm_scale={plan['bm_scale']}")
+                    break
+                print(f"re-reading with N_target={plan['N_target']}, bm_scale={plan['bm_scale']}")
+                this_N_target, this_bm_scale = plan['N_target'], plan['bm_scale']
+            for ind, Di in enumerate(D):
+                if Di is None:
+                    continue
+                for field in ['rgt','cycle','spot']:
+                    if field not in Di.fields:
+                        Di.assign({field:np.zeros_like(Di.x)+np.NaN})
+
+            data=pc.data(fields=['x','y','z','time','sigma','sigma_corr','slope_mag', 'sensor','spot', 'rgt','cycle','BP']).from_list(D)
+            data.assign({'day':np.floor(data.time*365.25)})
+            if extra_error is not None:
+                data.sigma[data.time < 2010] = np.sqrt(data.sigma[data.time<2010]**2 +extra_error**2)
+        else:
+            data, sensor_dict = reread_data_from_fits(xy0, Wxy, reread_dirs, template='E%d_N%d.h5')
+        meta['sensor_dict']=sensor_dict
+        return data, meta
 
-    if lagrangian:
-        lagrangian_dict=update_data_for_lagrangian( data,
+    def tide_stage(data, meta):
+        # apply the tides if a directory has been provided
+        if hemisphere==1:
+            EPSG=3413
+        else:
+            EPSG=3031
+        apply_tides(data, xy0, Wxy, tide_mask_file, tide_directory, tide_model, EPSG=EPSG,
+                    tide_cache_dir=tide_cache_dir,
+                    lattice_spacing=tide_lattice_spacing, lattice_tol=tide_lattice_tol)
+        return data, meta
+
+    def lagrangian_stage(data, meta):
+        update_data_for_lagrangian( data,
             lagrangian_ref_dem=lagrangian_ref_dem,
+            lagrangian_fast=lagrangian_fast,
+            lagrangian_fast_tol=lagrangian_fast_tol,
             **lagrangian_dict)
-
-    # make every dataset a double
-    for field in data.fields:
-        setattr(data, field, getattr(data, field).astype(np.float64))
-
-    if (firn_fixed or firn_rescale) and reread_dirs is None and \
-        calc_error_file is None and reread_file is None:
-        assign_firn_variable(data, firn_correction, firn_directory, hemisphere,
+        return data, meta
+
+    def firn_stage(data, meta):
+        # make every dataset a double
+        for field in data.fields:
+            setattr(data, field, getattr(data, field).astype(np.float64))
+        if firn_cache_dir is None:
+            from SMBcorr import assign_firn_variable
+            assign_firn_variable(data, firn_correction, firn_directory, hemisphere,
                          model_version=firn_version, subset_valid=True)
+        else:
+            assign_firn_variable_cached(data, firn_correction, firn_directory, hemisphere,
+                         model_version=firn_version, cache_dir=firn_cache_dir,
+                         t_span=t_span, subset_valid=True)
         if firn_fixed:
             data.z -= data.h_firn
+        return data, meta
+
+    def edit_stage(data, meta):
+        # make every dataset a double
+        for field in data.fields:
+            setattr(data, field, getattr(data, field).astype(np.float64))
+        if isinstance(data,pc.data):
+            temp=pc.data().from_dict({item:data.__dict__[item] for item in data.fields})
+            data=temp
+
+        # apply any custom edits
+        custom_edits(data)
+        with timed(timer, 'assign_sigma_corr'):
+            assign_sigma_corr(data)
+        if time_corr_min_count is not None:
+            meta['time_corr_groups']=merge_time_corr_groups(data, min_count=time_corr_min_count)
+            print("merged %d time_corr groups into %d" % \
+                  (meta['time_corr_groups']['N_groups_in'], meta['time_corr_groups']['N_groups_out']))
+
+        if year_mask_dir is not None:
+            with timed(timer, 'year_mask'):
+                mask_data_by_year(data, year_mask_dir, cube_file=year_mask_cube);
+        return data, meta
+
+    def thin_stage(data, meta):
+        dz_grid=None
+        if thin_reference_fit is not None and os.path.isfile(thin_reference_fit):
+            dz_grid=read_dz_variability(thin_reference_fit)
+        # the memory and time plans may have reduced N_target and increased bm_scale
+        thin_inputs=meta.get('thin_inputs', {'N_target':N_target, 'bm_scale':bm_scale})
+        data, meta['thinning'] = thin_data(data, thin_inputs['N_target'], thin_inputs['bm_scale'],
+                                           laser_sensors, xy0, Wxy, region_size=thin_region_size,
+                                           dz_grid=dz_grid)
+        print("adaptive thinning: kept %d of %d laser data and %d of %d DEM data" % \
+              (meta['thinning'].get('N_out_laser', meta['thinning']['N_in_laser']), meta['thinning']['N_in_laser'],
+               meta['thinning'].get('N_out_DEM', meta['thinning']['N_in_DEM']), meta['thinning']['N_in_DEM']))
+        return data, meta
+
+    def file_ids(files):
+        if files is None:
+            return None
+        if isinstance(files, str):
+            files=[files]
+        return [file_id(file) for file in files]
+
+    # the geoindex files are identified by their sizes and modification times,
+    # so that the read stage is rerun when a geoindex is rebuilt
+    GI_ids=GI_files
+    if isinstance(GI_files, dict):
+        GI_ids={key:file_ids(sorted(find_gI_files(val))) for key, val in GI_files.items()}
+    read_params={'xy0':xy0, 'Wxy':Wxy, 'hemisphere':hemisphere,
+                 'reread_file':file_id(reread_file), 'reread_dirs':reread_dirs,
+                 'GI_files':GI_ids, 'bm_scale':bm_scale, 'N_target':read_N_target,
+                 'mask_file':file_id(mask_file), 'geoid_file':file_id(geoid_file),
+                 'DEM_file':file_id(DEM_file), 'mask_floating':mask_floating,
+                 'water_mask_threshold':water_mask_threshold, 'extra_error':extra_error,
+                 'DEM_budget':DEM_budget}
+    if mem_budget is not None:
+        read_params.update({'mem_budget':mem_budget, 'memory_coefficients':memory_coefficients,
+                            't_span':t_span, 'spacing':spacing})
+    if time_model is not None:
+        # the cost model changes with every recorded run, so it is not part of
+        # the key: a cached read is reused until the budget or the fit changes
+        read_params.update({'time_budget':time_budget,
+                            't_span':t_span, 'spacing':spacing,
+                            'DEM_grid_bias_min_nodes':DEM_grid_bias_min_nodes})
+    tide_params={'tide_mask_file':file_id(tide_mask_file), 'tide_directory':tide_directory,
+                 'tide_model':tide_model, 'tide_lattice_spacing':tide_lattice_spacing,
+                 'tide_lattice_tol':tide_lattice_tol}
+    lagrangian_params={'velocity_files':file_ids(velocity_files), 'lagrangian_epoch':lagrangian_epoch,
+                       'lagrangian_ref_dem':file_id(lagrangian_ref_dem),
+                       'lagrangian_fast':lagrangian_fast, 'lagrangian_fast_tol':lagrangian_fast_tol}
+    if lagrangian_fast:
+        lagrangian_params.update({'t_span':t_span, 'spacing':spacing})
+    firn_params={'firn_correction':firn_correction, 'firn_directory':firn_directory,
+                 'firn_version':firn_version, 'firn_fixed':firn_fixed, 'hemisphere':hemisphere,
+                 'firn_cache_dir':firn_cache_dir}
+    if firn_cache_dir is not None:
+        firn_params['t_span']=t_span
+    edit_params={'year_mask_dir':year_mask_dir, 'time_corr_min_count':time_corr_min_count,
+                 'year_masks':file_ids(sorted(glob.glob(year_mask_dir+'/*.tif'))) \
+                    if year_mask_dir is not None else None,
+                 'year_mask_cube':file_id(year_mask_cube if year_mask_cube is not None else \
+                    os.path.join(year_mask_dir, 'year_mask_cube.h5')) \
+                    if year_mask_dir is not None else None}
+    thin_params={'N_target':N_target, 'thin_region_size':thin_region_size,
+                 'thin_reference_fit':file_id(thin_reference_fit)}
+    stages=fit_stages(cache_dir=stage_cache_dir, tile='E%d_N%d' % (xy0[0]/1000, xy0[1]/1000))
+    data, meta = stages.run([
+        ('read', read_params, read_stage, True),
+        ('tides', tide_params, tide_stage, read_optical and tide_mask_file is not None),
+        ('lagrangian', lagrangian_params, lagrangian_stage, lagrangian),
+        ('firn', firn_params, firn_stage, (firn_fixed or firn_rescale) and read_optical \
+            and calc_error_file is None),
+        ('edits', edit_params, edit_stage, True),
+        ('thin', thin_params, thin_stage, thin)], timer=timer)
+    # json stores the sensor numbers as strings
+    sensor_dict={int(key):val for key, val in meta['sensor_dict'].items()}
+    memory_plan=meta.get('memory_plan', None)
+    thinning=meta.get('thinning', None)
+    time_corr_groups=meta.get('time_corr_groups', None)
+    time_plan=meta.get('time_plan', None)
+    read_inputs=meta.get('read_inputs', None)
+    if thin and 'thin_inputs' in meta:
+        # the inputs to the fit are the thinning targets, not the read targets
+        read_inputs=meta['thin_inputs']
+
+    DEM_sensors=np.array([key for key in sensor_dict.keys() if key not in laser_sensors ])
+    if reference_epoch is None:
+        reference_epoch=len(np.arange(t_span[0], t_span[1], spacing['dt']))
+
+    # start from the edits of a previous fit for the same tile.  If the data
+    # have not changed, the editing converges in a few iterations
+    warm_start=None
+    if warm_start_file is not None and calc_error_file is None and os.path.isfile(warm_start_file):
+        with timed(timer, 'warm_start'):
+            warm_start=apply_prelim_edits(data, warm_start_file, min_match=warm_start_min_match)
+        print("warm start from %s: matched %d of %d data, %d start as edited%s" % \
+              (warm_start_file, warm_start['N_matched'], warm_start['N_data'], warm_start['N_edited'],
+               '' if warm_start['applied'] else ' (too few matched, not applied)'))
+
     if firn_rescale:
         # the grid has one node at each domain corner.
         this_grid=fd_grid( [xy0[1]+np.array([-0.5, 0.5])*Wxy,
@@ -527,60 +950,111 @@ def fit_altimetry(xy0, Wxy=4e4, \
     print("for DEMs, found %d data" % np.sum(np.in1d(data.sensor, np.array(DEM_sensors))))
 
     sensor_grid_bias_params=None
-    if DEM_grid_bias_params is not None:
+    DEM_grid_bias=None
+    if DEM_grid_bias_params is not None and DEM_grid_bias_min_nodes is not None:
+        # scale each DEM's bias grid to its coverage, and drop the grids of DEMs with little coverage
+        sensor_grid_bias_params, DEM_grid_bias = size_DEM_bias_grids(data, DEM_sensors,
+                DEM_grid_bias_params, xy0, Wxy, min_nodes=DEM_grid_bias_min_nodes)
+        print("DEM bias grids: %d full, %d coarsened, %d dropped; %d nodes instead of %d" % \
+              (DEM_grid_bias['N_full'], DEM_grid_bias['N_coarsened'], DEM_grid_bias['N_dropped'],
+               DEM_grid_bias['N_nodes'], DEM_grid_bias['N_nodes_full']))
+    elif DEM_grid_bias_params is not None:
         sensor_grid_bias_params=[]
         for sensor in DEM_sensors:
             sensor_grid_bias_params += [{'sensor':sensor, 'expected_val':0}]
             sensor_grid_bias_params[-1].update(DEM_grid_bias_params)
 
-    if isinstance(data,pc.data):
-        temp=pc.data().from_dict({item:data.__dict__[item] for item in data.fields})
-        data=temp
-
-    # apply any custom edits
-    custom_edits(data)
-    assign_sigma_corr(data)
-
     avg_masks=None
     if avg_mask_directory is not None:
 
         avg_masks = {os.path.basename(file).replace('.tif',''):pc.grid.data().from_geotif(file) for file in \
                      glob.glob(avg_mask_directory+'/*.tif')}
 
-    if year_mask_dir is not None:
-        mask_data_by_year(data, year_mask_dir);
+    # arguments shared by the coarse editing pass and the full-resolution fit
+    fit_args=dict(ctr=ctr, W=W, E_RMS=E_RMS0,
+                  reference_epoch=reference_epoch,
+                  bias_params=bias_params,
+                  repeat_res=repeat_res,
+                  srs_proj4=SRS_proj4, VERBOSE=True,
+                  data_slope_sensors=DEM_sensors,
+                  E_slope_bias=E_slope_bias,
+                  mask_file=mask_file,
+                  dzdt_lags=dzdt_lags,
+                  bias_model_args = bias_model_args,
+                  bias_nsigma_edit=bias_nsigma_edit,
+                  bias_nsigma_iteration=bias_nsigma_iteration,
+                  error_res_scale=error_res_scale,
+                  mask_scale={0:10, 1:1},
+                  avg_scales=avg_scales,
+                  avg_masks=avg_masks,
+                  sensor_grid_bias_params=sensor_grid_bias_params,
+                  converge_tol_frac_TSE=0.005)
+
+    coarse_edit=None
+    if coarse_edit_scale is not None and not compute_E and not Edit_only and max_iterations > 1:
+        # find the outliers with a model on a coarser grid, then start the
+        # full-resolution fit from the coarse fit's edits
+        coarse_spacing=spacing.copy()
+        for key in ['z0','dz']:
+            coarse_spacing[key] *= coarse_edit_scale
+        print("="*50)
+        print(f"running the editing pass with spacing={coarse_spacing}")
+        with timed(timer, 'coarse_edit'):
+            coarse_data=data.copy()
+            S_coarse=smooth_xytb_fit_aug(data=coarse_data, spacing=coarse_spacing,
+                         compute_E=False, max_iterations=max_iterations, Edit_only=True,
+                         sigma_extra_masks={'laser': np.in1d(coarse_data.sensor, laser_sensors),
+                                            'DEM': ~np.in1d(coarse_data.sensor, laser_sensors)},
+                         **fit_args)
+            coarse_edit=apply_edits(data, *data_edits(S_coarse['data']))
+            del S_coarse, coarse_data
+        coarse_edit['scale']=coarse_edit_scale
+        print("coarse editing pass set %d of %d data as edited" % \
+              (coarse_edit['N_edited'], coarse_edit['N_data']))
 
     sigma_extra_masks = {'laser': np.in1d(data.sensor, laser_sensors),
                          'DEM': ~np.in1d(data.sensor, laser_sensors)}
     # run the fit
     print("="*50)
     print("about to run smooth_xytb_fit_aug with params="+str(bias_params))
-    S=smooth_xytb_fit_aug(data=data, ctr=ctr, W=W, spacing=spacing, E_RMS=E_RMS0,
-                     reference_epoch=reference_epoch, compute_E=compute_E,
-                     bias_params=bias_params,
-                     repeat_res=repeat_res, max_iterations=max_iterations,
-                     srs_proj4=SRS_proj4, VERBOSE=True, Edit_only=Edit_only,
-                     data_slope_sensors=DEM_sensors,\
-                     E_slope_bias=E_slope_bias,\
-                     mask_file=mask_file,\
-                     dzdt_lags=dzdt_lags, \
-                     bias_model_args = bias_model_args, \
-                     bias_nsigma_edit=bias_nsigma_edit, \
-                     bias_nsigma_iteration=bias_nsigma_iteration, \
-                     error_res_scale=error_res_scale,\
-                     mask_scale={0:10, 1:1}, \
-                     avg_scales=avg_scales, \
-                     avg_masks=avg_masks, \
-                     sigma_extra_masks=sigma_extra_masks,\
-                     sensor_grid_bias_params=sensor_grid_bias_params,\
-                     converge_tol_frac_TSE=0.005)
+    with timed(timer, 'fit'):
+        S=smooth_xytb_fit_aug(data=data, spacing=spacing, compute_E=compute_E,
+                              max_iterations=max_iterations, Edit_only=Edit_only,
+                              sigma_extra_masks=sigma_extra_masks, **fit_args)
 
     if lagrangian:
         update_output_grids_for_lagrangian(S, **lagrangian_dict)
 
+    if memory_plan is not None:
+        S['memory_plan']=memory_plan
+    if warm_start is not None:
+        S['warm_start']=warm_start
+    if coarse_edit is not None:
+        S['coarse_edit']=coarse_edit
+    if thinning is not None:
+        S['thinning']=thinning
+    if DEM_grid_bias is not None:
+        S['DEM_grid_bias']=DEM_grid_bias
+    if time_corr_groups is not None:
+        S['time_corr_groups']=time_corr_groups
+    if time_plan is not None:
+        S['time_plan']=time_plan
+    # size of the fit, for the run database
+    S['run_size']={}
+    N_grid_bias=0
+    if sensor_grid_bias_params is not None:
+        N_grid_bias=sum([domain_nodes(params['spacing'], Wxy) for params in sensor_grid_bias_params])
+    S['run_size']['N_data'], S['run_size']['N_unknowns'] = fit_size(data.sensor, data.time, laser_sensors,
+            Wxy, t_span, spacing, N_grid_bias=N_grid_bias,
+            time_corr=data.time_corr if 'time_corr' in data.fields else None)
+    if read_inputs is not None:
+        S['run_size'].update(read_inputs)
+    S['stages']=stages.log
+    S['stage_timer']=timer
     return S, data, sensor_dict
 
 def main(argv):
+    t_start=time.time()
     # account for a bug in argparse that misinterprets negative agruents
     for i, arg in enumerate(argv):
         if (arg[0] == '-') and arg[1].isdigit(): argv[i] = ' ' + arg
@@ -601,6 +1075,7 @@ def main(argv):
     parser.add_argument('--GeoIndex_source_file', type=path, help='json file containing locations for geoIndex files')
     parser.add_argument('--reread_file', type=str, help='reread data from this file')
     parser.add_argument('--out_name', '-o', type=path, help="output file name")
+    parser.add_argument('--output_profile', type=str, default='default', choices=['default', 'compact'], help="output profile: 'compact' writes float32 grids, integer-coded categorical data fields, and shuffle+lzf compression")
     parser.add_argument('--dzdt_lags', type=str, default='1,2,4', help='lags for which to calculate dz/dt, comma-separated list, no spaces')
     parser.add_argument('--prelim', action="store_true")
     parser.add_argument('--E_d2zdt2', type=float, default=5000)
@@ -624,6 +1099,7 @@ def main(argv):
     parser.add_argument('--firn_directory', type=path, help='directory containing firn model')
     parser.add_argument('--firn_model', type=str, help='firn model name')
     parser.add_argument('--firn_version', type=str, help='firn version')
+    parser.add_argument('--firn_cache_dir', type=path, help='directory in which regional firn-model cubes are cached')
     parser.add_argument('--rerun_file_with_firn', type=str)
     parser.add_argument('--firn_rescale', action='store_true')
     parser.add_argument('--firn_fixed', action='store_true')
@@ -631,22 +1107,59 @@ def main(argv):
     parser.add_argument('--velocity_files', type=path, nargs='+', help='lagrangian velocity files.  May contain multiple time values.')
     parser.add_argument('--lagrangian_epoch', type=float, help='time (decimal year) to which data will be advected')
     parser.add_argument('--lagrangian_ref_dem', type=path, help='dem to be subtracted from data before advection')
+    parser.add_argument('--lagrangian_cache_dir', type=path, help='directory in which lagrangian displacement fields are cached')
+    parser.add_argument('--lagrangian_workers', type=int, default=1, help='number of processes used to calculate lagrangian displacement fields')
+    parser.add_argument('--lagrangian_fast', action='store_true', help='interpolate data positions at the lagrangian epoch from the grid displacement fields, advecting exactly only where the interpolation is inaccurate')
+    parser.add_argument('--lagrangian_fast_tol', type=float, default=5., help='estimated interpolation error (m) above which data points are advected exactly in lagrangian_fast mode')
+    parser.add_argument('--velocity_region_size', type=float, help='if specified, velocity windows are rounded out to multiples of this size (m) so that neighboring tiles can share cached velocities')
     parser.add_argument('--mask_file', type=path)
     parser.add_argument('--geoid_file', type=path)
     parser.add_argument('--water_mask_threshold', type=float)
     parser.add_argument('--year_mask_dir', type=path)
+    parser.add_argument('--year_mask_cube', type=path, help='year-mask cube file made by make_year_mask_cube.py, default is year_mask_cube.h5 in year_mask_dir.  If the cube is missing or out of date, the masks are read one year at a time')
     parser.add_argument('--tide_mask_file', type=path)
     parser.add_argument('--tide_directory', type=path)
     parser.add_argument('--tide_model', type=str, help='tide model name')
+    parser.add_argument('--tide_cache_dir', type=path, help='directory in which tide predictions are cached between runs')
+    parser.add_argument('--tide_lattice_spacing', type=float, help='if specified, tides are interpolated from a lattice with this spacing (m)')
+    parser.add_argument('--tide_lattice_tol', type=float, default=0.01, help='tide lattice cells with check-point errors larger than this (m) are evaluated exactly')
     parser.add_argument('--avg_mask_directory', type=path)
     parser.add_argument('--calc_error_file','-c', type=path)
     parser.add_argument('--calc_error_for_xy', action='store_true')
     parser.add_argument('--avg_scales', type=str, help='scales at which to report average errors, comma-separated list, no spaces')
     parser.add_argument('--error_res_scale','-s', type=float, nargs=2, default=[4, 2], help='if the errors are being calculated (see calc_error_file), scale the grid resolution in x and y to be coarser')
     parser.add_argument('--max_mem', type=float, default=15., help='maximum memory the program is allowed to use, in GB.')
-    args, unk=parser.parse_known_args()
+    parser.add_argument('--stage_cache_dir', type=path, help='directory in which the outputs of the data-preparation stages (read, tides, lagrangian, firn, edits) are cached, so that reruns resume after the last unchanged stage')
+    parser.add_argument('--warm_start', action='store_true', help='start from the data edits of the prelim fit for this tile (in base_directory/prelim)')
+    parser.add_argument('--warm_start_file', type=path, help='fit output file whose data edits are used as the starting state, default is the prelim fit if --warm_start is set')
+    parser.add_argument('--warm_start_min_match', type=float, default=0.9, help='the warm start is used only if at least this fraction of the data match the data of the previous fit')
+    parser.add_argument('--coarse_edit_scale', type=float, help='if set, outliers are first edited with a fit whose z0 and dz grid spacings are multiplied by this factor, and the edits are carried into the full-resolution fit')
+    parser.add_argument('--adaptive_thinning', action='store_true', help='read more data than N_target_laser and N_target_DEM, then thin them to N_target, keeping more data where the surface is steep or (if a reference fit is given) where dz varies')
+    parser.add_argument('--thin_region_size', type=float, default=2000., help='size of the regions used to assess surface variability in adaptive thinning')
+    parser.add_argument('--thin_reference_fit', type=path, help='previous fit whose dz variability is used in adaptive thinning, default is the warm-start file')
+    parser.add_argument('--thin_read_factor', type=float, default=2., help='with adaptive thinning, N_target is multiplied by this factor when reading the data')
+    parser.add_argument('--DEM_grid_bias_min_nodes', type=int, help='if set, the bias grid for each DEM is coarsened (its spacing doubled until its node count is no more than the number of nodes its data touch), and DEMs whose data touch fewer than this many nodes get no bias grid.  A coarsened grid cannot resolve bias variations shorter than its spacing, so DEMs that cover little of the tile get smoother bias corrections')
+    parser.add_argument('--time_corr_min_count', type=int, help='if set, adjacent time_corr groups of the same sensor and spot are merged until each has at least this many points (or spans 100 s for orbital, 30 minutes for airborne data), reducing the number of time_corr bias parameters')
+    parser.add_argument('--DEM_budget', type=int, help='maximum number of DEMs to use, chosen to maximize the space-time coverage of the tile, weighted by registration quality')
+    parser.add_argument('--run_db', type=path, help='sqlite database in which the size and wall time of each fit are recorded')
+    parser.add_argument('--time_budget', type=float, help='wall time (s) available for the fit.  If given with a run_db holding enough previous runs, N_target and the blockmedian scales are reduced until the predicted fit time is within the budget')
+    parser.add_argument('--timing_json', type=path, help='json file to which the timing, memory and I/O records for each stage of the fit are written')
+    parser.add_argument('--memory_plan', action='store_true', help='predict the peak memory of the fit before fitting, and re-read with a smaller N_target and a coarser blockmedian scale if it would exceed max_mem')
+    parser.add_argument('--threads', type=str, help="number of BLAS/OpenMP threads for the fit, or 'auto' to divide the node's cores among --workers.  The default is ALTIMETRYFIT_NUM_THREADS, or 1")
+    parser.add_argument('--workers', type=int, help='number of concurrent workers on the node, used with --threads auto.  The default is ALTIMETRYFIT_WORKERS, or 1')
+    args, unk=parser.parse_known_args(argv[1:])
     print("unknown arguments:"+str(unk))
 
+    try:
+        n_threads, thread_mode = resolve_threads(args.threads, args.workers)
+    except ValueError:
+        parser.error("--threads must be an integer or 'auto', and --workers and the ALTIMETRYFIT_NUM_THREADS and ALTIMETRYFIT_WORKERS variables must be integers")
+    n_active=set_thread_limits(n_threads)
+    if n_active != n_threads:
+        print(f"WARNING: could not set the thread limits to {n_threads} after numpy was imported "
+              f"(threadpoolctl is not installed); {n_active if n_active is not None else 'an unknown number of'} threads are in effect")
+    print(f"using {n_active} threads ({thread_mode})")
+
     set_memory_limit(int(args.max_mem*1024*1024*1024))
 
     if args.avg_scales is not None:
@@ -721,6 +1234,9 @@ def main(argv):
     if args.out_name is None:
         args.out_name=dest_dir + '/E%d_N%d.h5' % (args.xy0[0]/1e3, args.xy0[1]/1e3)
 
+    if args.warm_start and args.warm_start_file is None and not args.prelim:
+        args.warm_start_file=args.base_directory+'/prelim/E%d_N%d.h5' % (args.xy0[0]/1e3, args.xy0[1]/1e3)
+
     S, data, sensor_dict = fit_altimetry(args.xy0, Wxy=args.Width, E_RMS=E_RMS, \
             t_span=args.time_span, spacing=spacing, \
             reference_epoch=args.reference_epoch, \
@@ -736,17 +1252,37 @@ def main(argv):
             GI_files=geoIndex_dict,\
             bm_scale={'laser':args.bm_scale_laser,\
                          'DEM':args.bm_scale_DEM},\
+            mem_budget=args.max_mem*1024*1024*1024 if args.memory_plan else None,\
+            stage_cache_dir=args.stage_cache_dir,\
+            warm_start_file=args.warm_start_file,\
+            warm_start_min_match=args.warm_start_min_match,\
+            coarse_edit_scale=args.coarse_edit_scale,\
+            adaptive_thinning=args.adaptive_thinning,\
+            thin_region_size=args.thin_region_size,\
+            thin_reference_fit=args.thin_reference_fit if args.thin_reference_fit is not None else args.warm_start_file,\
+            thin_read_factor=args.thin_read_factor,\
+            DEM_grid_bias_min_nodes=args.DEM_grid_bias_min_nodes,\
+            time_corr_min_count=args.time_corr_min_count,\
+            DEM_budget=args.DEM_budget,\
+            time_budget=args.time_budget,\
+            run_db=args.run_db,\
             N_target={'laser':args.N_target_laser,\
                          'DEM':args.N_target_DEM},
             firn_directory=args.firn_directory,\
             firn_version=args.firn_version,\
             firn_correction=args.firn_model,\
+            firn_cache_dir=args.firn_cache_dir,\
             firn_fixed=args.firn_fixed,\
             firn_rescale=args.firn_rescale,\
             lagrangian=args.lagrangian,\
             velocity_files=args.velocity_files,\
             lagrangian_epoch=args.lagrangian_epoch,\
             lagrangian_ref_dem=args.lagrangian_ref_dem,\
+            lagrangian_cache_dir=args.lagrangian_cache_dir,\
+            lagrangian_workers=args.lagrangian_workers,\
+            lagrangian_fast=args.lagrangian_fast,\
+            lagrangian_fast_tol=args.lagrangian_fast_tol,\
+            velocity_region_size=args.velocity_region_size,\
             mask_file=args.mask_file, \
             DEM_file=args.DEM_file,\
             geoid_file=args.geoid_file,\
@@ -755,28 +1291,110 @@ def main(argv):
             E_slope_bias=args.E_slope_bias, \
             water_mask_threshold=args.water_mask_threshold, \
             year_mask_dir=args.year_mask_dir, \
+            year_mask_cube=args.year_mask_cube, \
             tide_directory=args.tide_directory, \
             tide_mask_file=args.tide_mask_file, \
             tide_model=args.tide_model, \
+            tide_cache_dir=args.tide_cache_dir, \
+            tide_lattice_spacing=args.tide_lattice_spacing, \
+            tide_lattice_tol=args.tide_lattice_tol, \
             avg_mask_directory=args.avg_mask_directory, \
             dzdt_lags=args.dzdt_lags, \
             avg_scales=args.avg_scales,\
             DEM_grid_bias_params=DEM_bias_params)
 
+    # threads is -1 if the number in effect is not known
+    S.setdefault('timing', {}).update({'threads':n_active if n_active is not None else -1,
+                                      'threads_requested':n_threads, 'thread_mode':thread_mode})
     if args.calc_error_file is None:
         save_fit_to_file(S, args.out_name, sensor_dict=sensor_dict,\
                          dzdt_lags=S['dzdt_lags'], \
-                         reference_epoch=args.reference_epoch)
+                         reference_epoch=args.reference_epoch,\
+                         output_profile=args.output_profile)
     else:
         S['E']['sigma_z0']=interp_ds(S['E']['sigma_z0'], args.error_res_scale[0])
         for field in S['E'].keys():
             if 'sigma_dz' in field: # ['sigma_dz', 'sigma_dzdt_lag1', 'sigma_dzdt_lag2', 'sigma_dzdt_lag4']:
                 S['E'][field] = interp_ds( S['E'][field], args.error_res_scale[1] )
-        save_errors_to_file(S, args.out_name)
+        save_errors_to_file(S, args.out_name, output_profile=args.output_profile)
+    if args.timing_json is not None:
+        S['stage_timer'].write_json(args.timing_json, extra={'fit':S['timing']})
+    if args.run_db is not None and args.calc_error_file is None:
+        run=S['run_size']
+        run_database(args.run_db).record(tile=os.path.basename(args.out_name).replace('.h5',''),
+            N_data=run['N_data'], N_unknowns=run['N_unknowns'],
+            wall=time.time()-t_start, fit_wall=S['stage_timer'].records.get('fit', {}).get('wall'),
+            N_target_laser=(run.get('N_target') or {}).get('laser'),
+            N_target_DEM=(run.get('N_target') or {}).get('DEM'),
+            bm_scale_laser=(run.get('bm_scale') or {}).get('laser'),
+            bm_scale_DEM=(run.get('bm_scale') or {}).get('DEM'))
 
     print("done with " + args.out_name)
     total_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +\
         resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
     print(f"peak memory usage (kB)={total_memory}")
+
+def batch_args(line):
+    '''
+    Get the fit_altimetry arguments from one line of a batch or queue file.
+
+    Lines may be bare argument lists, or commands (possibly preceded by an
+    environment setup and ';') that run fit_altimetry.py.  Blank lines and
+    comments return None.
+    '''
+    line=line.strip()
+    if len(line)==0 or line[0]=='#':
+        return None
+    for cmd in line.split(';'):
+        tokens=shlex.split(cmd)
+        for ii, token in enumerate(tokens):
+            if os.path.basename(token).startswith('fit_altimetry'):
+                return tokens[ii+1:]
+    return shlex.split(line.split(';')[-1])
+
+def batch_main(argv):
+    '''
+    Fit a list of tiles, one after another, in one process.
+
+    Each line of the batch file gives the arguments for one tile (see
+    batch_args); arguments on the command line other than the batch
+    options are appended to every tile's arguments.  Module-level caches
+    (tide predictors, firn cubes) stay loaded between tiles, while each
+    tile gets its own arguments, memory limit, and error handling.
+    '''
+    import argparse
+    parser=argparse.ArgumentParser(description="fit a list of tiles in one process",
+                                   fromfile_prefix_chars="@")
+    parser.add_argument('--batch_file', type=str, required=True, help='file containing one set of fit_altimetry arguments (or one queue command) per line')
+    parser.add_argument('--worker', type=int, nargs=2, default=[0, 1], help='worker index and number of workers: this worker fits lines index, index+N, index+2N, ...')
+    batch_args_in, extra_args = parser.parse_known_args(argv[1:])
+    with open(batch_args_in.batch_file,'r') as fh:
+        lines=[batch_args(line) for line in fh]
+    tile_args=[args for args in lines if args is not None]
+    index, N_workers = batch_args_in.worker
+    tile_args=tile_args[index::N_workers]
+
+    failed=[]
+    for count, args in enumerate(tile_args):
+        tile_argv=[argv[0]]+args+extra_args
+        print(f"fit_altimetry batch: tile {count+1} of {len(tile_args)}: {' '.join(args)}")
+        tic=time.time()
+        try:
+            main(tile_argv)
+        except (Exception, SystemExit):
+            # argparse errors and sys.exit calls in a tile must not stop the batch
+            traceback.print_exc()
+            failed += [' '.join(args)]
+        finally:
+            # release the tile's data before starting the next one
+            gc.collect()
+        print(f"fit_altimetry batch: tile {count+1} took {time.time()-tic:0.1f} s")
+    print(f"fit_altimetry batch: {len(tile_args)-len(failed)} tiles succeeded, {len(failed)} failed")
+    for args in failed:
+        print("\tfailed: "+args)
+    return len(failed)
+
 if __name__=='__main__':
+    if '--batch_file' in sys.argv:
+        sys.exit(batch_main(sys.argv) > 0)
     main(sys.argv)
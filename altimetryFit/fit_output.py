@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single-handle writer for fit_altimetry output files.
+
+Writing each grid with pc.grid.data.to_h5 reopens the output file once per
+grid.  fit_output_writer keeps one h5py handle open for the whole save and
+writes grids with the same layout as to_h5 (coordinates in 'x', 'y' and
+'t' or 'time', one dataset per field), with field datasets chunked in
+(y, x) tiles that span the full time axis, matching the windowed reads
+used when the tiles are mosaicked.
+
+Two output profiles are available:
+    'default' : fields are written with the dtype of the fit (float64),
+        grid fields are gzip-compressed
+    'compact' : grid fields and floating-point data fields are written as
+        float32 with the shuffle filter and lzf compression.  The categorical
+        data fields (sensor, rgt, cycle, spot, BP, day) are written as the
+        integer types in categorical_dtypes, with NaN values (e.g. rgt for
+        DEM data) written as categorical_fill, which is also stored in the
+        dataset's _FillValue attribute.  Coordinates and times (x, y, z,
+        time, time_corr) are kept as float64.  The layout depends only on
+        the fields, so it is the same for every tile.
+"""
+
+import numpy as np
+import h5py
+
+profiles=['default', 'compact']
+
+# data fields that are always written at full precision
+full_precision_fields=['x', 'y', 'z', 'time', 'time_corr']
+
+# integer types for the categorical data fields in the compact profile
+categorical_dtypes={'sensor':np.int32, 'rgt':np.int16, 'cycle':np.int16,
+                    'spot':np.int8, 'BP':np.int8, 'day':np.int32}
+# value written for NaN in a categorical field
+categorical_fill=-1
+
+def encode_categorical(field, data):
+    '''
+    Convert a categorical field to its integer type, with NaN written as categorical_fill
+    '''
+    dtype=categorical_dtypes[field]
+    good=np.isfinite(data)
+    if np.any(data[good] != np.round(data[good])) or \
+        np.any(data[good] < np.iinfo(dtype).min) or np.any(data[good] > np.iinfo(dtype).max) or \
+        np.any(data[good]==categorical_fill):
+        raise ValueError(f"{field} values cannot be written as {np.dtype(dtype).name}")
+    out=np.zeros(data.shape, dtype=dtype)+categorical_fill
+    out[good]=data[good]
+    return out
+
+def decode_categorical(data):
+    '''
+    Convert the integer-coded categorical fields of a pc.data object read
+    from a compact output file to float64, with NaN for categorical_fill
+    '''
+    for field in categorical_dtypes:
+        if field not in data.fields:
+            continue
+        val=getattr(data, field)
+        if not np.issubdtype(val.dtype, np.integer):
+            continue
+        val=val.astype(np.float64)
+        val[val==categorical_fill]=np.nan
+        setattr(data, field, val)
+    return data
+
+class fit_output_writer(object):
+    '''
+    Writer that holds one handle on an output file
+
+    Parameters
+    ----------
+    filename : str
+        output file
+    mode : str, optional
+        h5py file mode.  The default is 'w'.
+    chunk_size : int, optional
+        maximum size of the chunks in the x and y dimensions.  The default is 256.
+    profile : str, optional
+        output profile, 'default' or 'compact'.  The default is 'default'.
+    '''
+    def __init__(self, filename, mode='w', chunk_size=256, profile='default'):
+        if profile not in profiles:
+            raise ValueError(f"unknown output profile: {profile}")
+        self.filename=filename
+        self.mode=mode
+        self.chunk_size=chunk_size
+        self.profile=profile
+        self.h5f=None
+
+    def __enter__(self):
+        self.h5f=h5py.File(self.filename, self.mode)
+        return self
+
+    def __exit__(self, *args):
+        self.h5f.close()
+        self.h5f=None
+
+    def write_array(self, name, data, **kwargs):
+        '''
+        Write an array to a dataset, replacing it if it exists
+        '''
+        if name in self.h5f:
+            del self.h5f[name]
+        return self.h5f.create_dataset(name, data=data, **kwargs)
+
+    def grid_chunks(self, shape):
+        '''
+        Chunk shape for a grid field: (y, x) tiles, full extent in other dimensions
+        '''
+        if len(shape) < 2:
+            return None
+        return tuple([min(self.chunk_size, shape[0]), min(self.chunk_size, shape[1])] + list(shape[2:]))
+
+    def write_grid(self, ds, group):
+        '''
+        Write a pc.grid.data object to a group
+        '''
+        if group[0] != '/':
+            group='/'+group
+        grp=self.h5f.require_group(group)
+        for attr in ['srs_proj4', 'srs_wkt', 'srs_epsg']:
+            if getattr(ds, attr, None) is not None:
+                grp.attrs[attr]=getattr(ds, attr)
+        # coordinates are written without compression
+        for field in ['x', 'y', 'time', 't']:
+            if field in ds.fields or getattr(ds, field, None) is None:
+                continue
+            self.write_array(group+'/'+field, np.asarray(getattr(ds, field)))
+        for field in ds.fields:
+            data=np.asarray(getattr(ds, field))
+            if field in ['x', 'y', 'time', 't'] or data.ndim < 2:
+                self.write_array(group+'/'+field, data)
+                continue
+            if self.profile=='compact':
+                self.write_array(group+'/'+field, data.astype(np.float32),
+                                 chunks=self.grid_chunks(data.shape),
+                                 shuffle=True, compression='lzf')
+            else:
+                self.write_array(group+'/'+field, data, chunks=self.grid_chunks(data.shape),
+                                 compression='gzip')
+
+    def write_data_field(self, name, data):
+        '''
+        Write a point-data field
+        '''
+        data=np.asarray(data)
+        if self.profile != 'compact' or data.ndim != 1:
+            return self.write_array(name, data)
+        field=name.split('/')[-1]
+        kwargs={}
+        if data.size > 0:
+            kwargs=dict(shuffle=True, compression='lzf', chunks=(min(data.size, 65536),))
+        if field in categorical_dtypes:
+            dset=self.write_array(name, encode_categorical(field, data), **kwargs)
+            dset.attrs['_FillValue']=np.array(categorical_fill, dtype=categorical_dtypes[field])
+            return dset
+        if field not in full_precision_fields and np.issubdtype(data.dtype, np.floating):
+            data=data.astype(np.float32)
+        return self.write_array(name, data, **kwargs)
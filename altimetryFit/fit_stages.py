@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stage runner with content-hashed, optionally persisted stage outputs.
+
+The data preparation in fit_altimetry is split into a chain of stages
+(read, tides, lagrangian, firn, edits).  Each stage has a key that is the
+hash of the stage name, its parameters (with input files identified by
+path, size and modification time), and the key of the previous stage, so
+a change to any upstream parameter invalidates all later stages.  If a
+cache directory is given, the data output by each stage are written to an
+hdf5 file named by the key, and a rerun resumes from the last stage whose
+output is found.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import h5py
+import pointCollection as pc
+from altimetryFit.stage_timer import timed
+
+def file_id(filename):
+    '''
+    Identify a file by its path, size, and modification time
+    '''
+    if filename is None or not isinstance(filename, str) or not os.path.exists(filename):
+        return filename
+    stat=os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, int(stat.st_mtime)]
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+class fit_stages(object):
+    '''
+    Chain of data-preparation stages
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        directory in which stage outputs are stored.  If None, stages are
+        always run and nothing is written.
+    tile : str, optional
+        name used as a prefix for the cache files (e.g. E-200_N-1000)
+    '''
+    def __init__(self, cache_dir=None, tile='tile'):
+        self.cache_dir=cache_dir
+        self.tile=tile
+        self.key=''
+        self.log=[]
+
+    def stage_key(self, stage, params):
+        params_str=json.dumps(params, sort_keys=True, default=_json_default)
+        return hashlib.sha1((self.key+stage+params_str).encode('utf-8')).hexdigest()[:16]
+
+    def filename(self, stage, key):
+        return os.path.join(self.cache_dir, f'{self.tile}_{stage}_{key}.h5')
+
+    def read(self, filename):
+        '''
+        Read a stage output: a pc.data object and a dictionary of metadata
+        '''
+        with h5py.File(filename,'r') as h5f:
+            meta=json.loads(h5f.attrs['meta'])
+            if 'data' not in h5f:
+                return None, meta
+            fields={}
+            for key in h5f['data'].attrs['fields']:
+                key=key.decode('utf-8') if isinstance(key, bytes) else str(key)
+                fields[key]=np.array(h5f['data'][key])
+        return pc.data().from_dict(fields), meta
+
+    def write(self, filename, data, meta):
+        '''
+        Write a stage output to a temporary file, then move it into place
+        '''
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        temp_file=filename+'.%d.tmp' % os.getpid()
+        with h5py.File(temp_file,'w') as h5f:
+            h5f.attrs['meta']=json.dumps(meta, default=_json_default)
+            if data is not None:
+                grp=h5f.create_group('data')
+                grp.attrs['fields']=list(data.fields)
+                for field in data.fields:
+                    grp.create_dataset(field, data=getattr(data, field))
+        os.replace(temp_file, filename)
+
+    def run(self, stages, data=None, meta=None, timer=None):
+        '''
+        Run a chain of stages, resuming after the last stage whose output is cached.
+
+        Parameters
+        ----------
+        stages : list
+            (name, params, fn, enabled) for each stage.  params is a dict
+            of everything other than the input data that the stage output
+            depends on, and fn is a function of (data, meta) that returns
+            the stage's (data, meta).  Disabled stages are not run, but are
+            included in the keys of later stages.
+        data : pc.data, optional
+            input data for the first stage
+        meta : dict, optional
+            json-serializable metadata passed from stage to stage
+        timer : altimetryFit.stage_timer, optional
+            if provided, each stage that is run is timed under its name
+
+        Returns
+        -------
+        data, meta : outputs of the last stage
+        '''
+        if meta is None:
+            meta={}
+        self.key=''
+        keys=[]
+        for name, params, fn, enabled in stages:
+            if not enabled:
+                params={'enabled':False}
+            self.key=self.stage_key(name, params)
+            keys += [self.key]
+        # find the last stage with a readable cached output
+        start=0
+        if self.cache_dir is not None:
+            for ii in range(len(stages)-1, -1, -1):
+                if not stages[ii][3]:
+                    continue
+                filename=self.filename(stages[ii][0], keys[ii])
+                if not os.path.isfile(filename):
+                    continue
+                try:
+                    with timed(timer, 'stage_cache_read'):
+                        data, meta = self.read(filename)
+                except (OSError, KeyError, ValueError) as e:
+                    print(f"fit_stages: could not read {filename}: {e}")
+                    continue
+                print(f"fit_stages: resuming after stage {stages[ii][0]} from {filename}")
+                self.log += [(stage[0], 'cached' if stage[3] else 'disabled') for stage in stages[:ii+1]]
+                start=ii+1
+                break
+        for (name, params, fn, enabled), key in zip(stages[start:], keys[start:]):
+            if not enabled:
+                self.log += [(name, 'disabled')]
+                continue
+            with timed(timer, name):
+                data, meta = fn(data, meta)
+            self.log += [(name, 'run')]
+            if self.cache_dir is not None:
+                try:
+                    with timed(timer, 'stage_cache_write'):
+                        self.write(self.filename(name, key), data, meta)
+                except OSError as e:
+                    print(f"fit_stages: could not write output for stage {name}: {e}")
+        return data, meta
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Helper functions for the Lagrangian mode of fit_altimetry.
+
+The displacement fields that setup_lagrangian calculates for the output
+grid depend only on the tile geometry, the grid spacing, the time span,
+the velocity files and the Lagrangian epoch.  They are cached on disk under
+a hash of those inputs, and, when they need to be calculated, the grid
+nodes are split between worker processes that advect them independently.
+Velocity time series are read only for a window around the tile, and the
+gap-filled velocity windows are cached for each region.
+"""
+
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import h5py
+import pointCollection as pc
+
+# advection object shared with forked worker processes
+_adv=None
+
+def displacement_cache_file(cache_dir, xy0=None, Wxy=None, spacing=None, t_span=None,
+                            velocity_files=None, lagrangian_epoch=None):
+    '''
+    Make the name of the displacement-cache file for a set of inputs.  The
+    velocity files are identified by their path, size and modification time.
+    '''
+    file_info=[]
+    for file in velocity_files:
+        file_info += [[os.path.abspath(file), os.path.getsize(file), os.path.getmtime(file)]]
+    key=json.dumps({'xy0':[float(ii) for ii in xy0],
+                    'Wxy':float(Wxy),
+                    'dz':float(spacing['dz']),
+                    'dt':float(spacing['dt']),
+                    't_span':[float(ii) for ii in t_span],
+                    'velocity_files':file_info,
+                    'lagrangian_epoch':float(lagrangian_epoch)}, sort_keys=True)
+    return os.path.join(cache_dir, 'E%d_N%d_%s.h5' % (xy0[0]/1000, xy0[1]/1000,
+                                    hashlib.sha1(key.encode()).hexdigest()[0:16]))
+
+def read_displacement_cache(filename):
+    with h5py.File(filename,'r') as h5f:
+        return np.array(h5f['dx']), np.array(h5f['dy']), np.array(h5f['bounds'])
+
+def write_displacement_cache(filename, dx, dy, bounds):
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_file=filename+'.%d.tmp' % os.getpid()
+    with h5py.File(temp_file,'w') as h5f:
+        h5f.create_dataset('dx', data=dx, compression='gzip')
+        h5f.create_dataset('dy', data=dy, compression='gzip')
+        h5f.create_dataset('bounds', data=bounds)
+    os.replace(temp_file, filename)
+
+def advect_parcels(adv, x, y, t_ctrs, lagrangian_epoch, method):
+    '''
+    Advect a set of parcels from the Lagrangian epoch to each output time.
+    Each time step starts from the positions at the previous time.
+
+    Returns
+    -------
+    x_out, y_out : numpy arrays
+        parcel positions, one column for each time in t_ctrs
+    '''
+    adv.x=np.copy(x)
+    adv.y=np.copy(y)
+    adv.t=np.zeros_like(x)
+    x_out=np.zeros((x.size, len(t_ctrs)))
+    y_out=np.zeros((x.size, len(t_ctrs)))
+    for i, ctrs in enumerate(t_ctrs):
+        # advect points to output grid time
+        t0 = (ctrs - lagrangian_epoch)*24*3600*365.25
+        adv.translate_parcel(integrator='RK4', method=method, t0=t0)
+        x_out[:,i]=adv.x0
+        y_out[:,i]=adv.y0
+        # update coordinates to advect to next field
+        # without recomputing advection from original point
+        adv.x[:] = np.copy(adv.x0)
+        adv.y[:] = np.copy(adv.y0)
+        adv.t[:] = np.copy(t0)
+    return x_out, y_out
+
+def _advect_chunk(args):
+    return advect_parcels(_adv, *args)
+
+def advect_grid(adv, gridx, gridy, t_ctrs, lagrangian_epoch, method, bounds, workers=1):
+    '''
+    Calculate the displacements of a grid of parcels at each output time.
+
+    Parameters
+    ----------
+    adv : pointAdvection.advection
+        advection object containing the velocity fields
+    gridx, gridy : numpy arrays
+        grid-node coordinates at the Lagrangian epoch
+    t_ctrs : numpy array
+        output times (decimal years)
+    lagrangian_epoch : float
+        epoch (decimal year) at which parcels are at the grid nodes
+    method : str
+        velocity interpolation method
+    bounds : numpy array
+        bounds of the original grid, [[xmin, xmax], [ymin, ymax]]
+    workers : int, optional
+        number of processes among which the grid nodes are divided.
+        The default is 1.
+
+    Returns
+    -------
+    dx, dy : numpy arrays
+        displacements from the grid nodes, shape gridx.shape + (len(t_ctrs),)
+    bounds : numpy array
+        bounds of the original and advected coordinates
+    '''
+    global _adv
+    x=gridx.ravel()
+    y=gridy.ravel()
+    if workers is None or workers <= 1:
+        x_out, y_out = advect_parcels(adv, x, y, t_ctrs, lagrangian_epoch, method)
+    else:
+        # parcels are independent: divide the grid nodes between forked workers
+        _adv=adv
+        chunks=np.array_split(np.arange(x.size), workers)
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            results=pool.map(_advect_chunk, [(x[ii], y[ii], t_ctrs, lagrangian_epoch, method)
+                                             for ii in chunks])
+        _adv=None
+        x_out=np.concatenate([result[0] for result in results], axis=0)
+        y_out=np.concatenate([result[1] for result in results], axis=0)
+    shape=list(gridx.shape)+[len(t_ctrs)]
+    dx=np.reshape(x_out, shape) - gridx[:,:,None]
+    dy=np.reshape(y_out, shape) - gridy[:,:,None]
+    bounds=np.array(bounds, dtype=float)
+    if np.any(np.isfinite(x_out)):
+        bounds[0][0] = np.min([bounds[0][0], np.nanmin(x_out)])
+        bounds[0][1] = np.max([bounds[0][1], np.nanmax(x_out)])
+    if np.any(np.isfinite(y_out)):
+        bounds[1][0] = np.min([bounds[1][0], np.nanmin(y_out)])
+        bounds[1][1] = np.max([bounds[1][1], np.nanmax(y_out)])
+    return dx, dy, bounds
+
+def velocity_window_bounds(xy0, Wxy, buffer, region_size=None):
+    '''
+    Find the bounds of the velocity window needed for a tile.  If region_size
+    is specified, the tile bounds are rounded out to multiples of region_size,
+    so that neighboring tiles share the same window.
+    '''
+    bounds=[]
+    for ii in [0, 1]:
+        bds=xy0[ii]+np.array([-0.5, 0.5])*Wxy
+        if region_size is not None:
+            bds=np.array([np.floor(bds[0]/region_size), np.ceil(bds[1]/region_size)])*region_size
+        bounds += [bds+np.array([-1, 1])*buffer]
+    return bounds
+
+def NSIDC_times(ds):
+    '''
+    Decimal-year times of an NSIDC velocity time series
+    '''
+    return np.array(ds.time.data-np.datetime64('2000-01-01'),
+                    dtype='timedelta64[s]').astype(float)/24./3600./365.25 + 2000
+
+def read_NSIDC_velocity(filename):
+    '''
+    Read a whole NSIDC velocity time series, in the format expected by pointAdvection.advection.from_dict
+    '''
+    import xarray as xr
+    with xr.open_dataset(filename) as ds:
+        # y is stored in decreasing order
+        return {'x':np.array(ds.x),
+                'y':np.array(ds.y)[::-1],
+                'U':np.array(ds.VelocitySeries[:, 0, ::-1,:]),
+                'V':np.array(ds.VelocitySeries[:, 1, ::-1,:]),
+                'eU':np.array(ds.VelocitySeries[:, 3, ::-1,:]),
+                'eV':np.array(ds.VelocitySeries[:, 4, ::-1,:]),
+                'time':NSIDC_times(ds)}
+
+def read_NSIDC_velocity_window(filename, xy0, Wxy, t_span, lagrangian_epoch,
+                               region_size=None, max_reads=3):
+    '''
+    Read the part of an NSIDC velocity time series needed to advect a tile.
+
+    The window starts with a buffer of Wxy/2 around the tile.  The buffer is
+    then set to twice the largest displacement implied by the maximum speed
+    in the window and the time between t_span and the Lagrangian epoch, and
+    the window is re-read until the buffer stops growing.
+
+    Returns
+    -------
+    velocity : dict
+        velocity fields, in the format expected by pointAdvection.advection.from_dict,
+        or None if the window contains no velocity pixels
+    bounds : list
+        x and y bounds of the window that was read
+    '''
+    import xarray as xr
+    max_dt=np.max(np.abs(np.array(t_span)-lagrangian_epoch))
+    buffer=Wxy/2
+    with xr.open_dataset(filename) as ds:
+        x=np.array(ds.x)
+        y=np.array(ds.y)
+        for count in range(max_reads):
+            bounds=velocity_window_bounds(xy0, Wxy, buffer, region_size=region_size)
+            ix=np.flatnonzero((x >= bounds[0][0]) & (x <= bounds[0][1]))
+            iy=np.flatnonzero((y >= bounds[1][0]) & (y <= bounds[1][1]))
+            if ix.size==0 or iy.size==0:
+                print(f'no velocity pixels in the window {bounds} of {filename}')
+                return None, bounds
+            # U, V, eU, eV bands, for the window only
+            temp=np.array(ds.VelocitySeries[:, [0, 1, 3, 4], iy[0]:iy[-1]+1, ix[0]:ix[-1]+1])
+            max_speed=np.nanmax(np.sqrt(temp[:,0,:,:]**2+temp[:,1,:,:]**2))
+            needed_buffer=2*max_speed*max_dt
+            if not np.isfinite(needed_buffer) or needed_buffer <= buffer or count==max_reads-1:
+                break
+            buffer=needed_buffer
+        time=NSIDC_times(ds)
+    print(f'read velocity window of {ix.size}x{iy.size} pixels, buffer={buffer:0.0f} m')
+    # y is stored in decreasing order
+    velocity={'x':x[ix[0]:ix[-1]+1],
+              'y':y[iy[0]:iy[-1]+1][::-1],
+              'U':temp[:, 0, ::-1, :],
+              'V':temp[:, 1, ::-1, :],
+              'eU':temp[:, 2, ::-1, :],
+              'eV':temp[:, 3, ::-1, :],
+              'time':time}
+    return velocity, bounds
+
+def velocity_cache_file(cache_dir, velocity_files, xy0, Wxy, t_span, lagrangian_epoch, region_size=None):
+    '''
+    Make the name of the cache file for a gap-filled velocity window.
+    '''
+    file_info=[]
+    for file in velocity_files:
+        file_info += [[os.path.abspath(file), os.path.getsize(file), os.path.getmtime(file)]]
+    if region_size is not None:
+        # tiles in the same region share a window
+        xy_key=[np.floor((xy0[ii]-Wxy/2)/region_size)*region_size for ii in [0, 1]]+\
+            [np.ceil((xy0[ii]+Wxy/2)/region_size)*region_size for ii in [0, 1]]
+    else:
+        xy_key=[xy0[0], xy0[1], Wxy]
+    key=json.dumps({'velocity_files':file_info,
+                    'xy':[float(ii) for ii in xy_key],
+                    'region_size':region_size,
+                    't_span':[float(ii) for ii in t_span],
+                    'lagrangian_epoch':float(lagrangian_epoch)}, sort_keys=True)
+    return os.path.join(cache_dir, 'velocity_%s.h5' % hashlib.sha1(key.encode()).hexdigest()[0:16])
+
+def write_velocity_cache(filename, velocity, method):
+    '''
+    Write a gap-filled velocity grid (pc.grid.data) and its time axis to a cache file.
+    '''
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    temp_file=filename+'.%d.tmp' % os.getpid()
+    velocity.to_h5(temp_file, group='velocity', replace=True)
+    with h5py.File(temp_file,'r+') as h5f:
+        h5f['velocity'].attrs['method']=method
+        h5f['velocity'].attrs['t_axis']=velocity.t_axis
+    os.replace(temp_file, filename)
+
+def read_velocity_cache(filename):
+    '''
+    Read a gap-filled velocity grid and the interpolation method from a cache file.
+    '''
+    with h5py.File(filename,'r') as h5f:
+        method=h5f['velocity'].attrs['method']
+        if isinstance(method, bytes):
+            method=method.decode()
+        t_axis=int(h5f['velocity'].attrs['t_axis'])
+    velocity=pc.grid.data(t_axis=t_axis).from_h5(filename, group='velocity')
+    # the arrays are stored in their original order, so the time axis is not changed on reading
+    velocity.t_axis=t_axis
+    return velocity, method
+
+def interp_cube(cube, grid_x, grid_y, grid_t, x, y, t):
+    '''
+    Trilinear interpolation of a (y, x, t) cube defined on regular axes.
+    Points outside the cube are assigned NaN.
+    '''
+    result=np.zeros_like(x, dtype=np.float64)+np.nan
+    axes=[grid_y, grid_x, grid_t]
+    f=[]
+    inside=np.isfinite(x) & np.isfinite(y) & np.isfinite(t)
+    for axis, coord in zip(axes, [y, x, t]):
+        if axis.size > 1:
+            fi=(coord-axis[0])/(axis[1]-axis[0])
+        else:
+            fi=np.zeros_like(coord)
+            inside &= coord==axis[0]
+        inside &= (fi >= 0) & (fi <= axis.size-1)
+        f += [fi]
+    if not np.any(inside):
+        return result
+    i0=[]
+    w=[]
+    for fi, axis in zip(f, axes):
+        ii=np.clip(np.floor(fi[inside]).astype(int), 0, np.maximum(axis.size-2, 0))
+        i0 += [ii]
+        w += [fi[inside]-ii]
+    temp=np.zeros(np.sum(inside))
+    for dy in [0, 1]:
+        for dx in [0, 1]:
+            for dt in [0, 1]:
+                wt=(w[0] if dy else 1-w[0])*(w[1] if dx else 1-w[1])*(w[2] if dt else 1-w[2])
+                if not np.any(wt > 0):
+                    continue
+                ind=[np.minimum(i0[0]+dy, cube.shape[0]-1),
+                     np.minimum(i0[1]+dx, cube.shape[1]-1),
+                     np.minimum(i0[2]+dt, cube.shape[2]-1)]
+                temp += wt*cube[ind[0], ind[1], ind[2]]
+    result[inside]=temp
+    return result
+
+def displacement_interp_error(dx, dy):
+    '''
+    Estimate the error of linear interpolation of the displacement cubes
+    at each node, as one eighth of the largest second difference of
+    either displacement component along any axis.
+    '''
+    err=np.zeros(dx.shape)
+    for D in [dx, dy]:
+        for axis in range(3):
+            if D.shape[axis] < 3:
+                continue
+            d2=np.abs(np.diff(D, n=2, axis=axis))/8
+            # assign the second differences to the central nodes, and
+            # copy them to the edge nodes
+            pad=[(0, 0)]*3
+            pad[axis]=(1, 1)
+            err=np.fmax(err, np.pad(d2, pad, mode='edge'))
+    return err
+
+def fast_lagrangian_positions(x, y, time, dx=None, dy=None, grid_x=None, grid_y=None,
+                              grid_t=None, tol=5., N_iterations=5):
+    '''
+    Find the positions of data points at the Lagrangian epoch by interpolating
+    precomputed displacement cubes, instead of advecting each point.
+
+    The cubes give the displacement, at each grid time, of parcels that were
+    at the grid nodes at the epoch, so the epoch position x_e of a point
+    observed at x satisfies x_e + D(x_e, t) = x.  This is solved by fixed-point
+    iteration.
+
+    Parameters
+    ----------
+    x, y, time : numpy arrays
+        data coordinates and times (decimal years)
+    dx, dy : numpy arrays
+        displacement cubes, dimensions (y, x, t)
+    grid_x, grid_y, grid_t : numpy arrays
+        axes of the displacement cubes
+    tol : float, optional
+        points whose estimated interpolation error exceeds this (m), that
+        do not converge, or that are outside the cubes, are flagged for
+        exact advection.  The default is 5.
+    N_iterations : int, optional
+        number of fixed-point iterations.  The default is 5.
+
+    Returns
+    -------
+    x_e, y_e : numpy arrays
+        estimated positions at the epoch
+    needs_exact : numpy array
+        boolean array, true for points that should be advected exactly
+    '''
+    x_e=x.copy()
+    y_e=y.copy()
+    for count in range(N_iterations):
+        x_e = x - interp_cube(dx, grid_x, grid_y, grid_t, x_e, y_e, time)
+        y_e = y - interp_cube(dy, grid_x, grid_y, grid_t, x_e, y_e, time)
+    residual=np.sqrt((x_e + interp_cube(dx, grid_x, grid_y, grid_t, x_e, y_e, time) - x)**2 +
+                     (y_e + interp_cube(dy, grid_x, grid_y, grid_t, x_e, y_e, time) - y)**2)
+    err=interp_cube(displacement_interp_error(dx, dy), grid_x, grid_y, grid_t, x_e, y_e, time)
+    needs_exact = ~np.isfinite(x_e+y_e+err+residual) | (err > tol) | (residual > tol)
+    return x_e, y_e, needs_exact
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Predict the peak memory use of a fit, and downsize the inputs to fit a budget.
+
+The peak memory of smooth_xytb_fit_aug is dominated by the design matrix,
+which grows with the number of data, and by the factorization of the
+normal equations, which grows a little faster than linearly with the
+number of unknowns (z0 and dz grid nodes, and bias parameters).  The
+estimate is
+
+    base + per_datum*N_data + per_unknown*N + fill*N*log2(N)
+
+where N is the number of unknowns.  The coefficients are rough, and can be
+replaced by values calibrated from completed runs.
+"""
+
+import os
+import numpy as np
+
+default_coefficients={'base':1.5e9, 'per_datum':1500., 'per_unknown':2000., 'fill':100.}
+
+def grid_node_counts(Wxy, t_span, spacing):
+    '''
+    Number of z0 nodes and of dz nodes (in x, y, and time) for a fit
+    '''
+    N_z0=int(np.round(Wxy/spacing['z0'])+1)**2
+    N_t=int(np.round((t_span[1]-t_span[0])/spacing['dt'])+1)
+    N_dz=int(np.round(Wxy/spacing['dz'])+1)**2*N_t
+    return N_z0, N_dz
+
+def count_data(sensor, laser_sensors, N_fit=None):
+    '''
+    Number of data of each type ('laser', 'DEM'), limited to N_fit if the
+    data are to be thinned to N_fit before the fit
+    '''
+    laser=np.in1d(sensor, laser_sensors)
+    N_data={'laser':int(np.sum(laser)), 'DEM':int(np.sum(~laser))}
+    if N_fit is not None:
+        for key in N_data:
+            if N_fit.get(key) is not None:
+                N_data[key]=int(min(N_data[key], N_fit[key]))
+    return N_data
+
+def count_bias_params(sensor, time, laser_sensors, delta_t=10/(24*3600*365.25), time_corr=None):
+    '''
+    Approximate number of bias parameters: one per laser sensor per delta_t
+    (as in assign_sigma_corr), or per time_corr value if time_corr is
+    given, and one per DEM
+    '''
+    laser=np.in1d(sensor, laser_sensors)
+    if time_corr is None:
+        time_corr=np.floor(time/delta_t)
+    N_laser=np.unique(np.c_[sensor[laser], time_corr[laser]], axis=0).shape[0] \
+        if np.any(laser) else 0
+    return N_laser + np.unique(sensor[~laser]).size
+
+def estimate_peak_memory(N_data, N_z0, N_dz, N_bias, coefficients=None):
+    '''
+    Estimate the peak memory (bytes) used by a fit
+    '''
+    c=default_coefficients.copy()
+    if coefficients is not None:
+        c.update(coefficients)
+    N=N_z0+N_dz+N_bias
+    return c['base'] + c['per_datum']*N_data + c['per_unknown']*N + c['fill']*N*np.log2(max(N, 2))
+
+def current_rss():
+    '''
+    Resident memory of this process (bytes), or zero if it cannot be read
+    '''
+    try:
+        with open('/proc/self/statm','r') as fh:
+            return int(fh.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def plan_inputs(N_data, N_z0, N_dz, N_bias, budget, N_target=None, bm_scale=None,
+                coefficients=None, margin=0.9):
+    '''
+    Check a fit against a memory budget, and find reduced input sizes if needed.
+
+    Parameters
+    ----------
+    N_data : dict
+        number of data read for each type ('laser', 'DEM')
+    N_z0, N_dz, N_bias : int
+        numbers of z0 nodes, dz nodes and bias parameters
+    budget : float
+        memory available for the fit (bytes)
+    N_target, bm_scale : dict, optional
+        current maximum data counts and blockmedian scales for each data type
+    coefficients : dict, optional
+        memory-model coefficients, see estimate_peak_memory
+    margin : float, optional
+        the reduced inputs are chosen to use this fraction of the budget.
+        The default is 0.9.
+
+    Returns
+    -------
+    plan : dict
+        estimate, budget, and (if the budget is exceeded) the data fraction
+        and the new N_target and bm_scale values
+    '''
+    N_total=np.sum([N_data[key] for key in N_data])
+    estimate=estimate_peak_memory(N_total, N_z0, N_dz, N_bias, coefficients=coefficients)
+    plan={'estimate':estimate, 'budget':budget, 'N_data':int(N_total), 'N_z0':N_z0,
+          'N_dz':N_dz, 'N_bias':int(N_bias), 'fits':bool(estimate <= budget)}
+    if plan['fits'] or N_total==0:
+        return plan
+    # the data-dependent part of the estimate has to shrink to fit
+    fixed=estimate_peak_memory(0, N_z0, N_dz, N_bias, coefficients=coefficients)
+    fraction=(margin*budget-fixed)/(estimate-fixed)
+    plan['fraction']=float(np.clip(fraction, 0.05, 1))
+    plan['N_target']={key:int(plan['fraction']*N_data[key]) for key in N_data}
+    if N_target is not None:
+        for key in plan['N_target']:
+            if N_target.get(key) is not None:
+                plan['N_target'][key]=int(min(plan['N_target'][key], N_target[key]))
+    if bm_scale is not None:
+        # point density scales as the inverse square of the blockmedian scale
+        plan['bm_scale']={key:bm_scale[key]/np.sqrt(plan['fraction']) for key in bm_scale}
+    return plan
+
+def plan_for_data(D, laser_sensors, Wxy, t_span, spacing, budget, N_target=None,
+                  bm_scale=None, coefficients=None, N_fit=None):
+    '''
+    Make a memory plan for a list of data structures returned by read_optical_data.
+
+    The budget is reduced by the memory that the process is already using.
+    If the data are to be thinned before the fit, N_fit gives the number of
+    data of each type that will remain, and the plan is made for no more
+    than that many.
+    '''
+    sensor=np.concatenate([Di.sensor for Di in D if Di is not None] + [np.zeros(0)])
+    time=np.concatenate([Di.time for Di in D if Di is not None] + [np.zeros(0)])
+    N_data=count_data(sensor, laser_sensors, N_fit=N_fit)
+    N_z0, N_dz = grid_node_counts(Wxy, t_span, spacing)
+    N_bias=count_bias_params(sensor, time, laser_sensors)
+    return plan_inputs(N_data, N_z0, N_dz, N_bias, budget-current_rss(),
+                       N_target=N_target, bm_scale=bm_scale, coefficients=coefficients)
@@ -87,9 +87,53 @@ def apply_DEM_metadata(D, DEM_meta_config):
     meta['tilt_applied']=True
     return meta, DEM_meta_config
 
+def select_DEMs_by_coverage(D, meta_list, budget, bin_width, time_bin=1., sigma_ref=1.):
+    '''
+    Choose up to budget DEMs that cover the most space-time cells, weighted by registration quality
+
+    Each DEM covers the (x, y, time) cells of size bin_width x bin_width x
+    time_bin that contain its data.  DEMs are chosen greedily: each step
+    adds the DEM with the largest weight times the number of cells it
+    covers that are not yet covered.  The weight is
+    1/(1+(sigma/sigma_ref)**2), where sigma is the registration residual
+    from the DEM's _shift_est file; DEMs without one get the weight for
+    sigma=sigma_ref.
+
+    Returns
+    -------
+    list
+        indices of the selected DEMs, in their input order
+    '''
+    import heapq
+    cells=[]
+    for Di in D:
+        keys=np.c_[np.floor(Di.x/bin_width), np.floor(Di.y/bin_width), np.floor(Di.time/time_bin)].astype(np.int64)
+        cells += [set(map(tuple, np.unique(keys, axis=0)))]
+    weights=[]
+    for meta in meta_list:
+        sigma=float(meta['sigma']) if 'sigma' in meta else sigma_ref
+        weights += [1/(1+(sigma/sigma_ref)**2)]
+    # lazy greedy: the gain of a DEM can only decrease as cells are covered,
+    # so a DEM whose recomputed gain is still the largest in the queue is the best
+    queue=[(-weights[ii]*len(cells[ii]), ii) for ii in range(len(D))]
+    heapq.heapify(queue)
+    covered=set()
+    selected=[]
+    while queue and len(selected) < budget:
+        neg_gain, ii = heapq.heappop(queue)
+        gain=weights[ii]*len(cells[ii]-covered)
+        if gain <= 0:
+            continue
+        if queue and gain < -queue[0][0]:
+            heapq.heappush(queue, (-gain, ii))
+            continue
+        selected += [ii]
+        covered |= cells[ii]
+    return sorted(selected)
+
 def read_DEM_data(xy0, W, sensor_dict, gI_files=None, hemisphere=1, sigma_corr=20., 
                   blockmedian_scale=100., N_target=None, subset_stack=False, year_offset=0.5, 
-                  DEM_meta_config=None, DEM_res=32, DEBUG=False):
+                  DEM_meta_config=None, DEM_res=32, DEM_budget=None, DEBUG=False):
 
     if sensor_dict is None:
         sensor_dict={}
@@ -169,7 +213,12 @@ def read_DEM_data(xy0, W, sensor_dict, gI_files=None, hemisphere=1, sigma_corr=2
         meta['sensor'] = this_sensor_number
         meta_list += [meta]
         
-    if subset_stack:
+    if DEM_budget is not None and len(D_temp) > DEM_budget:
+        # choose the DEMs that add the most space-time coverage
+        DEM_number_list=select_DEMs_by_coverage(D_temp, meta_list, DEM_budget,
+                                                bin_width=np.maximum(400, 2*blockmedian_scale))
+        print(f'\t read_DEM_data: selected {len(DEM_number_list)} of {len(D_temp)} DEMs')
+    elif subset_stack:
         # subset the DEMs so that there is about one per year
         this_bin_width=np.maximum(400, 2*blockmedian_scale)
         DEM_number_list=subset_DEM_stack(D_temp, xy0, W['x'], \
@@ -11,6 +11,7 @@ import numpy as np
 from altimetryFit.read_ICESat2 import read_ICESat2
 from LSsurf.matlab_to_year import matlab_to_year
 from altimetryFit.read_DEM_data import read_DEM_data
+from altimetryFit.stage_timer import timed
 import pointCollection as pc
 
 
@@ -139,7 +140,7 @@ def read_optical_data(xy0, W, hemisphere=1, GI_files=None, \
               SRS_proj4=None,\
               mask_file=None, DEM_file=None, \
               geoid_file=None, water_mask_threshold=None, 
-              mask_floating=False, dem_subset_TF=False):
+              mask_floating=False, dem_subset_TF=False, DEM_budget=None, timer=None):
     """
     Read laser-altimetry and DEM data from geoIndex files.
 
@@ -171,6 +172,10 @@ def read_optical_data(xy0, W, hemisphere=1, GI_files=None, \
         mask file specifying floating data. The default is False.
     dem_subset_TF : bool, optional
         If true, DEM data are subsetted to provide one value per year. The default is False.
+    DEM_budget : int, optional
+        if provided, at most this many DEMs are used, chosen to maximize space-time coverage. The default is None.
+    timer : altimetryFit.stage_timer, optional
+        if provided, the read for each sensor is timed as stage 'read_<sensor>'. The default is None.
 
     Returns
     -------
@@ -194,33 +199,36 @@ def read_optical_data(xy0, W, hemisphere=1, GI_files=None, \
         bm_scale={'laser':100, 'DEM':200}
 
     if 'ICESat2' in GI_files:
-        
-        D = read_ICESat2(xy0, W, find_gI_files(GI_files['ICESat2']), 
+        with timed(timer, 'read_ICESat2'):
+            D = read_ICESat2(xy0, W, find_gI_files(GI_files['ICESat2']), 
                     SRS_proj4=SRS_proj4,
                     sensor=laser_dict['ICESat2'], 
                     cplx_accept_threshold=0.25, 
                     blockmedian_scale=bm_scale['laser'],
                     N_target=N_target['laser'])
-        for Di in D:
-            Di.assign({'slope_mag':np.sqrt(DEM.interp(Di.x, Di.y, field='z_x')**2+
+            for Di in D:
+                Di.assign({'slope_mag':np.sqrt(DEM.interp(Di.x, Di.y, field='z_x')**2+
                                            DEM.interp(Di.x, Di.y, field='z_y')**2)})
-            if hemisphere==-1:
-                # remove cycle 1 (overconstrains 2018-2019 based on not enough data)
-                Di.index(Di.time > 2019.0)
+                if hemisphere==-1:
+                    # remove cycle 1 (overconstrains 2018-2019 based on not enough data)
+                    Di.index(Di.time > 2019.0)
     if 'ICESat' in GI_files:
-        D_IS = read_ICESat(xy0, W, find_gI_files(GI_files['ICESat1']), 
+        with timed(timer, 'read_ICESat1'):
+            D_IS = read_ICESat(xy0, W, find_gI_files(GI_files['ICESat1']), 
                            sensor=laser_key()['ICESat1'],
                            hemisphere=hemisphere, DEM=DEM)
         if D_IS is not None:
             D += D_IS
     if 'LVIS' in GI_files:
-        D_LVIS=read_LVIS(xy0, W, 
+        with timed(timer, 'read_LVIS'):
+            D_LVIS=read_LVIS(xy0, W, 
                          find_gI_files(GI_files['LVIS']), 
                          blockmedian_scale=bm_scale['laser'], sensor=laser_dict['LVIS'])
         if D_LVIS is not None:
             D += D_LVIS
     if 'ATM' in GI_files:
-        D_ATM = read_ATM(xy0, W, find_gI_files(GI_files['ATM'])
+        with timed(timer, 'read_ATM'):
+            D_ATM = read_ATM(xy0, W, find_gI_files(GI_files['ATM'])
                          , blockmedian_scale=bm_scale['laser'], sensor=laser_dict['ATM'])
         if D_ATM is not None:
             D += D_ATM
@@ -230,30 +238,33 @@ def read_optical_data(xy0, W, hemisphere=1, GI_files=None, \
             year_offset=0
         else:
             year_offset=0.5
-        D_DEM, sensor_dict, DEM_meta_dict = read_DEM_data(xy0, W, sensor_dict, \
+        with timed(timer, 'read_DEM'):
+            D_DEM, sensor_dict, DEM_meta_dict = read_DEM_data(xy0, W, sensor_dict, \
                             gI_files=find_gI_files(GI_files['DEM']), \
                             hemisphere=hemisphere, 
                             blockmedian_scale=bm_scale['DEM'],
                             N_target=N_target['DEM'],
-                            subset_stack=dem_subset_TF, year_offset=year_offset)
+                            subset_stack=dem_subset_TF, year_offset=year_offset,
+                            DEM_budget=DEM_budget)
         if D_DEM is not None:
             D += D_DEM
 
     # two masking steps:
     # delete data over rock and ocean
-    if mask_file is not None:
-        mask=pc.grid.data().from_geotif(mask_file, bounds=[xy0[0]+np.array([-1, 1])*W['x']*1.1, xy0[1]+np.array([-1, 1])*W['y']*1.1])
-        for Di in D:
-            if Di is not None and mask_floating:
-                Di.index(mask.interp(Di.x, Di.y) > 0.1)
+    with timed(timer, 'read_masks'):
+        if mask_file is not None:
+            mask=pc.grid.data().from_geotif(mask_file, bounds=[xy0[0]+np.array([-1, 1])*W['x']*1.1, xy0[1]+np.array([-1, 1])*W['y']*1.1])
+            for Di in D:
+                if Di is not None and mask_floating:
+                    Di.index(mask.interp(Di.x, Di.y) > 0.1)
 
-    # if we have a geoid, delete data that are less than 10 m above it
-    if geoid_file is not None:
-        geoid=pc.grid.data().from_geotif(geoid_file, bounds=[xy0[0]+np.array([-1, 1])*W['x']*1.1, xy0[1]+np.array([-1, 1])*W['y']*1.1])
-        for Di in D:
-            if Di is not None:
-                Di.assign({'geoid':geoid.interp(Di.x, Di.y)})
-                if water_mask_threshold  is not None:
-                    Di.index((Di.z-Di.geoid) > water_mask_threshold)
+        # if we have a geoid, delete data that are less than 10 m above it
+        if geoid_file is not None:
+            geoid=pc.grid.data().from_geotif(geoid_file, bounds=[xy0[0]+np.array([-1, 1])*W['x']*1.1, xy0[1]+np.array([-1, 1])*W['y']*1.1])
+            for Di in D:
+                if Di is not None:
+                    Di.assign({'geoid':geoid.interp(Di.x, Di.y)})
+                    if water_mask_threshold  is not None:
+                        Di.index((Di.z-Di.geoid) > water_mask_threshold)
 
     return D, sensor_dict, DEM_meta_dict
@@ -9,7 +9,7 @@ import glob
 import re
 from datetime import date
 import sys
-from pyTMD import compute_tide_corrections
+from altimetryFit.tide_predictor import get_tide_predictor
 from dateutil import parser
 import json
 
@@ -65,20 +65,16 @@ def calc_tide(D_pt, t_DEM, directory=None, model=None, mask_file=None):
 
     if not np.any(mask_i):
         return
-    temp=np.zeros_like(D_pt.x) 
-    temp[mask_i]=compute_tide_corrections(
-                    D_pt.x[mask_i], D_pt.y[mask_i], (D_pt.time[mask_i]-2000)*365.25*24*3600,
-                    DIRECTORY=directory, MODEL=model,
-                    EPOCH=(2000,1,1,0,0,0), TYPE='drift', TIME='utc')
-    
-    
+    # the constituents are read once per process and reused for the second
+    # call, which uses the same locations
+    predictor=get_tide_predictor(directory, model)
+    delta_time=(D_pt.time[mask_i]-2000)*365.25*24*3600
+    temp=np.zeros_like(D_pt.x)
+    temp[mask_i]=predictor.predict(D_pt.x[mask_i], D_pt.y[mask_i], delta_time)
     D_pt.assign({'tide':np.array(temp)})
-    temp=np.zeros_like(D_pt.x) 
-    temp[mask_i]=compute_tide_corrections(
-                    D_pt.x[mask_i], D_pt.y[mask_i], 
-                    (t_DEM-2000+np.zeros(mask_i.sum()))*365.25*24*3600,
-                    DIRECTORY=directory, MODEL=model,
-                    EPOCH=(2000,1,1,0,0,0), TYPE='drift', TIME='utc')
+    temp=np.zeros_like(D_pt.x)
+    temp[mask_i]=predictor.predict(D_pt.x[mask_i], D_pt.y[mask_i],
+                    (t_DEM-2000+np.zeros(mask_i.sum()))*365.25*24*3600)
     D_pt.assign({'DEM_tide':temp})
 
 def get_DEM_date(filename):
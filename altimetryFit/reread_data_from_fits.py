@@ -11,6 +11,7 @@ import re
 import numpy as np
 import pointCollection as pc
 import os
+from altimetryFit.fit_output import decode_categorical
 
 
 def make_sensor_dict(h5f):
@@ -91,7 +92,7 @@ def reread_data_from_fits(xy0, W, dir_list, single_file=False,  template='E%d_N%
                     this_data=dict()
                     for key in h5f['data'].keys():
                         this_data[key]=np.array(h5f['data'][key])
-                this_data=pc.data(fields=this_data.keys()).from_dict(this_data)
+                this_data=decode_categorical(pc.data(fields=this_data.keys()).from_dict(this_data))
                 # DEBUGGING PLOT
                 #plt.plot(this_data.x, this_data.y,'.', markersize=1)
                 these=(np.abs(this_data.x-xy0[0])<W/2) & \
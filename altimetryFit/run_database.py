@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Record the size and run time of fits, and use them to choose input sizes for a time budget.
+
+Each completed fit adds a row to an sqlite database giving its data and
+unknown counts and its wall time.  A cost model
+
+    log(wall) = c0 + c_data*log(N_data) + c_unknowns*log(N_unknowns)
+
+is fit to the rows by least squares.  smooth_xytb_fit_aug does not report
+the number of iterations it runs, so iterations are not modelled: their
+effect on the wall time is part of the scatter about the model.  Given a
+time budget, plan_for_time
+predicts the wall time of a fit from the data that have been read, and
+finds the data fraction (and the corresponding N_target and bm_scale
+values) that bring the prediction under the budget.
+
+The database can be shared by the workers on a node: sqlite serializes
+the writes, and each write is a single short transaction.
+"""
+
+import socket
+import sqlite3
+import time
+import numpy as np
+from altimetryFit.memory_planner import grid_node_counts, count_bias_params, count_data
+
+columns=[('tile','TEXT'), ('finished','REAL'), ('host','TEXT'), ('N_data','INTEGER'),
+         ('N_unknowns','INTEGER'), ('wall','REAL'), ('fit_wall','REAL'),
+         ('N_target_laser','INTEGER'), ('N_target_DEM','INTEGER'),
+         ('bm_scale_laser','REAL'), ('bm_scale_DEM','REAL')]
+
+model_terms=['N_data', 'N_unknowns']
+
+def fit_size(sensor, time, laser_sensors, Wxy, t_span, spacing, time_corr=None, N_grid_bias=0):
+    '''
+    Number of data and of unknowns for a fit
+
+    The unknowns are the z0 and dz nodes, the bias parameters (approximate,
+    unless the time_corr values, after any merging of groups, are given),
+    and N_grid_bias DEM bias-grid nodes.
+    '''
+    N_z0, N_dz = grid_node_counts(Wxy, t_span, spacing)
+    N_bias=count_bias_params(sensor, time, laser_sensors, time_corr=time_corr)
+    return int(sensor.size), int(N_z0+N_dz+N_bias+N_grid_bias)
+
+class run_database(object):
+    '''
+    sqlite database of fit sizes and run times
+
+    Parameters
+    ----------
+    filename : str
+        database file, created if it does not exist
+    '''
+    def __init__(self, filename):
+        self.filename=filename
+        self.execute('CREATE TABLE IF NOT EXISTS runs (' +
+                     ', '.join([name+' '+kind for name, kind in columns]) + ')')
+        # add any columns that are missing from a database made by an earlier version
+        existing=[row[1] for row in self.execute('PRAGMA table_info(runs)')]
+        for name, kind in columns:
+            if name not in existing:
+                self.execute('ALTER TABLE runs ADD COLUMN '+name+' '+kind)
+
+    def execute(self, sql, values=()):
+        '''
+        Run one statement in its own transaction, and return any rows it selects
+        '''
+        conn=sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                return conn.execute(sql, values).fetchall()
+        finally:
+            conn.close()
+
+    def record(self, **kwargs):
+        '''
+        Add a row for a completed fit.  Keywords are the column names; missing columns are NULL.
+        '''
+        kwargs.setdefault('finished', time.time())
+        kwargs.setdefault('host', socket.gethostname())
+        names=[name for name, kind in columns if name in kwargs]
+        values=[kwargs[name].item() if isinstance(kwargs[name], np.generic) else kwargs[name] \
+                for name in names]
+        self.execute('INSERT INTO runs (' + ', '.join(names) + ') VALUES (' +
+                     ', '.join(['?']*len(names)) + ')', values)
+
+    def rows(self):
+        return self.execute('SELECT ' + ', '.join(model_terms) + ', wall FROM runs WHERE ' +
+                            ' AND '.join([term+' > 0' for term in model_terms+['wall']]))
+
+    def cost_model(self, min_rows=5):
+        '''
+        Fit the log-linear cost model to the recorded runs
+
+        Returns
+        -------
+        model : dict
+            coefficients ('c0' and one per term), the number of rows, and
+            the rms residual (in log units), or None if there are fewer than
+            min_rows runs
+        '''
+        rows=np.array(self.rows(), dtype=float)
+        if rows.shape[0] < min_rows:
+            return None
+        logs=np.log(rows)
+        G=np.c_[np.ones(rows.shape[0]), logs[:, :-1]]
+        coeffs, _, rank, _ = np.linalg.lstsq(G, logs[:, -1], rcond=None)
+        if rank < G.shape[1]:
+            # terms that do not vary among the runs cannot be fit; leave them out
+            varies=np.r_[True, np.std(logs[:, :-1], axis=0) > 0]
+            coeffs=np.zeros(G.shape[1])
+            coeffs[varies]=np.linalg.lstsq(G[:, varies], logs[:, -1], rcond=None)[0]
+        model={'c0':float(coeffs[0])}
+        model.update({'c_'+term:float(coeff) for term, coeff in zip(model_terms, coeffs[1:])})
+        model['N_rows']=int(rows.shape[0])
+        model['rms_log']=float(np.sqrt(np.mean((logs[:, -1]-G.dot(coeffs))**2)))
+        return model
+
+def predict_wall(model, N_data, N_unknowns):
+    '''
+    Predicted wall time (s) for a fit
+    '''
+    log_wall=model['c0']
+    for term, val in zip(model_terms, [N_data, N_unknowns]):
+        log_wall += model['c_'+term]*np.log(max(val, 1))
+    return float(np.exp(log_wall))
+
+def plan_for_time(D, laser_sensors, Wxy, t_span, spacing, time_budget, model,
+                  N_target=None, bm_scale=None, N_grid_bias=0, N_fit=None, margin=0.9):
+    '''
+    Check a fit against a time budget, and find reduced input sizes if needed.
+
+    Parameters
+    ----------
+    D : list
+        data structures returned by read_optical_data
+    time_budget : float
+        wall time available for the fit (s)
+    model : dict
+        cost model from run_database.cost_model
+    N_target, bm_scale : dict, optional
+        current maximum data counts and blockmedian scales for each data type
+    N_grid_bias : int, optional
+        number of DEM bias-grid nodes.  The default is 0.
+    N_fit : dict, optional
+        if the data are to be thinned before the fit, the number of data of
+        each type that will remain.  The plan is made for no more than that
+        many data.
+    margin : float, optional
+        the reduced inputs are chosen to use this fraction of the budget.
+        The default is 0.9.
+
+    Returns
+    -------
+    plan : dict
+        estimate, budget, and (if the budget is exceeded) the data fraction
+        and the new N_target and bm_scale values, in the form returned by
+        memory_planner.plan_inputs
+    '''
+    sensor=np.concatenate([Di.sensor for Di in D if Di is not None] + [np.zeros(0)])
+    time=np.concatenate([Di.time for Di in D if Di is not None] + [np.zeros(0)])
+    N_data=count_data(sensor, laser_sensors, N_fit=N_fit)
+    N_unknowns = fit_size(sensor, time, laser_sensors, Wxy, t_span, spacing,
+                          N_grid_bias=N_grid_bias)[1]
+    N_total=int(np.sum([N_data[key] for key in N_data]))
+    estimate=predict_wall(model, N_total, N_unknowns)
+    plan={'estimate':estimate, 'budget':time_budget, 'N_data':N_total, 'N_unknowns':N_unknowns,
+          'fits':bool(estimate <= time_budget)}
+    if plan['fits'] or N_total==0:
+        return plan
+    # the wall time scales as N_data**c_N_data
+    exponent=max(model['c_N_data'], 0.1)
+    plan['fraction']=float(np.clip((margin*time_budget/estimate)**(1/exponent), 0.05, 1))
+    plan['N_target']={key:int(plan['fraction']*N_data[key]) for key in N_data}
+    if N_target is not None:
+        for key in plan['N_target']:
+            if N_target.get(key) is not None:
+                plan['N_target'][key]=int(min(plan['N_target'][key], N_target[key]))
+    if bm_scale is not None:
+        # point density scales as the inverse square of the blockmedian scale
+        plan['bm_scale']={key:bm_scale[key]/np.sqrt(plan['fraction']) for key in bm_scale}
+    return plan
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Wall time, CPU time, memory and I/O instrumentation for the steps of a fit.
+
+A stage_timer records, for each named stage, the wall and CPU time, the
+change in resident memory, the number of files opened from python, and the
+bytes read by the process.  Stages are timed with a context manager:
+
+    timer=stage_timer()
+    with timer.stage('read_ATM'):
+        D=read_ATM(...)
+
+Stages may be nested, in which case the outer stage includes the inner
+ones, and a stage that is entered more than once accumulates its totals.
+
+File opens are counted with an audit hook, so opens made inside compiled
+libraries (HDF5, GDAL) are not included; the count of read system calls
+from /proc/self/io covers those.  On systems without /proc the I/O
+fields are zero.
+"""
+
+import os
+import sys
+import time
+import json
+import contextlib
+from altimetryFit.memory_planner import current_rss
+
+_open_count=[0]
+
+def _audit_hook(event, args):
+    # don't count the timer's own reads of /proc/self
+    if event=='open' and not str(args[0]).startswith('/proc/self/'):
+        _open_count[0] += 1
+
+_audit_installed=[False]
+
+def install_open_counter():
+    '''
+    Install the audit hook that counts file opens (audit hooks cannot be removed)
+    '''
+    if not _audit_installed[0]:
+        sys.addaudithook(_audit_hook)
+        _audit_installed[0]=True
+
+def io_counters():
+    '''
+    Read the I/O counters for this process: bytes read (all reads, and reads
+    from storage), and the number of read system calls
+    '''
+    out={'rchar':0, 'read_bytes':0, 'syscr':0}
+    try:
+        with open('/proc/self/io','r') as fh:
+            for line in fh:
+                key, val=line.split(':')
+                if key in out:
+                    out[key]=int(val)
+    except (OSError, ValueError):
+        pass
+    return out
+
+def counters():
+    io=io_counters()
+    return {'wall':time.perf_counter(), 'cpu':time.process_time(), 'rss':current_rss(),
+            'files_opened':_open_count[0], 'bytes_read':io['rchar'],
+            'disk_bytes_read':io['read_bytes'], 'read_calls':io['syscr']}
+
+class stage_timer(object):
+    '''
+    Record timing, memory and I/O for the stages of a fit
+    '''
+    def __init__(self):
+        install_open_counter()
+        self.records={}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start=counters()
+        try:
+            yield
+        finally:
+            end=counters()
+            rec=self.records.setdefault(name, {'calls':0, 'wall':0., 'cpu':0.,
+                    'rss_delta':0, 'files_opened':0, 'bytes_read':0,
+                    'disk_bytes_read':0, 'read_calls':0})
+            rec['calls'] += 1
+            rec['rss_delta'] += end['rss']-start['rss']
+            for key in ['wall','cpu','files_opened','bytes_read','disk_bytes_read','read_calls']:
+                rec[key] += end[key]-start[key]
+
+    def write_h5(self, grp):
+        '''
+        Write the records as attributes of one subgroup per stage of an h5py group
+        '''
+        for name, rec in self.records.items():
+            sub=grp.require_group(name.replace('/','_'))
+            for key, val in rec.items():
+                sub.attrs[key]=val
+
+    def write_json(self, filename, extra=None):
+        '''
+        Write the records (and any extra entries, e.g. the solver timing) to a json file
+        '''
+        out={'stages':self.records}
+        if extra is not None:
+            out.update(extra)
+        temp_file=filename+'.%d.tmp' % os.getpid()
+        with open(temp_file,'w') as fh:
+            json.dump(out, fh, indent=1, default=lambda val: val.tolist() if hasattr(val, 'tolist') else str(val))
+        os.replace(temp_file, filename)
+
+def timed(timer, name):
+    '''
+    Time a stage if a timer is given, otherwise do nothing
+    '''
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.stage(name)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-worker thread budget for BLAS, OpenMP and numexpr.
+
+The thread counts have to be set in the environment before numpy is
+imported, so this module does not import numpy, and set_thread_env should
+be called at the top of a script, before any other imports.  The budget
+comes from (in order of precedence) a '--threads' command-line argument
+(including arguments read from '@file' argument files),
+the ALTIMETRYFIT_NUM_THREADS environment variable, or the default of one
+thread.  A budget of 'auto' divides the cores available to the process
+among the concurrent workers on the node, given by '--workers' or the
+ALTIMETRYFIT_WORKERS environment variable (default 1).
+
+After numpy has been imported, set_thread_limits changes the limits of the
+loaded thread pools, if threadpoolctl is installed, and reports the number
+of threads that are in effect.
+"""
+
+import os
+import sys
+
+thread_vars=['MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+# thread count set in the environment before numpy was imported
+import_threads=None
+
+def available_cores():
+    '''
+    Number of cores that the process is allowed to run on
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def expand_arg_files(argv, prefix='@'):
+    '''
+    Replace '@file' arguments with the arguments in the file, one per line, as argparse does
+    '''
+    out=[]
+    for arg in argv:
+        if arg.startswith(prefix) and os.path.isfile(arg[1:]):
+            with open(arg[1:],'r') as fh:
+                out += expand_arg_files([line.strip() for line in fh.read().splitlines()], prefix=prefix)
+        else:
+            out += [arg]
+    return out
+
+def argv_value(argv, flag):
+    '''
+    Find the value of a flag in an argument list ('--flag value' or '--flag=value')
+    '''
+    value=None
+    for ii, arg in enumerate(argv):
+        if arg==flag and ii+1 < len(argv):
+            value=argv[ii+1]
+        elif arg.startswith(flag+'='):
+            value=arg.split('=', 1)[1]
+    return value
+
+def resolve_threads(threads=None, workers=None, argv=None):
+    '''
+    Find the number of threads for each worker.
+
+    Parameters
+    ----------
+    threads : int or str, optional
+        thread budget, or 'auto'.  If None, it is read from argv or from
+        the environment
+    workers : int or str, optional
+        number of concurrent workers on the node, used in 'auto' mode.  If
+        None, it is read from argv or from the environment
+    argv : list, optional
+        command-line arguments to search for '--threads' and '--workers'.
+        '@file' arguments are expanded.
+
+    Returns
+    -------
+    n_threads : int
+        number of threads
+    mode : str
+        'auto' or 'fixed'
+    '''
+    if argv is not None:
+        argv=expand_arg_files(argv)
+        if threads is None:
+            threads=argv_value(argv, '--threads')
+        if workers is None:
+            workers=argv_value(argv, '--workers')
+    if threads is None:
+        threads=os.environ.get('ALTIMETRYFIT_NUM_THREADS', '1')
+    if workers is None:
+        workers=os.environ.get('ALTIMETRYFIT_WORKERS', '1')
+    if str(threads).strip().lower()=='auto':
+        return max(1, available_cores()//max(1, int(workers))), 'auto'
+    return max(1, int(threads)), 'fixed'
+
+def import_thread_budget(argv=None):
+    '''
+    Number of threads to set when a module is imported, before numpy is.
+
+    A '--threads' or '--workers' value in argv that cannot be parsed is
+    ignored here (as is a bad value in the environment), falling back to
+    the environment and then to one thread, so that the error is reported
+    when the arguments are parsed, not when the module is imported.
+    '''
+    for kwargs in [{'argv':argv}, {}, {'threads':1}]:
+        try:
+            return resolve_threads(**kwargs)[0]
+        except ValueError:
+            continue
+
+def set_thread_env(n_threads):
+    '''
+    Set the thread-count environment variables.  Only effective before numpy is imported.
+    '''
+    global import_threads
+    for var in thread_vars:
+        os.environ[var]=str(n_threads)
+    if 'numpy' not in sys.modules:
+        import_threads=n_threads
+
+def set_thread_limits(n_threads):
+    '''
+    Limit the thread pools that have already been loaded.
+
+    Returns
+    -------
+    n_active : int
+        number of threads in effect: n_threads if the limits could be set
+        (threadpoolctl is installed, or numpy has not been imported),
+        otherwise the number set by set_thread_env before numpy was
+        imported, or None if that is not known
+    '''
+    set_thread_env(n_threads)
+    if 'numpy' not in sys.modules:
+        return n_threads
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return import_threads
+    threadpool_limits(limits=n_threads)
+    return n_threads
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache for ocean-tide predictions.
+
+Predictions are stored in one hdf5 file per tide model, projection and
+10-km cell, keyed by (location bin, time bin).  Reruns of a tile, and
+neighboring tiles that overlap it, look up their predictions in the cache
+and only call the tide model for bins that have not been seen before.
+"""
+
+import os
+import numpy as np
+import h5py
+import pointCollection as pc
+
+
+class tide_cache(object):
+    '''
+    Cache of tide predictions, keyed by (model, location bin, time bin)
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory in which the cache files are stored
+    model : str
+        tide model name
+    EPSG : int, optional
+        projection of the x and y coordinates. The default is 3031.
+    cell_size : float, optional
+        size of the cell covered by each cache file (m). The default is 1.e4.
+    xy_res : float, optional
+        size of the location bins (m). The default is 100.
+    t_res : float, optional
+        size of the time bins (s). The default is 10.
+    '''
+    def __init__(self, cache_dir, model, EPSG=3031, cell_size=1.e4, xy_res=100., t_res=10.):
+        self.cache_dir=os.path.join(cache_dir, str(model))
+        self.model=model
+        self.EPSG=EPSG
+        self.cell_size=cell_size
+        self.xy_res=xy_res
+        self.t_res=t_res
+        self.N_xy=int(np.round(cell_size/xy_res))
+        self.N_hits=0
+        self.N_misses=0
+
+    def filename(self, cell):
+        xc, yc = cell
+        return os.path.join(self.cache_dir,
+                            'E%d_N%d_EPSG%d.h5' % (xc/1000, yc/1000, self.EPSG))
+
+    def read_cell(self, cell):
+        '''
+        Read the keys and tide values for one cell.  Files written with
+        different bin sizes are ignored.
+        '''
+        filename=self.filename(cell)
+        if not os.path.isfile(filename):
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        try:
+            with h5py.File(filename,'r') as h5f:
+                if h5f.attrs['xy_res'] != self.xy_res or h5f.attrs['t_res'] != self.t_res:
+                    return np.zeros(0, dtype=np.int64), np.zeros(0)
+                return np.array(h5f['key']), np.array(h5f['tide'])
+        except (OSError, KeyError):
+            print(f"tide_cache: could not read {filename}, ignoring")
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    def write_cell(self, cell, keys, tide):
+        '''
+        Write the keys and tide values for one cell.  The file is written
+        to a temporary name and then moved into place, so that concurrent
+        workers never see a partial file.
+        '''
+        filename=self.filename(cell)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        temp_file=filename+'.%d.tmp' % os.getpid()
+        with h5py.File(temp_file,'w') as h5f:
+            h5f.attrs['model']=str(self.model)
+            h5f.attrs['EPSG']=self.EPSG
+            h5f.attrs['xy_res']=self.xy_res
+            h5f.attrs['t_res']=self.t_res
+            h5f.create_dataset('key', data=keys)
+            h5f.create_dataset('tide', data=tide)
+        os.replace(temp_file, filename)
+
+    def bin(self, x, y, delta_time):
+        '''
+        Find the cell and the key within the cell for each point
+        '''
+        cx=np.floor(x/self.cell_size)*self.cell_size
+        cy=np.floor(y/self.cell_size)*self.cell_size
+        ix=np.clip(np.floor((x-cx)/self.xy_res).astype(np.int64), 0, self.N_xy-1)
+        iy=np.clip(np.floor((y-cy)/self.xy_res).astype(np.int64), 0, self.N_xy-1)
+        it=np.floor(delta_time/self.t_res).astype(np.int64)
+        keys=(it*self.N_xy + iy)*self.N_xy + ix
+        return cx, cy, keys
+
+    def bin_centers(self, cell, keys):
+        '''
+        Find the location and time at the center of each bin
+        '''
+        ix=np.mod(keys, self.N_xy)
+        iy=np.mod(keys//self.N_xy, self.N_xy)
+        it=keys//(self.N_xy*self.N_xy)
+        return cell[0]+(ix+0.5)*self.xy_res, cell[1]+(iy+0.5)*self.xy_res, (it+0.5)*self.t_res
+
+    def predict(self, x, y, delta_time, predict_fn):
+        '''
+        Get tide predictions for a set of points.
+
+        Parameters
+        ----------
+        x, y : numpy arrays
+            projected point coordinates
+        delta_time : numpy array
+            seconds since 2000-01-01
+        predict_fn : callable
+            function of (x, y, delta_time) that evaluates the tide model.
+            It is only called for bins not found in the cache, and is
+            evaluated at the bin centers
+
+        Returns
+        -------
+        tide : numpy array
+            tide predictions for each point
+        '''
+        tide=np.zeros_like(x, dtype=np.float64)+np.nan
+        if x.size==0:
+            return tide
+        good=np.isfinite(x) & np.isfinite(y) & np.isfinite(delta_time)
+        good_ind=np.flatnonzero(good)
+        cx, cy, keys = self.bin(x[good], y[good], delta_time[good])
+        _, cell_dict = pc.unique_by_rows(np.c_[cx, cy], return_dict=True)
+        for cell, ind in cell_dict.items():
+            cache_keys, cache_tide = self.read_cell(cell)
+            u_keys, u_inv = np.unique(keys[ind], return_inverse=True)
+            u_tide=np.zeros(u_keys.size)+np.nan
+            if cache_keys.size > 0:
+                i_cache=np.clip(np.searchsorted(cache_keys, u_keys), 0, cache_keys.size-1)
+                hit=cache_keys[i_cache]==u_keys
+                u_tide[hit]=cache_tide[i_cache[hit]]
+            else:
+                hit=np.zeros(u_keys.size, dtype=bool)
+            self.N_hits += np.sum(hit)
+            self.N_misses += np.sum(~hit)
+            if np.any(~hit):
+                xb, yb, tb = self.bin_centers(cell, u_keys[~hit])
+                u_tide[~hit] = np.ma.filled(predict_fn(xb, yb, tb), np.nan)
+                all_keys=np.concatenate([cache_keys, u_keys[~hit]])
+                all_tide=np.concatenate([cache_tide, u_tide[~hit]])
+                order=np.argsort(all_keys)
+                try:
+                    self.write_cell(cell, all_keys[order], all_tide[order])
+                except OSError as e:
+                    print(f"tide_cache: could not write cache for cell {cell}: {e}")
+            tide[good_ind[ind]] = u_tide[u_inv.ravel()]
+        return tide
+
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tide predictor that keeps the tide-model constituents in memory.
+
+pyTMD's compute_tide_corrections reads the model constituents from disk
+and interpolates them to the requested points every time it is called.
+A tide_predictor reads the constituents once per process, keeps the
+interpolated harmonic constants for every location bin that it has seen,
+and only evaluates the harmonic sum for new times.  Use get_tide_predictor
+to share one predictor between all the tiles or DEMs handled by a process.
+
+The model-reading calls follow the pyTMD 2.0 interface
+(pyTMD.io.*.read_constants / interpolate_constants).  pyTMD is imported
+when a predictor is first used.
+"""
+
+import os
+import numpy as np
+import pyproj
+
+_predictors={}
+
+def get_tide_predictor(directory, model, EPSG=3031, **kwargs):
+    '''
+    Return the tide_predictor for a model directory, model name and projection,
+    creating it if this process has not used it before.
+    '''
+    key=(os.path.abspath(directory), model, EPSG)
+    if key not in _predictors:
+        _predictors[key]=tide_predictor(directory, model, EPSG=EPSG, **kwargs)
+    return _predictors[key]
+
+
+class tide_predictor(object):
+    '''
+    Tide-model predictor with cached constituents
+
+    Parameters
+    ----------
+    directory : str
+        directory containing the tide models
+    model : str
+        tide model name (e.g. CATS2008, Gr1km-v2)
+    EPSG : int, optional
+        projection of the x and y coordinates. The default is 3031.
+    xy_res : float, optional
+        harmonic constants are interpolated to the centers of location bins
+        of this size (m). The default is 100.
+    atlas_format : str, optional
+        format of ATLAS models. The default is 'netcdf'.
+    method : str, optional
+        interpolation method for the constituents. The default is 'spline'.
+    extrapolate : bool, optional
+        extrapolate constituents outside the model domain. The default is False.
+    cutoff : float, optional
+        extrapolation cutoff (km). The default is 10.
+    max_locations : int, optional
+        the location cache is cleared when it grows larger than this.  The default is 2e6.
+    '''
+    def __init__(self, directory, model, EPSG=3031, xy_res=100., atlas_format='netcdf',
+                 method='spline', extrapolate=False, cutoff=10., max_locations=2e6):
+        self.directory=directory
+        self.model_name=model
+        self.EPSG=EPSG
+        self.xy_res=xy_res
+        self.atlas_format=atlas_format
+        self.method=method
+        self.extrapolate=extrapolate
+        self.cutoff=cutoff
+        self.max_locations=max_locations
+        self.model=None
+        self.constituents=None
+        self.c=None
+        self.keys=np.zeros(0, dtype=np.int64)
+        self.hc=None
+        self.transformer=pyproj.Transformer.from_crs(pyproj.CRS.from_epsg(EPSG),
+                                                     pyproj.CRS.from_epsg(4326),
+                                                     always_xy=True)
+
+    def load(self):
+        '''
+        Read the model constituents from disk.  Only done once per predictor.
+        '''
+        if self.constituents is not None:
+            return
+        import pyTMD
+        print(f"tide_predictor: reading constituents for {self.model_name}")
+        self.model=pyTMD.io.model(self.directory, format=self.atlas_format,
+                                  compressed=False).elevation(self.model_name)
+        model=self.model
+        if model.format in ('OTIS', 'ATLAS', 'TMD3'):
+            self.constituents=pyTMD.io.OTIS.read_constants(model.grid_file, model.model_file,
+                    model.projection, type=model.type, grid=model.format)
+            self.c=self.constituents.fields
+        elif model.format=='netcdf':
+            self.constituents=pyTMD.io.ATLAS.read_constants(model.grid_file, model.model_file,
+                    type=model.type, compressed=model.compressed)
+            self.c=self.constituents.fields
+        elif model.format=='GOT':
+            self.constituents=pyTMD.io.GOT.read_constants(model.model_file,
+                    compressed=model.compressed)
+            self.c=self.constituents.fields
+        elif model.format=='FES':
+            self.constituents=pyTMD.io.FES.read_constants(model.model_file,
+                    type=model.type, version=model.version, compressed=model.compressed)
+            self.c=model.constituents
+
+    def interpolate(self, x, y):
+        '''
+        Interpolate the harmonic constants to a set of projected coordinates
+        '''
+        self.load()
+        import pyTMD
+        model=self.model
+        lon, lat = self.transformer.transform(x, y)
+        kwargs=dict(method=self.method, extrapolate=self.extrapolate, cutoff=self.cutoff)
+        if model.format in ('OTIS', 'ATLAS', 'TMD3'):
+            amp, ph, D = pyTMD.io.OTIS.interpolate_constants(lon, lat, self.constituents,
+                    model.projection, type=model.type, **kwargs)
+        elif model.format=='netcdf':
+            amp, ph, D = pyTMD.io.ATLAS.interpolate_constants(lon, lat, self.constituents,
+                    type=model.type, scale=model.scale, **kwargs)
+        else:
+            amp, ph = getattr(pyTMD.io, model.format).interpolate_constants(lon, lat,
+                    self.constituents, scale=model.scale, **kwargs)
+        return amp*np.exp(-1j*ph*np.pi/180.0)
+
+    def location_keys(self, x, y):
+        ix=np.floor(x/self.xy_res).astype(np.int64)
+        iy=np.floor(y/self.xy_res).astype(np.int64)
+        return (ix << 32) + (iy & 0xffffffff)
+
+    def harmonic_constants(self, x, y):
+        '''
+        Get the harmonic constants for each point, interpolating them for
+        location bins that have not been seen before.
+        '''
+        keys=self.location_keys(x, y)
+        u_keys, u_inv = np.unique(keys, return_inverse=True)
+        if self.hc is not None and self.keys.size + u_keys.size > self.max_locations:
+            print("tide_predictor: clearing location cache")
+            self.keys=np.zeros(0, dtype=np.int64)
+            self.hc=None
+        if self.hc is None:
+            new=np.ones(u_keys.size, dtype=bool)
+        else:
+            i_cache=np.clip(np.searchsorted(self.keys, u_keys), 0, self.keys.size-1)
+            new=self.keys[i_cache] != u_keys
+        if np.any(new):
+            xb=(np.floor(x/self.xy_res)+0.5)*self.xy_res
+            yb=(np.floor(y/self.xy_res)+0.5)*self.xy_res
+            # first point in each new bin
+            first=np.zeros(u_keys.size, dtype=int)
+            first[u_inv.ravel()[::-1]]=np.arange(keys.size)[::-1]
+            new_hc=self.interpolate(xb[first[new]], yb[first[new]])
+            if self.hc is None:
+                all_keys=u_keys[new]
+                all_hc=new_hc
+            else:
+                all_keys=np.concatenate([self.keys, u_keys[new]])
+                all_hc=np.ma.concatenate([self.hc, new_hc], axis=0)
+            order=np.argsort(all_keys)
+            self.keys=all_keys[order]
+            self.hc=all_hc[order,:]
+        return self.hc[np.searchsorted(self.keys, keys),:]
+
+    def predict(self, x, y, delta_time):
+        '''
+        Predict tides at a set of points.
+
+        Parameters
+        ----------
+        x, y : numpy arrays
+            projected point coordinates
+        delta_time : numpy array
+            UTC seconds since 2000-01-01
+
+        Returns
+        -------
+        tide : numpy array
+            tide predictions (m), NaN outside the model domain
+        '''
+        x=np.atleast_1d(x).ravel()
+        y=np.atleast_1d(y).ravel()
+        delta_time=np.atleast_1d(delta_time).ravel()
+        tide=np.zeros(x.size)+np.nan
+        if x.size==0:
+            return tide
+        hc=self.harmonic_constants(x, y)
+        import pyTMD
+        ts=pyTMD.time.timescale().from_deltatime(delta_time,
+                epoch=(2000,1,1,0,0,0), standard='UTC')
+        if self.model.format in ('OTIS', 'ATLAS', 'TMD3', 'netcdf'):
+            deltat=np.zeros_like(ts.tide)
+        else:
+            deltat=ts.tt_ut1
+        tide[:]=np.ma.getdata(pyTMD.predict.drift(ts.tide, hc, self.c,
+                deltat=deltat, corrections=self.model.format))
+        tide += np.ma.getdata(pyTMD.predict.infer_minor(ts.tide, hc, self.c,
+                deltat=deltat, corrections=self.model.format))
+        tide[np.any(np.ma.getmaskarray(hc), axis=1)]=np.nan
+        return tide
+
+
+def predict_tides_on_lattice(x, y, delta_time, predict_fn, spacing=2000., t_res=60.,
+                             N_check=1000, tol=0.01, seed=0):
+    '''
+    Approximate tide predictions by interpolating from a coarse lattice.
+
+    The tide model is evaluated on the nodes of a space-time lattice
+    (spatial spacing 'spacing', times rounded to t_res) that surround the
+    points, and the per-point values are bilinearly interpolated from the
+    nodes.  A random subset of points is evaluated exactly; lattice cells
+    in which the error for any of these points exceeds 'tol', and points
+    whose lattice nodes are outside the model domain, are evaluated exactly.
+
+    Parameters
+    ----------
+    x, y : numpy arrays
+        projected point coordinates
+    delta_time : numpy array
+        seconds since 2000-01-01
+    predict_fn : callable
+        function of (x, y, delta_time) that evaluates the tide model
+    spacing : float, optional
+        lattice spacing (m). The default is 2000.
+    t_res : float, optional
+        lattice times are rounded to this resolution (s). The default is 60.
+    N_check : int, optional
+        number of points evaluated exactly to check the errors. The default is 1000.
+    tol : float, optional
+        maximum acceptable error (m). The default is 0.01.
+    seed : int, optional
+        seed for the random selection of check points.  The default is 0.
+
+    Returns
+    -------
+    tide : numpy array
+        tide predictions for each point
+    stats : dict
+        counts of lattice-node and exact evaluations, and the check-point errors
+    '''
+    tide=np.zeros(x.size)+np.nan
+    stats={'N_points':x.size, 'N_nodes':0, 'N_exact':0, 'RMS_error':np.nan, 'max_error':np.nan}
+    if x.size==0:
+        return tide, stats
+    x0=np.floor(np.min(x)/spacing)*spacing
+    y0=np.floor(np.min(y)/spacing)*spacing
+    fx=(x-x0)/spacing
+    fy=(y-y0)/spacing
+    ix=np.floor(fx).astype(np.int64)
+    iy=np.floor(fy).astype(np.int64)
+    fx -= ix
+    fy -= iy
+    it=np.round(delta_time/t_res).astype(np.int64)
+
+    # evaluate the model at the unique lattice nodes needed by the points
+    corners=[(0, 0), (1, 0), (0, 1), (1, 1)]
+    node_rows=np.concatenate([np.c_[ix+di, iy+dj, it] for di, dj in corners], axis=0)
+    u_nodes, node_ind = np.unique(node_rows, axis=0, return_inverse=True)
+    node_ind=node_ind.ravel().reshape(len(corners), x.size)
+    node_tide=np.ma.filled(predict_fn(x0+u_nodes[:,0]*spacing, y0+u_nodes[:,1]*spacing,
+                                      u_nodes[:,2]*t_res), np.nan)
+    stats['N_nodes']=u_nodes.shape[0]
+    weights=[(1-fx)*(1-fy), fx*(1-fy), (1-fx)*fy, fx*fy]
+    tide[:]=0
+    for w, ind in zip(weights, node_ind):
+        tide += w*node_tide[ind]
+
+    # check a random subset of the points against exact evaluations
+    rng=np.random.default_rng(seed)
+    check=rng.choice(x.size, size=np.minimum(N_check, x.size), replace=False)
+    exact=np.ma.filled(predict_fn(x[check], y[check], delta_time[check]), np.nan)
+    err=np.abs(tide[check]-exact)
+    if np.any(np.isfinite(err)):
+        stats['RMS_error']=np.sqrt(np.nanmean(err**2))
+        stats['max_error']=np.nanmax(err)
+    tide[check]=exact
+
+    # re-evaluate points in cells that failed the check, and points that
+    # could not be interpolated
+    bad_cells=np.unique(np.c_[ix[check], iy[check]][err > tol], axis=0)
+    redo=~np.isfinite(tide)
+    if bad_cells.size > 0:
+        cell_key=ix*(np.max(iy)+2)+iy
+        bad_key=bad_cells[:,0]*(np.max(iy)+2)+bad_cells[:,1]
+        redo |= np.in1d(cell_key, bad_key)
+    redo[check]=False
+    if np.any(redo):
+        tide[redo]=np.ma.filled(predict_fn(x[redo], y[redo], delta_time[redo]), np.nan)
+    stats['N_exact']=check.size+np.sum(redo)
+    return tide, stats
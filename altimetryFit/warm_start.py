@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Carry the per-point edits of a previous (e.g. prelim or coarse) fit into a new fit.
+
+The data in the new fit are matched to the data in the previous fit's
+/data group by sensor, time, x and y.  The three_sigma_edit field of the
+new data is set to zero for matched points that the previous fit
+rejected, so the new fit starts from the previous fit's edited state.  The
+points are kept, so the fit can restore them if they fit the new model,
+and the fit's convergence test decides how many iterations are needed.
+"""
+
+import numpy as np
+import h5py
+
+def row_keys(sensor, time, x, y):
+    '''
+    Make one hashable key per data point from its sensor, time (to ~1 s) and position (to 1 cm)
+    '''
+    keys=np.c_[np.round(sensor), np.round(time*365.25*24*3600),
+               np.round(x*100), np.round(y*100)].astype(np.int64)
+    return np.ascontiguousarray(keys).view(np.dtype((np.void, keys.dtype.itemsize*4))).ravel()
+
+def read_prelim_edits(filename, edit_field='three_sigma_edit'):
+    '''
+    Read the coordinates and edit flags of the data in a fit output file
+
+    Returns
+    -------
+    keys : numpy array
+        row_keys for the data, or None if the file has no edit field
+    edited : numpy array
+        True for points that the fit rejected
+    '''
+    with h5py.File(filename,'r') as h5f:
+        if 'data' not in h5f or edit_field not in h5f['data']:
+            return None, None
+        D={field:np.array(h5f['data'][field]) for field in ['sensor','time','x','y', edit_field]}
+    good=np.all(np.isfinite(np.c_[D['sensor'], D['time'], D['x'], D['y']]), axis=1)
+    keys=row_keys(D['sensor'][good], D['time'][good], D['x'][good], D['y'][good])
+    return keys, D[edit_field][good]==0
+
+def data_edits(D, edit_field='three_sigma_edit'):
+    '''
+    Make the keys and edit flags for the data returned by a fit
+    '''
+    x=D.x_original if 'x_original' in D.fields else D.x
+    y=D.y_original if 'y_original' in D.fields else D.y
+    good=np.isfinite(D.sensor) & np.isfinite(D.time) & np.isfinite(x) & np.isfinite(y)
+    return row_keys(D.sensor[good], D.time[good], x[good], y[good]), getattr(D, edit_field)[good]==0
+
+def apply_edits(data, edit_keys, edited, min_match=0., edit_field='three_sigma_edit'):
+    '''
+    Set the initial edit state of data from the edits of a previous fit
+
+    Parameters
+    ----------
+    data : pointCollection.data
+        data for the new fit.  If the data have x_original and y_original
+        fields (from lagrangian advection), these are matched.
+    edit_keys : numpy array
+        row_keys for the data of a previous fit
+    edited : numpy array
+        True for the points of the previous fit that were rejected
+    min_match : float, optional
+        if less than this fraction of the data match the previous fit, the
+        edit state is not changed.  The default is 0.
+    edit_field : str, optional
+        field that is set to zero for the matched points that were
+        rejected, and to the previous fit's value (or one, if the field is
+        not present) for the others.  The default is 'three_sigma_edit'.
+
+    Returns
+    -------
+    stats : dict
+        number of data, of matched data, and of data whose initial edit
+        flags are set to zero, and whether the edits were applied
+    '''
+    stats={'N_data':int(data.size), 'N_matched':0, 'N_edited':0, 'fraction_matched':0., 'applied':False}
+    if edit_keys is None or edit_keys.size==0 or data.size==0:
+        return stats
+    x=data.x_original if 'x_original' in data.fields else data.x
+    y=data.y_original if 'y_original' in data.fields else data.y
+    keys=row_keys(data.sensor, data.time, x, y)
+
+    order=np.argsort(edit_keys)
+    edit_keys=edit_keys[order]
+    edited=edited[order]
+    ind=np.clip(np.searchsorted(edit_keys, keys), 0, edit_keys.size-1)
+    matched=edit_keys[ind]==keys
+    stats.update({'N_matched':int(np.sum(matched)), 'fraction_matched':float(np.mean(matched))})
+    if stats['fraction_matched'] < min_match:
+        return stats
+    if edit_field in data.fields:
+        edit_ok=getattr(data, edit_field) != 0
+    else:
+        edit_ok=np.ones(data.size, dtype=bool)
+    edit_ok[matched]=~edited[ind[matched]]
+    data.assign({edit_field:edit_ok})
+    stats.update({'N_edited':int(np.sum(~edit_ok)), 'applied':True})
+    return stats
+
+def apply_prelim_edits(data, filename, min_match=0., edit_field='three_sigma_edit'):
+    '''
+    Start the edit state of data from the edits of a previous fit
+
+    Parameters
+    ----------
+    data : pointCollection.data
+        data for the new fit
+    filename : str
+        output file from the previous fit
+    min_match : float, optional
+        see apply_edits
+    edit_field : str, optional
+        field in the previous fit's data that is zero for rejected
+        points.  The default is 'three_sigma_edit'.
+
+    Returns
+    -------
+    stats : dict
+        see apply_edits
+    '''
+    edit_keys, edited = read_prelim_edits(filename, edit_field=edit_field)
+    stats=apply_edits(data, edit_keys, edited, min_match=min_match, edit_field=edit_field)
+    stats['file']=filename
+    return stats
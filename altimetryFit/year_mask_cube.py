@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Year-mask stacks compiled into a single bit-packed cube.
+
+mask_data_by_year reads every yearly mask geotif in a directory for each
+tile.  Here the masks are compiled once into an hdf5 file in which the
+mask values and their validity are stored as bits packed along the time
+axis, with chunks that allow a tile-sized window to be read.  The lookup
+for a tile is then one bounded read and one vectorized gather.
+
+The cube is built once, offline, with scripts/make_year_mask_cube.py, so
+that the workers fitting tiles do not each write to the mask directory.
+A cube is used only if it is current (it lists the same mask years, and
+no mask file is newer than it).  Only binary (0/1) masks can be packed
+into bits; for other masks, the per-year reads must be used so that the
+masks are interpolated before they are thresholded.
+"""
+
+import os
+import re
+import glob
+import numpy as np
+import h5py
+import pointCollection as pc
+
+year_re=re.compile(r'(\d\d\d\d.+\d+).tif')
+
+def find_year_masks(mask_dir):
+    '''
+    Find the yearly mask files in a directory, sorted by year
+    '''
+    masks={}
+    for file in glob.glob(mask_dir+'/*.tif'):
+        m=year_re.search(file)
+        if m is not None:
+            masks[float(m.group(1))]=file
+    years=np.sort(np.array(list(masks.keys())))
+    return years, [masks[year] for year in years]
+
+def cube_is_current(cube_file, years, files):
+    if not os.path.isfile(cube_file):
+        return False
+    cube_time=os.path.getmtime(cube_file)
+    if any(os.path.getmtime(file) > cube_time for file in files):
+        return False
+    try:
+        with h5py.File(cube_file,'r') as h5f:
+            return np.array_equal(np.array(h5f['years']), years)
+    except (OSError, KeyError):
+        return False
+
+def make_year_mask_cube(cube_file, years, files, chunk=256):
+    '''
+    Read the yearly masks and write them to a bit-packed cube.
+
+    The masks are read and packed one at a time, so only one mask and one
+    byte plane of each packed array are held in memory.
+
+    Returns False (and writes nothing) if the masks do not share a grid or
+    are not binary.
+    '''
+    print(f"year_mask_cube: compiling {len(files)} masks into {cube_file}")
+    temp_file=cube_file+'.%d.tmp' % os.getpid()
+    try:
+        with h5py.File(temp_file,'w') as h5f:
+            for count, file in enumerate(files):
+                mask=pc.grid.data().from_geotif(file)
+                if count==0:
+                    x, y = mask.x, mask.y
+                    ny, nx = mask.z.shape
+                    nb=int(np.ceil(len(files)/8))
+                    h5f.create_dataset('x', data=x)
+                    h5f.create_dataset('y', data=y)
+                    h5f.create_dataset('years', data=years)
+                    chunks=(min(chunk, ny), min(chunk, nx), nb)
+                    for name in ['mask', 'valid']:
+                        h5f.create_dataset(name, shape=(ny, nx, nb), dtype=np.uint8,
+                                           chunks=chunks, compression='gzip')
+                elif mask.z.shape != (ny, nx) or not (np.allclose(mask.x, x) and np.allclose(mask.y, y)):
+                    print(f"year_mask_cube: {file} is not on the same grid as {files[0]}")
+                    return False
+                valid=np.isfinite(mask.z)
+                if np.any((mask.z[valid] != 0) & (mask.z[valid] != 1)):
+                    print(f"year_mask_cube: {file} is not a binary mask")
+                    return False
+                # set this year's bit in the byte plane that holds it
+                byte, bit = count//8, np.uint8(1 << (7-count % 8))
+                if count % 8==0:
+                    planes={'mask':np.zeros((ny, nx), dtype=np.uint8),
+                            'valid':np.zeros((ny, nx), dtype=np.uint8)}
+                planes['valid'][valid] |= bit
+                planes['mask'][valid & (mask.z==1)] |= bit
+                if count % 8==7 or count==len(files)-1:
+                    for name in ['mask', 'valid']:
+                        h5f[name][:, :, byte]=planes[name]
+        os.replace(temp_file, cube_file)
+        return True
+    finally:
+        if os.path.isfile(temp_file):
+            os.remove(temp_file)
+
+def read_window(cube_file, bounds):
+    '''
+    Read the part of the cube that covers a set of bounds, with a one-pixel pad.
+
+    Returns
+    -------
+    x, y, years, mask, valid : numpy arrays
+        grid coordinates, mask years, and packed mask and validity bits
+    '''
+    with h5py.File(cube_file,'r') as h5f:
+        x=np.array(h5f['x'])
+        y=np.array(h5f['y'])
+        years=np.array(h5f['years'])
+        c0, c1 = np.searchsorted(x, bounds[0])
+        r0, r1 = np.searchsorted(y, bounds[1])
+        c0, r0 = max(c0-1, 0), max(r0-1, 0)
+        c1, r1 = min(c1+1, x.size), min(r1+1, y.size)
+        return x[c0:c1], y[r0:r1], years, \
+            np.array(h5f['mask'][r0:r1, c0:c1, :]), np.array(h5f['valid'][r0:r1, c0:c1, :])
+
+def interp_year_mask(cube_file, x, y, years_ind):
+    '''
+    Bilinearly interpolate the yearly masks to a set of points.
+
+    Parameters
+    ----------
+    cube_file : str
+        compiled mask cube
+    x, y : numpy arrays
+        point coordinates
+    years_ind : numpy array
+        index of the mask year for each point
+
+    Returns
+    -------
+    result : numpy array
+        interpolated mask values, NaN outside the masks or where any
+        neighboring mask value is invalid
+    '''
+    result=np.zeros(x.shape)+np.nan
+    if x.size==0:
+        return result
+    gx, gy, years, mask, valid = read_window(cube_file,
+            [[np.nanmin(x), np.nanmax(x)], [np.nanmin(y), np.nanmax(y)]])
+    if gx.size < 2 or gy.size < 2:
+        return result
+    fx=(x-gx[0])/(gx[1]-gx[0])
+    fy=(y-gy[0])/(gy[1]-gy[0])
+    inside=np.flatnonzero((fx >= 0) & (fx <= gx.size-1) & (fy >= 0) & (fy <= gy.size-1))
+    if inside.size==0:
+        return result
+    fx, fy = fx[inside], fy[inside]
+    ix=np.minimum(np.floor(fx).astype(int), gx.size-2)
+    iy=np.minimum(np.floor(fy).astype(int), gy.size-2)
+    wx, wy = fx-ix, fy-iy
+    byte=years_ind[inside]//8
+    shift=7-years_ind[inside] % 8
+    temp=np.zeros(inside.size)
+    good=np.ones(inside.size, dtype=bool)
+    for di, dj, w in [(0, 0, (1-wx)*(1-wy)), (1, 0, wx*(1-wy)),
+                      (0, 1, (1-wx)*wy), (1, 1, wx*wy)]:
+        # zero-weight corners do not affect the result
+        used=w > 0
+        good &= ~used | ((valid[iy+dj, ix+di, byte] >> shift) & 1).astype(bool)
+        temp += w*((mask[iy+dj, ix+di, byte] >> shift) & 1)
+    temp[~good]=np.nan
+    result[inside]=temp
+    return result
+
+def year_mask_values(mask_dir, x, y, time, cube_file=None):
+    '''
+    Find the mask value for each point from the mask for the latest year
+    before the point's time.
+
+    Parameters
+    ----------
+    mask_dir : str
+        directory containing yearly mask geotifs, named with the year
+    x, y, time : numpy arrays
+        point coordinates and times
+    cube_file : str, optional
+        compiled cube file.  The default is year_mask_cube.h5 in mask_dir
+
+    Returns
+    -------
+    values : numpy array
+        mask values, NaN for points before the first mask year or outside
+        the masks.  None if there is no current cube
+    '''
+    if cube_file is None:
+        cube_file=os.path.join(mask_dir, 'year_mask_cube.h5')
+    years, files = find_year_masks(mask_dir)
+    values=np.zeros(x.shape)+np.nan
+    if len(files)==0:
+        return values
+    if not cube_is_current(cube_file, years, files):
+        if os.path.isfile(cube_file):
+            print(f"year_mask_cube: {cube_file} is out of date, rebuild it with make_year_mask_cube.py")
+        return None
+    years_ind=np.searchsorted(years, time)
+    pts=np.flatnonzero(years_ind > 0)
+    values[pts]=interp_year_mask(cube_file, x[pts], y[pts], years_ind[pts]-1)
+    return values
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare coarse-to-fine fitting with the standard single-pass fit.
+
+fit_altimetry.py is run once with the given arguments and once for each
+--scale value with --coarse_edit_scale added, and the wall times, the
+number of data retained by the editing (out of the data in each output
+file, which include the edited points), and the differences in the z0 and
+dz grids are reported.
+
+usage: benchmark_coarse_to_fine.py --out_dir /tmp/c2f --scale 4 -- [fit_altimetry.py arguments]
+"""
+
+import argparse
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+import h5py
+import altimetryFit
+
+def run_fit(fit_args, out_name, extra_args=[]):
+    cmd=[sys.executable, os.path.join(os.path.dirname(altimetryFit.__file__), 'fit_altimetry.py')] \
+        + fit_args + ['--out_name', out_name] + extra_args
+    t0=time.perf_counter()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter()-t0
+
+def compare(ref_file, test_file, fields=['z0/z0', 'dz/dz']):
+    out={}
+    with h5py.File(ref_file,'r') as h5r, h5py.File(test_file,'r') as h5t:
+        for field in fields:
+            if field not in h5r or field not in h5t:
+                continue
+            delta=np.array(h5t[field], dtype=float)-np.array(h5r[field], dtype=float)
+            out[field]={'rms':np.sqrt(np.nanmean(delta**2)), 'max':np.nanmax(np.abs(delta))}
+        for h5f, key in [(h5r, 'ref'), (h5t, 'test')]:
+            if 'data/three_sigma_edit' not in h5f:
+                out['N_'+key], out['N_total_'+key] = -1, -1
+                continue
+            edit=np.array(h5f['data/three_sigma_edit'])
+            out['N_'+key], out['N_total_'+key] = int(np.sum(edit!=0)), int(edit.size)
+    return out
+
+def main():
+    argv=sys.argv[1:]
+    fit_args=[]
+    if '--' in argv:
+        fit_args=argv[argv.index('--')+1:]
+        argv=argv[:argv.index('--')]
+    parser=argparse.ArgumentParser(description='compare coarse-to-fine and single-pass fits')
+    parser.add_argument('--out_dir', type=str, default='.')
+    parser.add_argument('--scale', type=float, nargs='+', default=[4.])
+    args=parser.parse_args(argv)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    ref_file=os.path.join(args.out_dir, 'single_pass.h5')
+    t_ref=run_fit(fit_args, ref_file)
+    print(f"single pass: {t_ref:0.1f} s")
+    for scale in args.scale:
+        test_file=os.path.join(args.out_dir, f'coarse_{scale:g}.h5')
+        t_test=run_fit(fit_args, test_file, ['--coarse_edit_scale', str(scale)])
+        diffs=compare(ref_file, test_file)
+        print(f"coarse scale {scale:g}: {t_test:0.1f} s ({t_test/t_ref:0.2f}x), "
+              f"data retained {diffs['N_test']} of {diffs['N_total_test']} vs "
+              f"{diffs['N_ref']} of {diffs['N_total_ref']}")
+        for field in ['z0/z0', 'dz/dz']:
+            if field in diffs:
+                print(f"\t{field}: RMS difference {diffs[field]['rms']:0.3f} m, max {diffs[field]['max']:0.3f} m")
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measure the import time of altimetryFit entry points.
+
+Each module is imported in a fresh interpreter with -X importtime, several
+times, and the median wall time is reported along with the slowest
+top-level dependencies from the last run, and whether the optional
+subsystems (LSsurf, pyTMD, SMBcorr, pointAdvection, xarray, osgeo) were
+loaded.
+
+usage: benchmark_import_time.py [module ...] [-N 5] [--top 5]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+import numpy as np
+
+default_modules=['altimetryFit', 'altimetryFit.read_optical', 'altimetryFit.fit_altimetry',
+                 'altimetryFit.register_DEMs', 'altimetryFit.im_subset']
+optional=['LSsurf', 'pyTMD', 'SMBcorr', 'pointAdvection', 'xarray', 'osgeo']
+
+def time_import(module):
+    '''
+    Import a module in a new interpreter.
+
+    Returns
+    -------
+    wall_time : float
+        time to start the interpreter and import the module (s)
+    cumulative : dict
+        cumulative import time (s) for each top-level package
+    loaded : list
+        optional subsystems that were imported
+    '''
+    code=f"import sys, {module}; print(' '.join(m for m in {optional!r} if m in sys.modules))"
+    tic=time.time()
+    result=subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          capture_output=True, text=True)
+    wall_time=time.time()-tic
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().split('\n')[-1])
+    cumulative={}
+    for line in result.stderr.split('\n'):
+        # lines look like: import time:  self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields=line.split('|')
+        name=fields[2].rstrip()
+        # top-level imports have the smallest indentation
+        if name.startswith('  '):
+            continue
+        cumulative[name.strip()]=float(fields[1])/1.e6
+    return wall_time, cumulative, result.stdout.split()
+
+def main():
+    parser=argparse.ArgumentParser(description='measure the import time of altimetryFit modules')
+    parser.add_argument('modules', type=str, nargs='*', default=default_modules)
+    parser.add_argument('-N', type=int, default=5, help='number of runs for each module')
+    parser.add_argument('--top', type=int, default=5, help='number of top-level dependencies to list')
+    args=parser.parse_args()
+
+    # time for the interpreter to start, without any imports
+    baseline=np.median([time_import('sys')[0] for ii in range(args.N)])
+    print(f'interpreter start: {baseline:0.3f} s')
+    for module in args.modules:
+        try:
+            times=[]
+            for ii in range(args.N):
+                wall_time, cumulative, loaded = time_import(module)
+                times += [wall_time]
+        except RuntimeError as e:
+            print(f'{module}: import failed: {e}')
+            continue
+        print(f'{module}: {np.median(times)-baseline:0.3f} s (median of {args.N})')
+        print('\toptional subsystems loaded: '+(', '.join(loaded) if len(loaded) > 0 else 'none'))
+        for name in sorted(cumulative, key=cumulative.get, reverse=True)[:args.top]:
+            print(f'\t{cumulative[name]:8.3f} s {name}')
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the size and read/write times of fit_altimetry output profiles.
+
+For each input file (an existing fit_altimetry output), the file size, the
+time to read every dataset, and the time for a mosaic-style windowed read
+of the grids are reported for the file as it is (profile 'input', the
+current layout), and for the file rewritten with each output profile,
+along with the write time.
+
+usage: benchmark_output_profile.py E-200_N-1000.h5 [more files] [--out_dir /tmp]
+"""
+
+import argparse
+import os
+import time
+import tempfile
+import numpy as np
+import h5py
+from altimetryFit.fit_output import fit_output_writer, profiles
+
+class grid_fields(object):
+    '''
+    Minimal stand-in for pc.grid.data, holding the datasets from one group
+    '''
+    def __init__(self, group):
+        self.fields=[]
+        for key, ds in group.items():
+            if not isinstance(ds, h5py.Dataset):
+                continue
+            setattr(self, key, np.array(ds))
+            if key not in ['x', 'y', 'time', 't']:
+                self.fields += [key]
+
+def read_fit_file(filename):
+    '''
+    Read all the datasets from a fit file, sorted into grids, point data and others
+    '''
+    grids={}
+    data={}
+    other={}
+    with h5py.File(filename,'r') as h5f:
+        def visit(name, obj):
+            # /data holds point fields named x and y, but is not a grid
+            if isinstance(obj, h5py.Group) and name != 'data' and 'x' in obj and 'y' in obj:
+                grids[name]=grid_fields(obj)
+            elif isinstance(obj, h5py.Dataset):
+                group=os.path.dirname(name)
+                if group=='data':
+                    data[name]=np.array(obj)
+                elif group not in grids:
+                    other[name]=np.array(obj)
+        h5f.visititems(visit)
+    return grids, data, other
+
+def write_fit_file(filename, grids, data, other, profile):
+    with fit_output_writer(filename, mode='w', profile=profile) as out:
+        for name, val in data.items():
+            out.write_data_field(name, val)
+        for name, val in other.items():
+            out.write_array(name, val)
+        for name, ds in grids.items():
+            out.write_grid(ds, name)
+
+def read_all(filename):
+    with h5py.File(filename,'r') as h5f:
+        def visit(name, obj):
+            # visititems stops at the first non-None return value
+            if isinstance(obj, h5py.Dataset):
+                np.array(obj)
+        h5f.visititems(visit)
+
+def read_windows(filename, W=100):
+    '''
+    Read a WxW window from the center of each 2-D or 3-D grid field
+    '''
+    with h5py.File(filename,'r') as h5f:
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset) and obj.ndim >= 2:
+                r0=max(0, obj.shape[0]//2-W//2)
+                c0=max(0, obj.shape[1]//2-W//2)
+                np.array(obj[r0:r0+W, c0:c0+W, ...])
+        h5f.visititems(visit)
+
+def time_reads(filename, W=100):
+    '''
+    Time a full read and a windowed read of a file
+    '''
+    tic=time.time()
+    read_all(filename)
+    t_read=time.time()-tic
+    tic=time.time()
+    read_windows(filename, W=W)
+    t_window=time.time()-tic
+    return t_read, t_window
+
+def main():
+    parser=argparse.ArgumentParser(description='compare size and read/write times of fit output profiles')
+    parser.add_argument('files', type=str, nargs='+')
+    parser.add_argument('--out_dir', type=str, default=None)
+    parser.add_argument('--window', type=int, default=100)
+    args=parser.parse_args()
+    out_dir=args.out_dir
+    if out_dir is None:
+        out_dir=tempfile.mkdtemp()
+    print('%30s %10s %12s %10s %10s %10s' % ('file', 'profile', 'size (MB)', 'write (s)', 'read (s)', 'window (s)'))
+    for file in args.files:
+        t_read, t_window = time_reads(file, W=args.window)
+        print('%30s %10s %12.2f %10s %10.3f %10.3f' % (os.path.basename(file), 'input',
+              os.path.getsize(file)/2**20, '-', t_read, t_window))
+        grids, data, other = read_fit_file(file)
+        for profile in profiles:
+            out_file=os.path.join(out_dir, profile+'_'+os.path.basename(file))
+            tic=time.time()
+            write_fit_file(out_file, grids, data, other, profile)
+            t_write=time.time()-tic
+            t_read, t_window = time_reads(out_file, W=args.window)
+            print('%30s %10s %12.2f %10.3f %10.3f %10.3f' % (os.path.basename(file), profile,
+                  os.path.getsize(out_file)/2**20, t_write, t_read, t_window))
+            os.remove(out_file)
+
+if __name__=='__main__':
+    main()
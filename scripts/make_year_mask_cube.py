@@ -0,0 +1,39 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compile the yearly masks in a directory into a bit-packed mask cube.
+
+Run this once, before the tile fits, whenever the masks change.  The fits
+(fit_altimetry.py --year_mask_dir) use the cube if it is current, and
+otherwise read the masks one year at a time.
+
+usage: make_year_mask_cube.py mask_dir [--cube_file year_mask_cube.h5]
+"""
+
+import argparse
+import os
+import sys
+from altimetryFit.year_mask_cube import find_year_masks, cube_is_current, make_year_mask_cube
+
+def main():
+    parser=argparse.ArgumentParser(description='compile yearly mask geotifs into a bit-packed cube')
+    parser.add_argument('mask_dir', type=str)
+    parser.add_argument('--cube_file', type=str, help='output file, default is year_mask_cube.h5 in mask_dir')
+    parser.add_argument('--chunk', type=int, default=256)
+    parser.add_argument('--force', action='store_true', help='rebuild the cube even if it is current')
+    args=parser.parse_args()
+    cube_file=args.cube_file
+    if cube_file is None:
+        cube_file=os.path.join(args.mask_dir, 'year_mask_cube.h5')
+    years, files = find_year_masks(args.mask_dir)
+    if len(files)==0:
+        print(f"no yearly masks found in {args.mask_dir}")
+        sys.exit(1)
+    if cube_is_current(cube_file, years, files) and not args.force:
+        print(f"{cube_file} is current")
+        return
+    if not make_year_mask_cube(cube_file, years, files, chunk=args.chunk):
+        sys.exit(1)
+
+if __name__=='__main__':
+    main()
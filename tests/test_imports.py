@@ -0,0 +1,28 @@
+"""
+The lazily imported package exports the same objects as its submodules.
+"""
+
+import importlib
+import sys
+import pytest
+import altimetryFit
+
+def submodule(name):
+    try:
+        return importlib.import_module('altimetryFit.'+name)
+    except ImportError as e:
+        pytest.skip(f'optional dependency missing: {e}')
+
+@pytest.mark.parametrize('name', sorted(altimetryFit._lazy_attrs))
+def test_lazy_attr_is_submodule_attr(name):
+    module=submodule(altimetryFit._lazy_attrs[name])
+    assert getattr(altimetryFit, name) is getattr(module, name)
+
+@pytest.mark.parametrize('name', ['reread_data_from_fits', 'check_ATL06_hold_list', 'read_ICESat2', 'im_subset'])
+def test_submodule_import_keeps_export(name):
+    # importing a submodule that shares a name with an exported function
+    # must not replace the function with the module
+    sys.modules.pop('altimetryFit.'+name, None)
+    vars(altimetryFit).pop(name, None)
+    module=submodule(name)
+    assert getattr(altimetryFit, name) is getattr(module, name)